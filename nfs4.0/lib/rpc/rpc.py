@@ -48,52 +48,96 @@ else:
     class my_poll(object):
         """Emulate select.poll using select.select"""
         def __init__(self):
-            self._in = []
-            self._out = []
-            self._err = []
+            self._in = {}
+            self._out = {}
+            self._err = {}
 
         def register(self, fd, eventmask=_bothmask):
             if type(fd) != int:
                 fd = fd.fileno()
             self.unregister(fd)
             if eventmask & _readmask:
-                self._in.append(fd)
+                self._in[fd] = 1
             if eventmask & _writemask:
-                self._out.append(fd)
-            self._err.append(fd)
+                self._out[fd] = 1
+            self._err[fd] = 1
 
         def unregister(self, fd):
             if type(fd) != int:
                 fd = fd.fileno()
             # Remove
-            if fd in self._in: self._in.remove(fd)
-            if fd in self._out: self._out.remove(fd)
-            if fd in self._err: self._err.remove(fd)
+            self._in.pop(fd, None)
+            self._out.pop(fd, None)
+            self._err.pop(fd, None)
 
         def poll(self, timeout=None):
-            # STUB - deal with timeout
-            read, write, err = select.select(self._in, self._out, self._err)
-            list = []
+            if timeout is not None:
+                timeout = timeout / 1000.0
+            read, write, err = select.select(self._in.keys(),
+                                             self._out.keys(),
+                                             self._err.keys(), timeout)
+            masks = {}
             for fd in read:
-                mask = select.POLLIN
-                if fd in write:
-                    mask |= select.POLLOUT
-                    write.remove(fd)
-                if fd in err:
-                    mask |= select.POLLERR
-                    err.remove(fd)
-                list.append((fd, mask))
+                masks[fd] = select.POLLIN
             for fd in write:
-                mask = select.POLLOUT
-                if fd in err:
-                    mask |= select.POLLERR
-                    err.remove(fd)
-                list.append((fd, mask))
+                masks[fd] = masks.get(fd, 0) | select.POLLOUT
             for fd in err:
-                mask = select.POLLOUT
-                list.append((fd, mask))
-            return list
+                masks[fd] = masks.get(fd, 0) | select.POLLERR
+            return masks.items()
     select.poll = my_poll
+
+class epoll_poll(object):
+    """Give select.epoll the interface of select.poll
+
+    The POLL* and EPOLL* event bits have the same values, so masks pass
+    straight through.  Registering an fd again with the mask it already
+    has costs nothing, which matters since RPCServer does this for every
+    reply it queues.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._masks = {} # {fd: eventmask}
+
+    def register(self, fd, eventmask=_bothmask):
+        if type(fd) != int:
+            fd = fd.fileno()
+        old = self._masks.get(fd)
+        if old == eventmask:
+            return
+        if old is None:
+            self._epoll.register(fd, eventmask)
+        else:
+            self._epoll.modify(fd, eventmask)
+        self._masks[fd] = eventmask
+
+    def unregister(self, fd):
+        if type(fd) != int:
+            fd = fd.fileno()
+        if self._masks.pop(fd, None) is not None:
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, ValueError):
+                # Already closed, which removes it from the epoll set
+                pass
+
+    def poll(self, timeout=None):
+        # poll takes milliseconds, epoll takes seconds
+        if timeout is None or timeout < 0:
+            timeout = -1
+        else:
+            timeout = timeout / 1000.0
+        while 1:
+            try:
+                return self._epoll.poll(timeout)
+            except IOError, e:
+                if e.errno != errno.EINTR:
+                    raise
+
+def new_poll():
+    """Return the best poll object this platform has"""
+    if hasattr(select, "epoll"):
+        return epoll_poll()
+    return select.poll()
         
 class RPCError(Exception):
     pass
@@ -163,17 +207,38 @@ def _recv_record(self):
         data += self.recv_all(count)
     return data
 
-def _send_record(self, data, chunksize=2048):
+def _read_record(f):
+    """Read a record marked record from file object f"""
+    last = False
+    data = []
+    while not last:
+        rec_mark = f.read(4)
+        if len(rec_mark) < 4:
+            raise EOFError("Connection closed")
+        count = struct.unpack('>L', rec_mark)[0]
+        last = count & 0x80000000L
+        if last:
+            count &= 0x7fffffffL
+        frag = f.read(count)
+        if len(frag) < count:
+            raise EOFError("Connection closed")
+        data.append(frag)
+    return ''.join(data)
+
+def _send_record(self, data, chunksize=65536):
     """Send data using record marking standard"""
     dlen = len(data)
     i = last = 0
+    out = []
     while not last:
-        chunk = data[i:i+chunksize]
+        chunk = buffer(data, i, chunksize)
         i += chunksize
         if i >= dlen:
             last = 0x80000000L
-        mark = struct.pack('>L', last | len(chunk))
-        self.sendall(mark + chunk)
+        out.append(struct.pack('>L', last | len(chunk)))
+        out.append(str(chunk))
+    # One sendall rather than one per fragment
+    self.sendall(''.join(out))
 
 socket._socketobject.recv_all = _recv_all
 socket._socketobject.recv_record = _recv_record
@@ -182,20 +247,30 @@ socket._socketobject.send_record = _send_record
 #################################################
 
 class RPCClient(object):
+    """RPC client that multiplexes calls over one connection
+
+    Any number of threads may have calls outstanding at once.  A reader
+    thread owns the receiving side of the connection and hands each
+    reply to whichever call is waiting on its xid.  If the connection
+    drops, it is reopened and every outstanding call is sent again.
+    """
     def __init__(self, host='localhost', port=51423,
                  program=None, version=None, sec_list=None, timeout=15.0,
-                 uselowport=False):
+                 uselowport=False, retrans=0):
         self.debug = 0
         t = threading.currentThread()
         self.lock = threading.Lock()
+        self.iolock = threading.Lock() # serializes use of the connection
         self.af = socket.AF_INET;
         if host.find(':') != -1:
             self.af = socket.AF_INET6;
         self.remotehost = host
         self.remoteport = port
         self.timeout = timeout
+        self.retrans = retrans # resends of a call before giving up
         self.uselowport = uselowport
-        self._socket = {}
+        self._socket = None
+        self._xidlist = {} # {xid: XidCache} for calls awaiting a reply
         self.getsocket() # init socket, is this needed here?
         self.ipaddress = self.socket.getsockname()[0]
         self._rpcpacker = {t : rpc_pack.RPCPacker()}
@@ -203,7 +278,6 @@ class RPCClient(object):
         self.default_prog = program
         self.default_vers = version
         self.xid = 0L
-        self._xidlist = {}
         if sec_list is None:
             sec_list = [SecAuthNone()]
         self.sec_list = sec_list
@@ -233,18 +307,34 @@ class RPCClient(object):
                     print "Could not use low port"
                     return
 
+    def _connect(self):
+        """Open a new connection, with a reader thread for it
+
+        Must hold iolock.
+        """
+        out = socket.socket(self.af, socket.SOCK_STREAM)
+        if self.uselowport:
+            self.bindsocket(out)
+        out.connect((self.remotehost, self.remoteport))
+        # Reply timeouts are handled per call in listen, so the reader
+        # can block without ever losing its place in a record
+        out.settimeout(None)
+        self._socket = out
+        t = threading.Thread(target=self._read_replies, args=(out,),
+                             name="rpc reader %s:%s" %
+                             (self.remotehost, self.remoteport))
+        t.setDaemon(True)
+        t.start()
+        return out
+
     def getsocket(self):
-        t = threading.currentThread()
-        self.lock.acquire()
-        if t in self._socket:
-            out = self._socket[t]
-        else:
-            out = self._socket[t] = socket.socket(self.af, socket.SOCK_STREAM)
-            if self.uselowport:
-                self.bindsocket(out)
-            out.connect((self.remotehost, self.remoteport))
-            out.settimeout(self.timeout)
-        self.lock.release()
+        self.iolock.acquire()
+        try:
+            out = self._socket
+            if out is None:
+                out = self._connect()
+        finally:
+            self.iolock.release()
         return out
 
     socket = property(getsocket)
@@ -266,8 +356,8 @@ class RPCClient(object):
         if t in self._rpcunpacker:
             out = self._rpcunpacker[t]
         else:
-            self._rpcpacker[t] = gss_pack.GSSPacker()
-            out = self._rpcunpacker[t] = gss_pack.GSSUnpacker('')
+            self._rpcpacker[t] = rpc_pack.RPCPacker()
+            out = self._rpcunpacker[t] = rpc_pack.RPCUnpacker('')
         self.lock.release()
         return out
 
@@ -279,39 +369,112 @@ class RPCClient(object):
             self.rhead = None    # unpacked reply header
             self.rdata = None    # unsecured reply data
             self.proc = proc     # unpacked proc from header
+            self.error = None    # set if the call could not be completed
+            self.done = threading.Event() # set once rhead or error is
 
         def __repr__(self):
             return "%s\n%s" % (self.header, self.data)
 
     def add_outstanding_xids(self, xid, header, data, cred, proc):
-        t = threading.currentThread()
         self.lock.acquire()
-        if t in self._xidlist:
-            if xid in self._xidlist[t]: raise
-            self._xidlist[t][xid] = self.XidCache(header, data, cred, proc)
-        else:
-            self._xidlist[t] = {xid : self.XidCache(header, data, cred, proc)}
-        self.lock.release()
+        try:
+            if xid in self._xidlist:
+                raise RPCError("xid %i is already outstanding" % xid)
+            out = self._xidlist[xid] = \
+                  self.XidCache(header, data, cred, proc)
+        finally:
+            self.lock.release()
+        return out
 
     def get_outstanding_xids(self):
-        t = threading.currentThread()
         self.lock.acquire()
-        out = self._xidlist[t]
+        out = self._xidlist.copy()
         self.lock.release()
         return out
 
     def reconnect(self):
-        t = threading.currentThread()
-        self.lock.acquire()
-        self._socket[t].close()
-        out = self._socket[t] = socket.socket(self.af, socket.SOCK_STREAM)
-        if self.uselowport:
-            self.bindsocket(out)
-        out.connect((self.remotehost, self.remoteport))
-        out.settimeout(self.timeout)
-        self.lock.release()
+        """Replace the connection, resending every outstanding call"""
+        self.iolock.acquire()
+        try:
+            return self._reconnect()
+        finally:
+            self.iolock.release()
+
+    def _reconnect(self):
+        # Must hold iolock
+        if self._socket is not None:
+            # shutdown, since the old reader's makefile keeps it open
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._socket.close()
+            self._socket = None
+        out = self._connect()
+        for xid, call in self.get_outstanding_xids().items():
+            if not call.done.isSet():
+                if self.debug: print "resend", xid
+                out.send_record(call.header + call.data)
         return out
-        
+
+    def _transmit(self, call):
+        self.iolock.acquire()
+        try:
+            try:
+                if self._socket is None:
+                    # _connect can't resend, so _reconnect sends call too
+                    self._reconnect()
+                else:
+                    self._socket.send_record(call.header + call.data)
+            except socket.error, e:
+                print "Got error:", e
+                self._reconnect()
+        finally:
+            self.iolock.release()
+
+    def _read_replies(self, sock):
+        """Route each reply arriving on sock to the call waiting for it"""
+        p = rpc_pack.RPCUnpacker('')
+        f = sock.makefile('rb')
+        try:
+            while 1:
+                reply = _read_record(f)
+                p.reset(reply)
+                try:
+                    rhead = p.unpack_rpc_msg()
+                except xdrlib.Error, e:
+                    print "XDRError", e
+                    continue
+                self.lock.acquire()
+                call = self._xidlist.get(rhead.xid)
+                if call is not None and not call.done.isSet():
+                    call.rhead = rhead
+                    call.rdata = reply[p.get_position():]
+                    call.done.set()
+                self.lock.release()
+                # Anything else is a reply to a call that has been given
+                # up on, or a second reply to a retransmitted call
+        except (socket.error, EOFError), e:
+            pass
+        self.iolock.acquire()
+        try:
+            if self._socket is not sock:
+                # Someone else has already replaced this connection
+                return
+            try:
+                self._reconnect()
+            except socket.error, e:
+                # Fail every waiting call, the next send will try again
+                self._socket = None
+                self.lock.acquire()
+                for call in self._xidlist.values():
+                    if not call.done.isSet():
+                        call.error = e
+                        call.done.set()
+                self.lock.release()
+        finally:
+            self.iolock.release()
+
     def send(self, procedure, data='', program=None, version=None):
         """Send an RPC call to the server
 
@@ -325,80 +488,60 @@ class RPCClient(object):
         xid = self.get_new_xid()
         header, cred = self.get_call_header(xid, program, version, procedure)
         data = self.security.secure_data(data, cred)
+        if self.debug: print "send %i" % xid
+        # Must be outstanding before it is sent, or the reply can race it
+        call = self.add_outstanding_xids(xid, header, data, cred, procedure)
         try:
-            if self.debug: print "send %i" % xid
-            self.socket.send_record(header + data)
-        except socket.timeout:
+            self._transmit(call)
+        except:
+            self.lock.acquire()
+            del self._xidlist[xid]
+            self.lock.release()
             raise
-        except socket.error, e:
-            print "Got error:", e
-            if self.debug: print "resend", xid
-            try:
-                self.reconnect().send_record(header + data)
-            except socket.error:
-                self.reconnect()
-                raise
-        self.add_outstanding_xids(xid, header, data, cred, procedure)
         return xid
 
     def listen(self, xid):
-        # Exists (per thread) list of outstanding xid/seq pairs
-        # If xid not on list, return error.
-        # Listen until get reply with given xid.  Cache others received
-        # on list.  Return error if get one not on list.
+        """Wait for and return the reply to xid
+
+        After waiting timeout seconds the call is sent again, up to
+        retrans times, after which socket.timeout is raised.
+        """
         if self.debug: print "listen", xid
-        list = self.get_outstanding_xids()
-        if xid not in list:
-            raise
-        done = False
-        rdata = list[xid].rdata
-        if rdata is not None:
-            rhead = list[xid].rhead
-            done = True
-        while not done:
-            try:
-                reply = self.socket.recv_record()
-            except socket.timeout:
+        self.lock.acquire()
+        call = self._xidlist.get(xid)
+        self.lock.release()
+        if call is None:
+            raise RPCError("xid %i is not outstanding" % xid)
+        tries = 0
+        try:
+            while not call.done.wait(self.timeout):
+                if tries >= self.retrans:
+                    raise socket.timeout("timed out waiting for xid %i" % xid)
+                tries += 1
+                if self.debug: print "retransmit", xid
+                self._transmit(call)
+        finally:
+            self.lock.acquire()
+            del self._xidlist[xid]
+            self.lock.release()
+        if call.error is not None:
+            raise call.error
+        rhead = call.rhead
+        rdata = call.rdata
+        try:
+            # BUG?, should use rhead credentials?
+            # This conditional is gss specific code that should be hidden
+            if rhead.rbody.stat == MSG_ACCEPTED and \
+                    rhead.areply.reply_data.stat == SUCCESS:
+                rdata = self.security.unsecure_data(rdata, call.cred)
+        except:
+            if 0:
+                # need for servers that don't add gss checksum to errors
+                pass
+            else:
                 raise
-            except socket.error, e:
-                print "Got error:", e
-                if self.debug: print "relisten", xid
-                try:
-                    s = self.reconnect()
-                    s.send_record(list[xid].header + list[xid].data)
-                    reply = s.recv_record()
-                except socket.error:
-                    self.reconnect()
-                    raise
-            p = self.getrpcunpacker()
-            p.reset(reply)
-            rhead = p.unpack_rpc_msg()
-            rxid = rhead.xid
-            if rxid not in list:
-                raise RPCError("Got reply xid %i, expected %i" % \
-                               (rxid, xid))
-            if list[rxid].rhead is not None:
-                raise RPCError("Duplicated reply xid %i" % rxid)
-            rdata = reply[p.get_position():]
-            try:
-                # BUG?, should use rhead credentials?
-                # This conditional is gss specific code that should be hidden
-                if rhead.rbody.stat == MSG_ACCEPTED and \
-                        rhead.areply.reply_data.stat == SUCCESS:
-                    rdata = self.security.unsecure_data(rdata, list[rxid].cred)
-            except:
-                if 0:
-                    # need for servers that don't add gss checksum to errors
-                    pass
-                else:
-                    raise
-            list[rxid].rhead = rhead
-            list[rxid].rdata = rdata
-            if rxid == xid:
-                done = True
-        out = list[xid]
-        del list[xid]
-        self.check_reply(out)
+        call.rdata = rdata
+        self.check_reply(call)
         return rdata
 
     def call(self, procedure, data='', program=None, version=None):
@@ -456,6 +599,11 @@ class RPCClient(object):
 ###################################################
 
 class Server(object):
+    # Bounds on how much is read from a connection per event.  The size
+    # used grows while reads fill it, and shrinks while they do not.
+    minread = 4096
+    maxread = 1024 * 1024
+
     def __init__(self, host='', port=51423, name="SERVER"):
         try:
             self.s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
@@ -466,9 +614,20 @@ class Server(object):
         self.port = self.s.getsockname()[1]
         self.s.setblocking(0)
         # Set up poll object
-        self.p = select.poll()
+        self.p = new_poll()
         self.p.register(self.s, _readmask)
         self.name = name
+        self.readsizes = {} # {fd: current read size}
+
+    def recv(self, fd):
+        """Read whatever fd has ready, adapting the size asked for"""
+        size = self.readsizes.get(fd, self.minread)
+        data = self.sockets[fd].recv(size)
+        if len(data) == size:
+            self.readsizes[fd] = min(2 * size, self.maxread)
+        elif len(data) < size // 4 and size > self.minread:
+            self.readsizes[fd] = size // 2
+        return data
 
     def run(self, debug=0):
         while 1:
@@ -496,13 +655,17 @@ class Server(object):
                         if fd == self.s.fileno():
                             self.event_connect(fd)
                         else:
-                            data = self.sockets[fd].recv(4096)
+                            data = self.recv(fd)
                             if data:
                                 self.event_read(fd, data)
                             else:
                                 self.event_close(fd)
 
 class RPCServer(Server):
+    # Largest record fragment sent, and most bytes handed to one send()
+    fragsize = 64 * 1024
+    maxsend = 1024 * 1024
+
     def __init__(self, prog=10, vers=4, host='', port=51423):
         Server.__init__(self, host, port)
         self.rpcpacker =  rpc_pack.RPCPacker()
@@ -518,9 +681,9 @@ class RPCServer(Server):
                 self.security[sectype] = supported[secname]()
 
         self.readbufs = {}
-        self.writebufs = {}
+        self.writebufs = {} # record marked data waiting to be sent
+        self.writepos = {} # how much of writebufs has been sent
         self.packetbufs = {} # store packets read until have a whole record
-        self.recordbufs = {} # write buffer for outgoing records
         self.sockets = {}
         self.s.listen(5)
 
@@ -539,10 +702,10 @@ class RPCServer(Server):
                   (csock.getpeername(), csock.fileno())
         self.p.register(csock, _readmask)
         cfd = csock.fileno()
-        self.readbufs[cfd] = ''
-        self.writebufs[cfd] = ''
+        self.readbufs[cfd] = bytearray()
+        self.writebufs[cfd] = bytearray()
+        self.writepos[cfd] = 0
         self.packetbufs[cfd] = []
-        self.recordbufs[cfd] = []
         self.sockets[cfd] = csock
         
     def event_read(self, fd, data, debug=0):
@@ -551,58 +714,76 @@ class RPCServer(Server):
         Also responds to command codes sent as encoded integers
         """
         if debug: print "SERVER: In read event for %i" % fd
-        self.readbufs[fd] += data
-        loop = True
-        while loop:
-            loop = False
-            str = self.readbufs[fd]
-            if len(str) >= 4:
-                packetlen = struct.unpack('>L', str[0:4])[0]
-                last = 0x80000000L & packetlen
-                packetlen &= 0x7fffffffL
-                if len(str) >= 4 + packetlen:
-                    self.packetbufs[fd].append(str[4:4 + packetlen])
-                    self.readbufs[fd] = str[4 + packetlen:]
-                    if self.readbufs[fd]:
-                        loop = True # We've received data past last 
-                    if last:
-                        if debug: print "SERVER: Received record from %i" % fd
-                        recv_data = ''.join(self.packetbufs[fd])
-                        self.packetbufs[fd] = []
-                        if len(recv_data) == 4:
-                            reply = self.event_command(fd, struct.unpack('>L', recv_data)[0])
-                        else:
-                            # All handle_* functions are called in compute_reply
-                            reply = self.compute_reply(recv_data)
-                        if reply is not None:
-                            self.recordbufs[fd].append(reply)
-                            self.p.register(fd, _bothmask)
-
-    def event_write(self, fd, chunksize=2048, debug=0):
-        if debug: print "SERVER: In write event for %i" % fd
-        if self.writebufs[fd]:
-            if debug: print "  writing from writebuf"
-            count = self.sockets[fd].send(self.writebufs[fd])
-            self.writebufs[fd] = self.writebufs[fd][count:]
-            # check if done?
-        elif self.recordbufs[fd]:
-            if debug: print "  writing from recordbuf"
-            data = self.recordbufs[fd][0]
-            chunk = data[:chunksize]
-            if len(data) > chunksize:
-                last = 0
-                self.recordbufs[fd][0] = data[chunksize:]
+        buf = self.readbufs[fd]
+        buf.extend(data)
+        view = memoryview(buf)
+        pos = 0
+        end = len(buf)
+        records = []
+        while end - pos >= 4:
+            packetlen = struct.unpack_from('>L', buf, pos)[0]
+            last = 0x80000000L & packetlen
+            packetlen &= 0x7fffffffL
+            if end - pos - 4 < packetlen:
+                break
+            self.packetbufs[fd].append(view[pos + 4:pos + 4 + packetlen].tobytes())
+            pos += 4 + packetlen
+            if last:
+                if debug: print "SERVER: Received record from %i" % fd
+                records.append(''.join(self.packetbufs[fd]))
+                self.packetbufs[fd] = []
+        # The view must be released before buf can be resized
+        del view
+        del buf[:pos]
+        for recv_data in records:
+            if len(recv_data) == 4:
+                reply = self.event_command(fd, struct.unpack('>L', recv_data)[0])
             else:
-                last = 0x80000000L
-                del self.recordbufs[fd][0]
-            mark = struct.pack('>L', last | len(chunk))
-            self.writebufs[fd] = (mark + chunk)
-            # Duplicated code
-            count = self.sockets[fd].send(self.writebufs[fd])
-            self.writebufs[fd] = self.writebufs[fd][count:]
-        else:
+                # All handle_* functions are called in compute_reply
+                reply = self.compute_reply(recv_data)
+            if reply is not None:
+                self.queue_record(fd, reply)
+
+    def queue_record(self, fd, data):
+        """Record mark data and add it to the output for fd"""
+        out = self.writebufs[fd]
+        size = self.fragsize
+        i = 0
+        while len(data) - i > size:
+            out.extend(struct.pack('>L', size))
+            out.extend(buffer(data, i, size))
+            i += size
+        out.extend(struct.pack('>L', 0x80000000L | (len(data) - i)))
+        out.extend(buffer(data, i))
+        self.p.register(fd, _bothmask)
+
+    def event_write(self, fd, debug=0):
+        """Send as much queued output as the socket will take
+
+        Every queued record goes out through the one buffer, so a burst
+        of replies costs one send() rather than one per fragment.
+        """
+        if debug: print "SERVER: In write event for %i" % fd
+        out = self.writebufs[fd]
+        pos = self.writepos[fd]
+        if pos < len(out):
+            view = memoryview(out)
+            try:
+                pos += self.sockets[fd].send(view[pos:pos + self.maxsend])
+            except socket.error, e:
+                if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            del view
+        if pos >= len(out):
             if debug: print "  done writing"
+            del out[:]
+            pos = 0
             self.p.register(fd, _readmask)
+        elif pos > self.maxsend and 2 * pos > len(out):
+            # Drop what has been sent, without moving data on every send
+            del out[:pos]
+            pos = 0
+        self.writepos[fd] = pos
 
     def event_command(self, cfd, comm, debug=0):
         if debug:
@@ -624,9 +805,10 @@ class RPCServer(Server):
         self.sockets[fd].close()
         del self.readbufs[fd]
         del self.writebufs[fd]
+        del self.writepos[fd]
         del self.packetbufs[fd]
-        del self.recordbufs[fd]
         del self.sockets[fd]
+        self.readsizes.pop(fd, None)
         
     event_hup = event_error
 
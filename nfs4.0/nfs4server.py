@@ -664,6 +664,7 @@ class NFS4Server(rpc.RPCServer):
             attrs = nfs4lib.bitmap2list(op.opreaddir.attr_request)
             entries = []
             bytecnt = 0
+            eof = 1
             packer = nfs4lib.FancyNFS4Packer()
             for entry in dirlist:
                 # Get file attributes
@@ -680,19 +681,17 @@ class NFS4Server(rpc.RPCServer):
                 # Make sure returned value not too big
                 bytecnt += len(packer.get_buffer())
                 if bytecnt > op.opreaddir.maxcount - 16:
+                    eof = 0
                     break
                 # Add file to returned entries
                 entries.insert(0,entry)
-            if (not entries) and dirlist:
+            if (not entries) and not eof:
                 return simple_error(NFS4ERR_TOOSMALL)
             # Encode entries as linked list
             e4 = []
             for entry in entries:
                 e4 = [entry4(entry.cookie, entry.name, entry.attr, nextentry=e4)]
-            if len(entries) < len(dirlist):
-                d4 = dirlist4(e4, eof=0)
-            else:
-                d4 = dirlist4(e4, eof=1)
+            d4 = dirlist4(e4, eof=eof)
         except NFS4Error, e:
             return simple_error(e.code)
         rdresok = READDIR4resok(cookieverf=verifier, reply=d4)
@@ -840,6 +839,7 @@ class NFS4Server(rpc.RPCServer):
         v = op.opsetclientid.client.verifier
         k = (op.opsetclientid.callback, op.opsetclientid.callback_ident)
         p = "Stub" # Principal
+        self.state.expire_clients()
         # NOTE this makes the assumption that only one entry can match x=x
         entry = self.state.confirmed.find(x=x)
         entry2 = self.state.unconfirmed.find(x=x)
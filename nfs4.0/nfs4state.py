@@ -4,7 +4,8 @@ import nfs4_pack
 import rpc.rpc
 import nfs4acl
 import nfs4lib
-import os, time, array, random, string
+import os, time, array, random, string, bisect
+from collections import deque
 try:
     import cStringIO
     StringIO = cStringIO
@@ -101,9 +102,17 @@ class NFSServerState:
         self.rootfh = root # FIXME used to get leasetime, should be better way
 
     class ClientIDCache:
+        """Client records, indexed by clientid, name and server verifier
+
+        Each of c, x and s is unique within one cache, so any lookup
+        giving one of them is a dict access.  Leases are kept in a queue
+        in renewal order so expire() need only look at its head.
+        """
         def __init__(self):
-            self.list = []
-            self.dict = {}
+            self.dict = {} # {c : CacheEntry}
+            self.names = {} # {x : CacheEntry}
+            self.verifiers = {} # {s : CacheEntry}
+            self.leases = deque() # [(time, c), ...] oldest first
 
         class CacheEntry:
             def __init__(self, v, x, c, k, s, p):
@@ -128,6 +137,9 @@ class NFSServerState:
                 if s is not None and s != self.s: return False
                 return True
 
+        def __len__(self):
+            return len(self.dict)
+
         def add(self, v, x, c, k, s, p):
             """Add entry into cache
 
@@ -139,47 +151,88 @@ class NFSServerState:
             p is principal
             """
             # This assumes does not already exist in cache
-            entry = self.CacheEntry(v, x, c, k, s, p)
-            if self.exists(x=x) or self.exists(c=c):
-                raise "Bad Cache"
-            self.list.append(entry)
-            self.dict[c] = entry
+            self.addentry(self.CacheEntry(v, x, c, k, s, p))
 
         def addentry(self, entry):
             if not isinstance(entry, self.CacheEntry):
                 raise TypeError, "Bad entry: %s" % str(entry)
-            if self.exists(x=entry.x) or self.exists(c=entry.c):
+            if entry.x in self.names or entry.c in self.dict:
                 raise "Bad Cache"
-            self.list.append(entry)
             self.dict[entry.c] = entry
+            self.names[entry.x] = entry
+            self.verifiers[entry.s] = entry
+            self._queue(entry)
+
+        def _queue(self, entry):
+            self.leases.append((entry.time, entry.c))
+            if len(self.leases) > 2 * len(self.dict) + 16:
+                # Mostly stale slots, rebuild so the queue stays bounded
+                self.leases = deque(sorted([(e.time, e.c)
+                                            for e in self.dict.values()]))
+
+        def _candidates(self, v, x, c, k, s):
+            """Return entries that might match, using an index if possible"""
+            if c is not None:
+                index, key = self.dict, c
+            elif x is not None:
+                index, key = self.names, x
+            elif s is not None:
+                index, key = self.verifiers, s
+            else:
+                return self.dict.values()
+            entry = index.get(key)
+            if entry is None:
+                return []
+            return [entry]
 
         def exists(self, v=None, x=None, c=None, k=None, s=None):
             """Returns True if cache contains an entry matching input"""
-            for entry in self.list:
-                if entry.matches(v, x, c, k, s): return True
-            return False
+            return self.find(v, x, c, k, s) is not None
 
         def remove(self, v=None, x=None, c=None, k=None, s=None):
             """Remove all cache entries matching input"""
-            for i, entry in zip(range(len(self.list)), self.list):
+            for entry in self._candidates(v, x, c, k, s):
                 if entry.matches(v, x, c, k, s):
-                    del self.list[i]
-                    del self.dict[entry.c]
+                    self._remove(entry)
+
+        def _remove(self, entry):
+            del self.dict[entry.c]
+            del self.names[entry.x]
+            if self.verifiers.get(entry.s) is entry:
+                del self.verifiers[entry.s]
+            # Its place in self.leases is dropped lazily by expire()
 
         def find(self, v=None, x=None, c=None, k=None, s=None):
             """Returns first cache entry matching input, or None"""
-            for entry in self.list:
+            for entry in self._candidates(v, x, c, k, s):
                 if entry.matches(v, x, c, k, s): return entry
             return None
 
         def renew(self, client):
             """Renews lease for client"""
-            self.dict[client].time = int(time.time())
+            entry = self.dict[client]
+            now = int(time.time())
+            if entry.time != now:
+                entry.time = now
+                self._queue(entry)
 
         def expired(self, client, secs):
             """Returns True if client has not been renewed in past secs"""
             return int(time.time()) - self.dict[client].time > secs
 
+        def expire(self, secs):
+            """Remove and return entries not renewed in past secs"""
+            out = []
+            limit = int(time.time()) - secs
+            while self.leases and self.leases[0][0] < limit:
+                t, c = self.leases.popleft()
+                entry = self.dict.get(c)
+                # Skip queue slots left behind by a renew or remove
+                if entry is not None and entry.time == t:
+                    self._remove(entry)
+                    out.append(entry)
+            return out
+
     class StateIDInfo:
         """State associated with an id"""
         def __init__(self, fh, ownerinfo):
@@ -492,6 +545,14 @@ class NFSServerState:
         if id not in self.special_ids:
             self.confirmed.renew(self.state[id].owner.owner.clientid)
 
+    def expire_clients(self):
+        """Drop unconfirmed clientids whose lease has run out
+
+        Confirmed clients are left alone, their state is only given up
+        when it conflicts with another client (see __expire).
+        """
+        return self.unconfirmed.expire(self.rootfh.fattr4_lease_time)
+
     def renew(self, clientid):
         """Implements state changes of RENEW operation"""
         self.__check_clientid(clientid)
@@ -1334,7 +1395,96 @@ class VirtualHandle(NFSFileHandle):
         self.fattr4_time_metadata = converttime()
         return len(data)
 
+class HardStore:
+    """Open file descriptors and lstat results shared by HardHandles
+
+    At most maxfds descriptors are kept open, the least recently used
+    being closed first.  A stat result is reused for up to ttl seconds,
+    and is dropped as soon as the server itself changes the file.
+    """
+    def __init__(self, maxfds=64, ttl=1.0):
+        self.maxfds = maxfds
+        self.ttl = ttl
+        self.fds = {} # form {file : [fd, writable, lastuse]}
+        self.stats = {} # form {file : (time, stat_struct)}
+        self.__clock = 0
+
+    def lstat(self, file):
+        now = time.time()
+        try:
+            when, stat_struct = self.stats[file]
+            if now - when < self.ttl:
+                return stat_struct
+        except KeyError:
+            pass
+        stat_struct = os.lstat(file)
+        self.stats[file] = (now, stat_struct)
+        return stat_struct
+
+    def invalidate(self, file):
+        """Forget cached stat of file, call after changing it"""
+        try:
+            del self.stats[file]
+        except KeyError:
+            pass
+
+    def close(self, file):
+        """Close any descriptor held for file, and forget its stat"""
+        self.invalidate(file)
+        try:
+            fd = self.fds.pop(file)[0]
+        except KeyError:
+            return
+        os.close(fd)
+
+    def getfd(self, file, writable=False):
+        """Return an open descriptor for file, opening it if needed"""
+        self.__clock += 1
+        entry = self.fds.get(file)
+        if entry is not None:
+            if entry[1] or not writable:
+                entry[2] = self.__clock
+                return entry[0]
+            # Only open for reading, reopen below
+            self.close(file)
+        if writable:
+            fd = os.open(file, os.O_RDWR)
+        else:
+            try:
+                fd = os.open(file, os.O_RDWR)
+                writable = True
+            except OSError:
+                fd = os.open(file, os.O_RDONLY)
+        if len(self.fds) >= self.maxfds:
+            lru = min([(e[2], f) for f, e in self.fds.items()])[1]
+            os.close(self.fds.pop(lru)[0])
+        self.fds[file] = [fd, writable, self.__clock]
+        return fd
+
+    def pread(self, file, offset, count):
+        fd = self.getfd(file)
+        os.lseek(fd, offset, 0)
+        out = []
+        while count > 0:
+            data = os.read(fd, count)
+            if not data:
+                break
+            out.append(data)
+            count -= len(data)
+        return "".join(out)
+
+    def pwrite(self, file, offset, data):
+        fd = self.getfd(file, writable=True)
+        os.lseek(fd, offset, 0)
+        count = len(data)
+        while data:
+            data = data[os.write(fd, data):]
+        self.invalidate(file)
+        return count
+
 class HardHandle(NFSFileHandle):
+    store = HardStore() # Shared by all HardHandles
+
     def __init__(self, filesystem, name, parent, file):
         NFSFileHandle.__init__(self, name, parent)
         self.file = file
@@ -1345,7 +1495,7 @@ class HardHandle(NFSFileHandle):
         return self.parent
 
     def get_attributes(self, attrlist=None):
-        stat_struct = os.lstat(self.file)
+        stat_struct = self.store.lstat(self.file)
         ret_dict = {};
         for attr in attrlist:
             if attr == FATTR4_TYPE:
@@ -1394,7 +1544,7 @@ class HardHandle(NFSFileHandle):
                 return os.readlink(self.file)
 
     def get_type(self):
-        stat_struct = os.lstat(self.file)
+        stat_struct = self.store.lstat(self.file)
         if S_ISDIR(stat_struct.st_mode):
             return NF4DIR
         elif S_ISREG(stat_struct.st_mode):
@@ -1405,11 +1555,7 @@ class HardHandle(NFSFileHandle):
             return NF4REG
 
     def read(self, offset, count):
-        fh = open(self.file)
-        fh.seek(offset)
-        data = fh.read(count)
-        fh.close()
-        return data
+        return self.store.pread(self.file, offset, count)
 
 
     def read_dir(self):
@@ -1433,11 +1579,7 @@ class HardHandle(NFSFileHandle):
         return os.readlink(self.file)
 
     def write(self, offset, data):
-        fh = open(self.file, 'r+')
-        fh.seek(offset)
-        fh.write(data)
-        fh.close()
-        return len(data) 
+        return self.store.pwrite(self.file, offset, data)
 
 # This seems to be only used now by O_Readdir...can we get rid of it?
 ## class NFSClientHandle:
@@ -1460,9 +1602,19 @@ class HardHandle(NFSFileHandle):
 #####################################################################
 
 class DirList:
+    """Entries of a VirtualHandle directory, in the order they were added
+
+    Names are looked up through a dict.  Cookies are handed out in
+    increasing order and never reused, and removing an entry only
+    leaves a hole in self.list until enough holes build up to compact
+    it, so a cookie is found by bisection and stays valid however the
+    directory changes.  The cookie verifier thus never has to change.
+    """
     def __init__(self):
         self.verifier = packnumber(int(time.time()))
-        self.list = []
+        self.list = [] # form [DirEnt or None, ...], None where removed
+        self.cookies = [] # cookie of each slot in self.list
+        self.names = {} # form {name : DirEnt}
         self.__lastcookie = 2
 
     class DirEnt:
@@ -1472,64 +1624,68 @@ class DirList:
             self.cookie = cookie
 
     def __len__(self):
-        return len(self.list)
+        return len(self.names)
 
     def __getitem__(self, name):
         """Allows  fh = self[name]"""
-        for x in self.list:
-            if x.name == name:
-                return x.fh
-        raise KeyError, "Invalid key %s" % name
+        try:
+            return self.names[name].fh
+        except KeyError:
+            raise KeyError, "Invalid key %s" % name
 
     def __setitem__(self, name, fh):
         """Allows self[name] = fh"""
         # Remove if already in list
-        for x in self.list:
-            if x.name == name:
-                del self.list[x]
+        if name in self.names:
+            self.__remove(name)
         # Append to end of list
-        self.list.append(self.DirEnt(name, fh, self.__nextcookie()))
+        entry = self.DirEnt(name, fh, self.__nextcookie())
+        self.names[name] = entry
+        self.list.append(entry)
+        self.cookies.append(entry.cookie)
 
     def __nextcookie(self):
         self.__lastcookie += 1
         return self.__lastcookie
 
+    def __remove(self, name):
+        entry = self.names.pop(name)
+        self.list[bisect.bisect_left(self.cookies, entry.cookie)] = None
+        if 2 * len(self.names) < len(self.list):
+            # Mostly holes, squeeze them out
+            self.list = [x for x in self.list if x is not None]
+            self.cookies = [x.cookie for x in self.list]
+
     def __delitem__(self, name):
         """Allows del self[name]"""
-        for x in self.list:
-            if x.name == name:
-                self.list.remove(x)
-                return
-        raise KeyError, "Invalid key %s" % name
+        if name not in self.names:
+            raise KeyError, "Invalid key %s" % name
+        self.__remove(name)
 
     def getcookie(self, name):
-        for x in self.list:
-            if x.name == name:
-                return x.cookie
-        raise KeyError, "Invalid key %s" % name
+        try:
+            return self.names[name].cookie
+        except KeyError:
+            raise KeyError, "Invalid key %s" % name
 
     def readdir(self, cookie):
-        """Returns DirEnt list containing all entries larger than cookie"""
+        """Returns iterator over DirEnts with cookies larger than cookie"""
         if cookie < 0 or cookie > self.__lastcookie:
             raise IndexError, "Invalid cookie %i" % cookie
-        i = None
-        for x in self.list:
-            if x.cookie > cookie:
-                i = self.list.index(x)
-                break
-        if i is None:
-            return []
-        else:
-            return self.list[i:]
+        return self.__iterfrom(bisect.bisect_right(self.cookies, cookie))
+
+    def __iterfrom(self, i):
+        while i < len(self.list):
+            x = self.list[i]
+            if x is not None:
+                yield x
+            i += 1
 
     def has_key(self, name):
-        for x in self.list:
-            if x.name == name:
-                return True
-        return False
+        return name in self.names
 
     def keys(self):
-        return [x.name for x in self.list]
+        return [x.name for x in self.list if x is not None]
 
     def values(self):
-        return [x.fh for x in self.list]
+        return [x.fh for x in self.list if x is not None]
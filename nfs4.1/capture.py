@@ -0,0 +1,255 @@
+"""Flight recorder for server RPC traffic
+
+A FlightRecorder keeps the most recent calls and replies in a fixed size,
+preallocated ring buffer, evicting the oldest records as it fills.  The
+contents can be written out as pcapng, with IP/TCP/RPC headers made up
+around the recorded procedure data, so standard tools can decode it.
+
+When no recorder is installed the server does no capture work at all.
+"""
+
+from __future__ import with_statement
+import struct
+import socket
+import threading
+import time
+from collections import deque
+import logging
+
+import rpc
+from rpc.rpc_pack import RPCPacker
+from xdrdef.nfs4_const import NFS4_PROGRAM, nfs_opnum4
+
+log = logging.getLogger("nfs.server.capture")
+
+class Record(object):
+    """Bookkeeping for one call or reply held in the ring"""
+    __slots__ = ["offset", "length", "stamp", "src", "dst",
+                 "xid", "is_reply", "cred"]
+
+    def __init__(self, offset, length, stamp, src, dst, xid, is_reply, cred):
+        self.offset = offset
+        self.length = length
+        self.stamp = stamp
+        self.src = src
+        self.dst = dst
+        self.xid = xid
+        self.is_reply = is_reply
+        self.cred = cred
+
+class FlightRecorder(object):
+    """Byte-bounded ring buffer of recent RPC calls and replies
+
+    Only COMPOUNDs passing the filter are recorded.  Each filter is a set,
+    and None means do not filter on that field:
+        clients - peer hosts (as strings) or NFS clientids
+        ops - operation numbers, matching if any op in compound matches
+        xids - RPC transaction ids
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.records = deque()
+        self.head = 0 # Offset in buffer where next record will go
+        self.dropped = 0 # Records too big to ever fit
+        self.lock = threading.Lock()
+        self.set_filter()
+
+    def set_filter(self, clients=None, ops=None, xids=None):
+        self.clients = clients
+        self.ops = ops
+        self.xids = xids
+
+    def parse_filter(self, line):
+        """Set filter from a string like 'client=10.0.0.1 op=OPEN xid=7'"""
+        clients = ops = xids = None
+        names = dict((v, k) for k, v in nfs_opnum4.items())
+        for item in line.split():
+            key, value = item.split("=", 1)
+            if key == "client":
+                if clients is None:
+                    clients = set()
+                if value.isdigit():
+                    clients.add(int(value))
+                else:
+                    clients.add(value)
+            elif key == "op":
+                if ops is None:
+                    ops = set()
+                if value.isdigit():
+                    ops.add(int(value))
+                else:
+                    ops.add(names[("OP_" + value).upper()])
+            elif key == "xid":
+                if xids is None:
+                    xids = set()
+                xids.add(int(value, 0))
+            else:
+                raise ValueError("Unknown capture filter %r" % key)
+        self.set_filter(clients, ops, xids)
+
+    def match(self, peer, clientid, xid, args):
+        if self.xids is not None and xid not in self.xids:
+            return False
+        if self.clients is not None and peer[0] not in self.clients and \
+               clientid not in self.clients:
+            return False
+        if self.ops is not None:
+            for a in args.argarray:
+                if a.argop in self.ops:
+                    break
+            else:
+                return False
+        return True
+
+    def add(self, call_info, args, clientid, call, reply):
+        """Record a COMPOUND call and its reply, if it passes the filter"""
+        pipe = call_info.connection
+        try:
+            peer = pipe.getpeername()
+            local = pipe.getsockname()
+        except socket.error:
+            return
+        if not isinstance(peer, tuple):
+            # AF_UNIX, which has no IP addresses to put in the dump
+            return
+        xid = getattr(call_info, "xid", 0)
+        if not self.match(peer, clientid, xid, args):
+            return
+        stamp = time.time()
+        with self.lock:
+            self._append(call, Record(0, 0, stamp, peer, local, xid,
+                                      False, call_info.raw_cred))
+            self._append(reply, Record(0, 0, stamp, local, peer, xid,
+                                       True, None))
+
+    def _append(self, data, record):
+        """Copy data into ring, evicting the oldest records to make room"""
+        length = len(data)
+        if length > self.size:
+            self.dropped += 1
+            return
+        records = self.records
+        if self.head + length > self.size:
+            # Leave the tail end unused, and wrap around.  Anything still
+            # in the tail is older than what is at the start, so goes first.
+            while records and records[0].offset >= self.head:
+                records.popleft()
+            self.head = 0
+        end = self.head + length
+        while records and records[0].offset < end and \
+                  records[0].offset + records[0].length > self.head:
+            records.popleft()
+        self.buffer[self.head:end] = data
+        record.offset = self.head
+        record.length = length
+        records.append(record)
+        self.head = end
+
+    def snapshot(self):
+        """Return list of (record, data) currently held, oldest first"""
+        with self.lock:
+            return [(r, str(self.buffer[r.offset:r.offset + r.length]))
+                    for r in self.records]
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.head = 0
+
+    def dump(self, filename):
+        """Write current contents to filename in pcapng format"""
+        records = self.snapshot()
+        fd = open(filename, "wb")
+        try:
+            write_pcapng(fd, records)
+        finally:
+            fd.close()
+        log.info("Wrote %i records to %s" % (len(records), filename))
+        return len(records)
+
+##################################################
+# pcapng export
+##################################################
+
+LINKTYPE_RAW = 101 # Packet starts with IPv4 or IPv6 header
+MAX_SEGMENT = 65000 # Keep each fake packet within IPv4 length limit
+
+def _pad4(data):
+    return data + "\0" * (-len(data) % 4)
+
+def _block(type, body):
+    length = 12 + len(body)
+    return struct.pack("<II", type, length) + body + struct.pack("<I", length)
+
+def _rpc_header(record):
+    """Pack the RPC header that precedes the procedure data"""
+    p = RPCPacker()
+    none = rpc.opaque_auth(rpc.AUTH_NONE, "")
+    if record.is_reply:
+        areply = rpc.accepted_reply(none, rpc.rpc_reply_data(rpc.SUCCESS, ""))
+        body = rpc.rpc_msg_body(rpc.REPLY, rbody=rpc.reply_body(
+            rpc.MSG_ACCEPTED, areply=areply))
+    else:
+        cbody = rpc.call_body(2, NFS4_PROGRAM, 4, 1,
+                              record.cred, none)
+        body = rpc.rpc_msg_body(rpc.CALL, cbody=cbody)
+    p.pack_rpc_msg(rpc.rpc_msg(record.xid, body))
+    return p.get_buffer()
+
+def _checksum(data):
+    if len(data) % 2:
+        data += "\0"
+    total = sum(struct.unpack("!%iH" % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+def _ip_header(src, dst, length):
+    """Return an IPv4 or IPv6 header for TCP payload of given length"""
+    srchost = _v4_mapped(src[0])
+    dsthost = _v4_mapped(dst[0])
+    if ":" in srchost or ":" in dsthost:
+        return struct.pack("!IHBB16s16s", 6 << 28, length, 6, 64,
+                           _inet6(srchost), _inet6(dsthost))
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + length, 0, 0x4000,
+                         64, 6, 0, socket.inet_aton(srchost),
+                         socket.inet_aton(dsthost))
+    return header[:10] + struct.pack("!H", _checksum(header)) + header[12:]
+
+def _v4_mapped(host):
+    if host.startswith("::ffff:") and "." in host:
+        return host[7:]
+    return host
+
+def _inet6(host):
+    if ":" not in host:
+        host = "::ffff:" + host
+    return socket.inet_pton(socket.AF_INET6, host)
+
+def write_pcapng(fd, records):
+    """Write list of (record, data) to fd as a pcapng capture
+
+    Each record becomes one RPC record on a fake TCP stream, with sequence
+    numbers tracked per direction so that tools can reassemble them.
+    """
+    fd.write(_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+    fd.write(_block(1, struct.pack("<HHI", LINKTYPE_RAW, 0, 0)))
+    seqs = {}
+    for record, data in records:
+        payload = _rpc_header(record) + data
+        payload = struct.pack("!I", 0x80000000 | len(payload)) + payload
+        flow = (record.src, record.dst)
+        usec = int(record.stamp * 1000000)
+        for i in range(0, len(payload), MAX_SEGMENT):
+            segment = payload[i:i + MAX_SEGMENT]
+            seq = seqs.get(flow, 1)
+            ack = seqs.get((record.dst, record.src), 1)
+            seqs[flow] = (seq + len(segment)) & 0xffffffff
+            tcp = struct.pack("!HHIIBBHHH", record.src[1], record.dst[1],
+                              seq, ack, 5 << 4, 0x18, 65535, 0, 0)
+            packet = _ip_header(record.src, record.dst,
+                                len(tcp) + len(segment)) + tcp + segment
+            body = struct.pack("<IIIII", 0, usec >> 32, usec & 0xffffffff,
+                               len(packet), len(packet)) + _pad4(packet)
+            fd.write(_block(6, body))
@@ -125,8 +125,12 @@ class ServerConfig(object):
                          "Server sends debug info in reply tags"),
               ConfigLine("lease_time", 60,
                          "Server lease time in seconds"),
+              ConfigLine("recall_wait", 2,
+                         "Seconds OPEN waits for recalled delegations"),
               ConfigLine("catch_ctrlc", True,
                          "Ctrl-c sends server into interactive debugging shell"),
+              ConfigLine("metrics_sample", 0,
+                         "Time one in N compounds, 0 turns timing off"),
               ]
 
     def __init__(self):
@@ -186,4 +190,20 @@ class Actions(object):
     attrs = [ConfigLine("reboot", 0,
                         "Any write here will simulate a server reboot",
                         _action),
+             ConfigLine("lock_profile", 0,
+                        "Write 1 to record lock contention, 0 to stop, "
+                        "2 to clear.  Needs server run with --profile_locks",
+                        _action),
+             ConfigLine("lock_profile_dump", "",
+                        "Write a file name to save worst lock contention",
+                        _action),
+             ConfigLine("capture", 0,
+                        "Write bytes of traffic to keep in flight recorder, "
+                        "0 turns it off", _action),
+             ConfigLine("capture_filter", "",
+                        "Write filter like 'client=10.0.0.1 op=OPEN xid=7' "
+                        "for flight recorder", _action),
+             ConfigLine("capture_dump", "",
+                        "Write a file name to save flight recorder as pcapng",
+                        _action),
              ]
@@ -79,6 +79,13 @@ class ErrorParser():
             x.extend(self.getText(el.childNodes))
         error.addField(name, x)
 
+    def operations(self):
+        """Return set of all opnames that some error rule applies to"""
+        ops = set()
+        for err in self.errors:
+            ops.update(err.operation)
+        return ops
+
     def get_error(self, opname, arg=None, env=None):
         # opname must be e.g "create_session" or "sequence" from the caller
         for err in self.errors:
@@ -5,6 +5,7 @@ import nfs4lib
 from nfs4lib import NFS4Error
 import struct
 import logging
+import locking
 from locking import Lock, RWLock
 from cStringIO import StringIO
 import time
@@ -748,12 +749,34 @@ class ConfigObj(FSObject):
         try:
             self.configline.value = lines[0]
         except ConfigAction, e:
-            if e.name == "reboot":
-                self.fs.server.reboot()
+            try:
+                self._action(e.name, e.value)
+            except:
+                log_o.info("close() action %s failed" % e.name, exc_info=True)
         except:
             log_o.info("close() verify failed", exc_info=True)
         self._reset()
 
+    def _action(self, name, value):
+        server = self.fs.server
+        if name == "reboot":
+            server.reboot()
+        elif name == "lock_profile":
+            value = int(value)
+            if value == 2:
+                locking.profiler.reset()
+            else:
+                locking.profiler.enabled = bool(value)
+        elif name == "lock_profile_dump":
+            locking.profiler.dump(server.dump_path(value))
+        elif name == "capture":
+            server.set_capture(int(value))
+        elif name == "capture_filter":
+            if server.capture is not None:
+                server.capture.parse_filter(value)
+        elif name == "capture_dump":
+            server.dump_capture(value)
+
     def exists(self, name):
         """Returns True if name is in the dir"""
         log_o.log(5, "FSObject.exists(%r)" % name)
@@ -1,8 +1,14 @@
 from __future__ import with_statement
 import threading
+import time
+import sys
+import re
 
 
 DEBUG = False # Note this only affects locks at creation 
+PROFILE = False # Ditto, profiled locks only record when profiler.enabled
+# RWLock waits shorter than this (in seconds) do not count as contention
+CONTENDED = 0.00005
 
 class Counter(object):
     def __init__(self, first_value=0, name="counter"):
@@ -18,15 +24,136 @@ class Counter(object):
 def Lock(name=""):
     if DEBUG:
         return _DebugLock(name)
+    elif PROFILE:
+        return _ProfiledLock(name)
     else:
         return threading.Lock()
 
 def RWLock(name=""):
     if DEBUG:
         return _RWLockVerbose(name)
+    elif PROFILE:
+        return _ProfiledRWLock(name)
     else:
         return _RWLock()
 
+class _LockStats(object):
+    def __init__(self):
+        self.acquires = 0
+        self.contended = 0 # Acquires that had to wait
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.hold = 0.0
+        self.max_hold = 0.0
+
+class LockProfiler(object):
+    """Aggregate wait and hold times of profiled locks
+
+    Stats are kept per (lock name, call site of acquire), where digits in
+    lock names are collapsed so per-object locks are grouped together.
+    """
+    _digits = re.compile(r"\d+")
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stats = {} # {(name, site): _LockStats}
+
+    def _get(self, name, site):
+        key = (self._digits.sub("#", name), site)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats.setdefault(key, _LockStats())
+        return stats
+
+    def acquired(self, name, site, wait):
+        with self._lock:
+            stats = self._get(name, site)
+            stats.acquires += 1
+            if wait:
+                stats.contended += 1
+                stats.wait += wait
+                if wait > stats.max_wait:
+                    stats.max_wait = wait
+
+    def released(self, name, site, hold):
+        with self._lock:
+            stats = self._get(name, site)
+            stats.hold += hold
+            if hold > stats.max_hold:
+                stats.max_hold = hold
+
+    def report(self, count=20, key="wait"):
+        """Return text table of the count worst entries, sorted by key"""
+        with self._lock:
+            items = self.stats.items()
+        items.sort(key=lambda i: getattr(i[1], key), reverse=True)
+        out = ["%-24s %-40s %8s %8s %10s %10s %10s %10s" %
+               ("lock", "acquired at", "acquires", "waited", "wait(s)",
+                "maxwait(s)", "hold(s)", "maxhold(s)")]
+        for (name, site), st in items[:count]:
+            out.append("%-24s %-40s %8i %8i %10.6f %10.6f %10.6f %10.6f" %
+                       (name[:24], site[-40:], st.acquires, st.contended,
+                        st.wait, st.max_wait, st.hold, st.max_hold))
+        return "\n".join(out) + "\n"
+
+    def dump(self, filename, count=50):
+        fd = open(filename, "w")
+        try:
+            fd.write(self.report(count))
+        finally:
+            fd.close()
+
+profiler = LockProfiler()
+
+def _call_site(depth=2):
+    """Return file:line (function) of the code that called acquire"""
+    f = sys._getframe(depth)
+    return "%s:%i (%s)" % (f.f_code.co_filename.split("/")[-1],
+                           f.f_lineno, f.f_code.co_name)
+
+class _ProfiledLock(object):
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.name = name
+        self._since = None # Set while held, if profiling
+        self._site = None
+
+    def acquire(self, blocking=True):
+        if not profiler.enabled:
+            return self.lock.acquire(blocking)
+        site = _call_site()
+        start = time.time()
+        if self.lock.acquire(False):
+            wait = 0.0
+        elif self.lock.acquire(blocking):
+            wait = time.time() - start
+        else:
+            return False
+        self._since = time.time()
+        self._site = site
+        profiler.acquired(self.name, site, wait)
+        return True
+
+    __enter__ = acquire
+
+    def release(self):
+        since, site = self._since, self._site
+        self._since = None
+        self.lock.release()
+        if since is not None:
+            profiler.released(self.name, site, time.time() - since)
+
+    def __exit__(self, t, v, tb):
+        self.release()
+
+    def locked(self):
+        return self.lock.locked()
+
 def _collect_acq_data(suffix=""):
     """Debugging decorator for lock acquire"""
     def _deco(acquire):
@@ -161,6 +288,51 @@ class _RWLock(object):
         # Must always notify, since might be write-lockers waiting
         self._cond.notifyAll()
 
+class _ProfiledRWLock(_RWLock):
+    """_RWLock that reports to profiler, read and write holds separately"""
+    def __init__(self, name=""):
+        super(_ProfiledRWLock, self).__init__()
+        self.name = "RWLock_%s" % name
+        self._holders = {} # {thread ident: (since, site, suffix)}
+
+    def _timed(self, acquire, suffix):
+        if not profiler.enabled:
+            acquire()
+            return
+        site = _call_site(3)
+        start = time.time()
+        acquire()
+        now = time.time()
+        self._holders[threading.currentThread().ident] = (now, site, suffix)
+        wait = now - start
+        if wait < CONTENDED:
+            wait = 0.0
+        profiler.acquired(self.name + suffix, site, wait)
+
+    def _untimed(self):
+        held = self._holders.pop(threading.currentThread().ident, None)
+        if held is not None:
+            since, site, suffix = held
+            profiler.released(self.name + suffix, site, time.time() - since)
+
+    def acquire(self):
+        self._timed(super(_ProfiledRWLock, self).acquire, "(read)")
+
+    def acquire_write(self):
+        self._timed(super(_ProfiledRWLock, self).acquire_write, "(write)")
+
+    def release(self):
+        super(_ProfiledRWLock, self).release()
+        self._untimed()
+
+    def upgrade(self):
+        self._untimed()
+        self._timed(super(_ProfiledRWLock, self).upgrade, "(write)")
+
+    def downgrade(self):
+        self._untimed()
+        self._timed(super(_ProfiledRWLock, self).downgrade, "(read)")
+
 class _RWLockVerbose(_RWLock):
     """
     want: acquire() - gets read lock, which merely causes writelock to block
@@ -0,0 +1,174 @@
+"""Latency histograms and counters for the server
+
+Timings are kept in log-linear histograms, in the spirit of HdrHistogram,
+so recording is a couple of integer ops and memory does not grow with the
+number of samples.  Only one in every `sample` compounds is timed, which
+keeps the overhead small at full load.
+
+ServerMetrics.prometheus() renders everything in the Prometheus text
+exposition format, and serve_metrics() makes that available over http.
+"""
+
+from __future__ import with_statement
+import itertools
+import threading
+import BaseHTTPServer
+
+SUB_BITS = 3 # Each power of two is split into 2**SUB_BITS buckets
+SUB_COUNT = 1 << SUB_BITS
+
+class Histogram(object):
+    """Count of integer values (microseconds), bucketed to ~12% precision"""
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def index(value):
+        if value < SUB_COUNT:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return (shift + 1) * SUB_COUNT + (value >> shift) - SUB_COUNT
+
+    @staticmethod
+    def lowest(index):
+        """Smallest value that falls in bucket index"""
+        if index < SUB_COUNT:
+            return index
+        shift = index // SUB_COUNT - 1
+        return (SUB_COUNT + index % SUB_COUNT) << shift
+
+    def record(self, value):
+        # Timings are wall clock deltas, which go negative if the clock
+        # steps back
+        value = max(0, int(value))
+        i = self.index(value)
+        with self.lock:
+            counts = self.counts
+            if i >= len(counts):
+                counts.extend([0] * (i + 1 - len(counts)))
+            counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, pct):
+        """Return value at or below which pct percent of records lie"""
+        with self.lock:
+            wanted = pct / 100.0 * self.count
+            seen = 0
+            for i, c in enumerate(self.counts):
+                seen += c
+                if c and seen >= wanted:
+                    return min(self.lowest(i + 1) - 1, self.max)
+            return self.max
+
+class ServerMetrics(object):
+    """Timing and status counts for COMPOUND phases and individual ops
+
+    Phases are unpack (XDR decode of args), compound (running all ops,
+    including state locking and fs work) and pack (XDR encode of reply).
+    Per op timing covers the op_<name> method.
+    """
+    phases = ["unpack", "compound", "pack"]
+    quantiles = [50, 90, 99, 99.9]
+
+    def __init__(self):
+        self._calls = itertools.count()
+        self.lock = threading.Lock()
+        self.gauges = {} # {name: (help, value)}, not cleared by reset()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phase = dict((name, Histogram()) for name in self.phases)
+            self.ops = {} # {opname: Histogram}
+            self.status = {} # {(opname, statusname): count}
+
+    def sampled(self, sample):
+        """Returns True for one in every sample calls"""
+        return self._calls.next() % sample == 0
+
+    def time_phase(self, name, seconds):
+        self.phase[name].record(seconds * 1000000)
+
+    def time_op(self, opname, seconds):
+        hist = self.ops.get(opname)
+        if hist is None:
+            with self.lock:
+                hist = self.ops.setdefault(opname, Histogram())
+        hist.record(seconds * 1000000)
+
+    def count_status(self, opname, status):
+        """Count an op result, done for every op, not just sampled ones"""
+        key = (opname, status)
+        with self.lock:
+            self.status[key] = self.status.get(key, 0) + 1
+
+    def set_gauge(self, name, help, value):
+        with self.lock:
+            self.gauges[name] = (help, value)
+
+    def prometheus(self):
+        """Return metrics in the Prometheus text exposition format"""
+        out = []
+        def summary(name, help, hists, label):
+            out.append("# HELP %s %s" % (name, help))
+            out.append("# TYPE %s summary" % name)
+            for key in sorted(hists):
+                h = hists[key]
+                for q in self.quantiles:
+                    out.append('%s{%s="%s",quantile="%s"} %.6f' %
+                               (name, label, key, q / 100.0,
+                                h.percentile(q) / 1e6))
+                out.append('%s_sum{%s="%s"} %.6f' %
+                           (name, label, key, h.total / 1e6))
+                out.append('%s_count{%s="%s"} %i' %
+                           (name, label, key, h.count))
+        summary("nfs_compound_phase_seconds",
+                "Time spent in each phase of sampled COMPOUNDs",
+                self.phase, "phase")
+        summary("nfs_op_seconds", "Time spent in each op of sampled COMPOUNDs",
+                dict(self.ops), "op")
+        out.append("# HELP nfs_op_status_total Op results by status")
+        out.append("# TYPE nfs_op_status_total counter")
+        with self.lock:
+            status = sorted(self.status.items())
+        for (opname, stat), count in status:
+            out.append('nfs_op_status_total{op="%s",status="%s"} %i' %
+                       (opname, stat, count))
+        with self.lock:
+            gauges = sorted(self.gauges.items())
+        for name, (help, value) in gauges:
+            out.append("# HELP %s %s" % (name, help))
+            out.append("# TYPE %s gauge" % name)
+            out.append("%s %.6f" % (name, value))
+        return "\n".join(out) + "\n"
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(metrics, port, interface="127.0.0.1"):
+    """Serve metrics at http://interface:port/metrics from a thread"""
+    httpd = BaseHTTPServer.HTTPServer((interface, port), _Handler)
+    httpd.metrics = metrics
+    t = threading.Thread(target=httpd.serve_forever, name="Metrics")
+    t.setDaemon(True)
+    t.start()
+    return httpd
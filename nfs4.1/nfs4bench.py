@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+# nfs4bench.py - nfsv4.1 server load generator and benchmark
+#
+# Requires python 2.6
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import use_local # HACK so don't have to rebuild constantly
+import sys
+if sys.hexversion < 0x02060000:
+    print "Requires python 2.6 or higher"
+    sys.exit(1)
+import os
+import time
+import json
+import logging
+import random
+import socket
+import threading
+import Queue
+from optparse import OptionParser, OptionGroup, IndentedHelpFormatter
+
+import rpc
+import nfs4lib
+import nfs4client
+from xdrdef.nfs4_const import *
+from xdrdef.nfs4_type import *
+import nfs_ops
+op = nfs_ops.NFS4ops()
+Slot = nfs_ops.Slot
+
+VERSION = "0.1"
+
+current_stateid = stateid4(1, '\0' * 12)
+
+##################################################
+# Workloads
+##################################################
+
+class Workload(object):
+    """Base class for a benchmark workload.
+
+    A workload gets a private directory on the server, given as the fh
+    dirfh.  setup() prepares it using a synchronous session.  Each
+    iteration then submits ops(i), and on completion followup(i, res)
+    may return further ops to send as part of the same iteration, which
+    allows chains such as LOCK followed by LOCKU.  Latency is measured
+    over the whole chain.
+    """
+    name = None
+    description = ""
+
+    def __init__(self, opts, index):
+        self.opts = opts
+        self.prefix = "%s%i" % (self.name, index) # Unique per client
+
+    def setup(self, sess, dirfh):
+        self.dirfh = dirfh
+
+    def ops(self, i):
+        raise NotImplementedError
+
+    def followup(self, i, res):
+        return None
+
+    def teardown(self, sess):
+        pass
+
+class CreateRemove(Workload):
+    name = "create"
+    description = "OPEN(CREATE)/CLOSE then REMOVE of a small file"
+
+    def setup(self, sess, dirfh):
+        Workload.setup(self, sess, dirfh)
+        self.owner = "bench_%s" % self.prefix
+
+    def ops(self, i):
+        name = "%s_%i" % (self.prefix, i)
+        how = openflag4(OPEN4_CREATE, createhow4(UNCHECKED4,
+                                                 {FATTR4_MODE: 0644}))
+        return [op.putfh(self.dirfh), op.savefh(),
+                op.open(0, OPEN4_SHARE_ACCESS_BOTH |
+                        OPEN4_SHARE_ACCESS_WANT_NO_DELEG,
+                        OPEN4_SHARE_DENY_NONE, open_owner4(0, self.owner),
+                        how, open_claim4(CLAIM_NULL, name)),
+                op.close(0, current_stateid),
+                op.restorefh(), op.remove(name)]
+
+class StatStorm(Workload):
+    name = "stat"
+    description = "GETATTR of a single file"
+    attrs = nfs4lib.list2bitmap([FATTR4_TYPE, FATTR4_CHANGE, FATTR4_SIZE,
+                                 FATTR4_FILEID, FATTR4_MODE,
+                                 FATTR4_NUMLINKS, FATTR4_OWNER,
+                                 FATTR4_OWNER_GROUP, FATTR4_TIME_MODIFY])
+
+    def setup(self, sess, dirfh):
+        Workload.setup(self, sess, dirfh)
+        self.fh, stateid = _create(sess, dirfh, self.prefix)
+        _close(sess, self.fh, stateid)
+        self.template = op.template([op.putfh(self.fh),
+                                     op.getattr(self.attrs)])
+
+    def ops(self, i):
+        return self.template.fill()
+
+class _FileIO(Workload):
+    """Common code for READ and WRITE workloads on one open file"""
+    sequential = True
+
+    def setup(self, sess, dirfh):
+        Workload.setup(self, sess, dirfh)
+        self.iosize = self.opts.iosize
+        self.blocks = max(1, self.opts.filesize // self.iosize)
+        self.fh, self.stateid = _create(sess, dirfh, self.prefix)
+        data = "\x5a" * self.iosize
+        for b in xrange(self.blocks):
+            res = sess.compound([op.putfh(self.fh),
+                                 op.write(self.stateid, b * self.iosize,
+                                          UNSTABLE4, data)])
+            nfs4lib.check(res)
+        nfs4lib.check(sess.compound([op.putfh(self.fh), op.commit(0, 0)]))
+
+    def offset(self, i):
+        if self.sequential:
+            return (i % self.blocks) * self.iosize
+        return random.randrange(self.blocks) * self.iosize
+
+    def teardown(self, sess):
+        _close(sess, self.fh, self.stateid)
+
+class SeqRead(_FileIO):
+    name = "seqread"
+    description = "Sequential READ of iosize chunks"
+
+    def setup(self, sess, dirfh):
+        _FileIO.setup(self, sess, dirfh)
+        self.template = op.template([op.putfh(self.fh),
+                                     op.read(self.stateid, Slot("offset"),
+                                             self.iosize)])
+
+    def ops(self, i):
+        return self.template.fill(offset=self.offset(i))
+
+class RandRead(SeqRead):
+    name = "randread"
+    description = "Random READ of iosize chunks"
+    sequential = False
+
+class SeqWrite(_FileIO):
+    name = "seqwrite"
+    description = "Sequential UNSTABLE WRITE of iosize chunks"
+
+    def setup(self, sess, dirfh):
+        _FileIO.setup(self, sess, dirfh)
+        self.data = "\xa5" * self.iosize
+        self.template = op.template([op.putfh(self.fh),
+                                     op.write(self.stateid, Slot("offset"),
+                                              UNSTABLE4, self.data)])
+
+    def ops(self, i):
+        return self.template.fill(offset=self.offset(i))
+
+class RandWrite(SeqWrite):
+    name = "randwrite"
+    description = "Random UNSTABLE WRITE of iosize chunks"
+    sequential = False
+
+class LockContention(Workload):
+    name = "lock"
+    description = "Byte-range LOCK/LOCKU on one range, all clients contend"
+
+    def setup(self, sess, dirfh):
+        Workload.setup(self, sess, dirfh)
+        # Every client opens the same file, so that they contend
+        self.fh, self.stateid = _create(sess, dirfh, "lockfile")
+        # One lock owner per iteration in flight, so that a client's own
+        # iterations don't trip over each other.  Owners are reused, so
+        # server state does not grow as the run goes on.
+        self.owners = Queue.Queue()
+        self.inflight = {} # {iteration: owner}
+        for k in xrange(self.opts.depth):
+            self.owners.put(self._new_owner(sess, k))
+
+    def _new_owner(self, sess, k):
+        """Create lock owner k, returning (lock stateid, LOCK template)
+
+        The owner is created by a READ lock beyond the contended range,
+        which no other client conflicts with.
+        """
+        owner = open_to_lock_owner4(0, self.stateid, 0,
+                                    lock_owner4(0, "bench_%s_%i" %
+                                                (self.prefix, k)))
+        res = sess.compound([op.putfh(self.fh),
+                             op.lock(READ_LT, False, 4096 + k, 1,
+                                     locker4(open_owner=owner,
+                                             new_lock_owner=True))])
+        nfs4lib.check(res, msg="Creating lock owner")
+        stateid = res.resarray[-1].lock_stateid
+        res = sess.compound([op.putfh(self.fh),
+                             op.locku(READ_LT, 0, stateid, 4096 + k, 1)])
+        nfs4lib.check(res, msg="Unlocking lock owner setup range")
+        # A seqid of 0 means whatever the stateid's current seqid is
+        stateid = stateid4(0, stateid.other)
+        owner = exist_lock_owner4(stateid, 0)
+        template = op.template([op.putfh(self.fh),
+                                op.lock(WRITE_LT, False, 0, 4096,
+                                        locker4(lock_owner=owner,
+                                                new_lock_owner=False))])
+        return stateid, template
+
+    def ops(self, i):
+        # There is always one free, since at most opts.depth iterations
+        # are in flight
+        owner = self.inflight[i] = self.owners.get_nowait()
+        return owner[1].fill()
+
+    def followup(self, i, res):
+        if res.status == NFS4_OK and res.resarray[-1].resop == OP_LOCK:
+            return [op.putfh(self.fh),
+                    op.locku(WRITE_LT, 0, self.inflight[i][0], 0, 4096)]
+        # Either LOCKU is done, or LOCK failed.  NFS4ERR_DENIED is the
+        # expected result of contention.
+        self.owners.put(self.inflight.pop(i))
+        return None
+
+    def teardown(self, sess):
+        _close(sess, self.fh, self.stateid)
+
+class ReadDir(Workload):
+    name = "readdir"
+    description = "Full READDIR listing of a directory with dirsize entries"
+
+    def setup(self, sess, dirfh):
+        Workload.setup(self, sess, dirfh)
+        res = sess.compound([op.putfh(dirfh), op.create(createtype4(NF4DIR),
+                                                         self.prefix, {}),
+                             op.getfh()])
+        nfs4lib.check(res)
+        self.fh = res.resarray[-1].object
+        pipe = sess.pipeline()
+        futures = pipe.map([[op.putfh(self.fh),
+                             op.create(createtype4(NF4DIR), "e%i" % j, {})]
+                            for j in xrange(self.opts.dirsize)])
+        for res in pipe.wait(futures):
+            nfs4lib.check(res)
+        pipe.close()
+
+    def _readdir(self, cookie, verf):
+        return [op.putfh(self.fh),
+                op.readdir(cookie, verf, 8192, 8192,
+                           nfs4lib.list2bitmap([FATTR4_TYPE, FATTR4_FILEID]))]
+
+    def ops(self, i):
+        return self._readdir(0, "\0" * 8)
+
+    def followup(self, i, res):
+        if res.status != NFS4_OK:
+            return None
+        reply = res.resarray[-1].reply
+        if reply.eof or not reply.entries:
+            return None
+        return self._readdir(reply.entries[-1].cookie,
+                             res.resarray[-1].cookieverf)
+
+workloads = dict((w.name, w) for w in [CreateRemove, StatStorm,
+                                       SeqRead, RandRead, SeqWrite, RandWrite,
+                                       LockContention, ReadDir])
+default_mix = ["create", "stat", "seqread", "randread", "seqwrite",
+               "randwrite", "lock", "readdir"]
+
+def _create(sess, dirfh, name):
+    """Create (or truncate) a file, returning fh and open stateid"""
+    how = openflag4(OPEN4_CREATE, createhow4(UNCHECKED4, {FATTR4_SIZE: 0}))
+    res = sess.compound([op.putfh(dirfh),
+                         op.open(0, OPEN4_SHARE_ACCESS_BOTH |
+                                 OPEN4_SHARE_ACCESS_WANT_NO_DELEG,
+                                 OPEN4_SHARE_DENY_NONE,
+                                 open_owner4(0, "bench_%s" % name), how,
+                                 open_claim4(CLAIM_NULL, name)),
+                         op.getfh()])
+    nfs4lib.check(res, msg="Creating file %s" % name)
+    return res.resarray[-1].object, res.resarray[-2].stateid
+
+def _close(sess, fh, stateid):
+    nfs4lib.check(sess.compound([op.putfh(fh), op.close(0, stateid)]))
+
+##################################################
+# Statistics
+##################################################
+
+class Stats(object):
+    """Collect per-iteration latencies and status counts"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.status = {}
+        self.errors = 0
+        self.compounds = 0
+
+    def add(self, latency, status, compounds):
+        with self.lock:
+            self.latencies.append(latency)
+            name = nfsstat4.get(status, str(status))
+            self.status[name] = self.status.get(name, 0) + 1
+            self.compounds += compounds
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        lat = sorted(self.latencies)
+        count = len(lat)
+        out = {"iterations": count,
+               "compounds": self.compounds,
+               "errors": self.errors,
+               "elapsed": elapsed,
+               "iterations_per_sec": (count / elapsed if elapsed else 0.0),
+               "compounds_per_sec": (self.compounds / elapsed
+                                     if elapsed else 0.0),
+               "status": self.status,
+               }
+        if count:
+            out["latency_ms"] = {
+                "min": lat[0] * 1000,
+                "mean": sum(lat) / count * 1000,
+                "p50": percentile(lat, 50) * 1000,
+                "p90": percentile(lat, 90) * 1000,
+                "p99": percentile(lat, 99) * 1000,
+                "p999": percentile(lat, 99.9) * 1000,
+                "max": lat[-1] * 1000,
+                }
+        return out
+
+def percentile(sorted_list, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_list:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(sorted_list) + 0.5)) - 1
+    return sorted_list[max(0, min(rank, len(sorted_list) - 1))]
+
+##################################################
+# Driver
+##################################################
+
+class BenchClient(object):
+    """One client id and session, driving a closed loop of iterations"""
+    def __init__(self, c, opts, index, cred):
+        self.opts = opts
+        name = "nfs4bench_%i_%i_%i" % (os.getpid(), int(time.time()), index)
+        self.client = c.new_client(name, cred=cred)
+        attrs = channel_attrs4(0, opts.iosize + 4096, opts.iosize + 4096,
+                               4096, 128, opts.slots, [])
+        self.sess = self.client.create_session(fore_attrs=attrs)
+        self.sess.compound([op.reclaim_complete(FALSE)])
+
+    def run(self, workload, seconds, stats):
+        """Keep opts.depth iterations in flight for given seconds"""
+        pipe = self.sess.pipeline(self.opts.depth)
+        window = threading.Semaphore(self.opts.depth)
+        counter = [0]
+        def submit(i, ops, start, compounds):
+            f = pipe.submit(ops)
+            f.add_done_callback(lambda f: done(f, i, start, compounds))
+        def done(f, i, start, compounds):
+            try:
+                res = f.result()
+                more = workload.followup(i, res)
+            except Exception:
+                stats.add_error()
+                window.release()
+                return
+            if more is not None:
+                submit(i, more, start, compounds + 1)
+                return
+            stats.add(time.time() - start, res.status, compounds)
+            window.release()
+        end = time.time() + seconds
+        while time.time() < end:
+            window.acquire()
+            i = counter[0]
+            counter[0] += 1
+            submit(i, workload.ops(i), time.time(), 1)
+        # Drain iterations still in flight
+        for i in xrange(self.opts.depth):
+            window.acquire()
+        pipe.close()
+
+def run_workload(name, clients, opts, dirfh):
+    """Run named workload on all clients, returning summary dict"""
+    loads = []
+    for i, bc in enumerate(clients):
+        w = workloads[name](opts, i)
+        w.setup(bc.sess, dirfh)
+        loads.append(w)
+    for phase, seconds in (("warmup", opts.warmup),
+                           ("measure", opts.duration)):
+        if not seconds:
+            continue
+        stats = Stats()
+        threads = [threading.Thread(target=bc.run, args=(w, seconds, stats))
+                   for bc, w in zip(clients, loads)]
+        start = time.time()
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        if phase == "measure":
+            summary = stats.summary(elapsed)
+    for bc, w in zip(clients, loads):
+        w.teardown(bc.sess)
+    return summary
+
+def lookup_dir(sess, path):
+    res = sess.compound(nfs4lib.use_obj(path) + [op.getfh()])
+    nfs4lib.check(res, msg="LOOKUP of /%s" % '/'.join(path))
+    return res.resarray[-1].object
+
+def make_bench_dir(sess, path):
+    """Create a fresh, uniquely named directory under path"""
+    name = "nfs4bench_%i_%i" % (os.getpid(), int(time.time()))
+    res = sess.compound(nfs4lib.use_obj(path) +
+                        [op.create(createtype4(NF4DIR), name,
+                                   {FATTR4_MODE: 0777}),
+                         op.getfh()])
+    nfs4lib.check(res, msg="Creating bench directory %s" % name)
+    return res.resarray[-1].object
+
+def start_selftest_server(transport="tcp"):
+    """Start an in-process NFS4Server exporting a StubFS_Mem at /bench
+
+    The server also listens on the given transport.  For "unix" and
+    "shm" the host returned is the socket path.
+    """
+    import nfs4server
+    from fs import StubFS_Mem
+    logging.getLogger("nfs.server").setLevel(logging.WARN)
+    logging.getLogger("rpc").setLevel(logging.WARN)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((rpc.LOOPBACK, 0))
+    port = s.getsockname()[1]
+    s.close()
+    host = rpc.LOOPBACK
+    kwargs = {}
+    if transport == "udp":
+        kwargs["udp"] = True
+    elif transport in ("unix", "shm"):
+        host = kwargs[transport] = "/tmp/nfs4bench-%i.sock" % os.getpid()
+    server = nfs4server.NFS4Server(port=port, interface=rpc.LOOPBACK,
+                                   **kwargs)
+    server.mount(StubFS_Mem(2), path="/bench")
+    t = threading.Thread(target=server.start, name="SelftestServer")
+    t.setDaemon(True)
+    t.start()
+    return server, host, port, ["bench"]
+
+def scan_options(p):
+    """Parse command line options"""
+    p.add_option("--selftest", action="store_true", default=False,
+                 help="Run against an in-process server on StubFS_Mem")
+    p.add_option("--transport", default=None, choices=rpc.TRANSPORTS,
+                 help="With --selftest, connect over tcp, unix, udp or shm "
+                 "[tcp].  Otherwise taken from the url scheme, "
+                 "e.g. nfs+unix://%2Ftmp%2Fnfs.sock/path")
+    p.add_option("--workload", "-w", action="append", default=[],
+                 metavar="NAME", help="Workload to run, may be repeated "
+                 "[%s]" % ','.join(default_mix))
+    p.add_option("--showworkloads", action="store_true", default=False,
+                 help="Print a list of all workloads and exit")
+    p.add_option("--json", default=None, metavar="FILE",
+                 help="Store results in FILE in json format [%default]")
+
+    g = OptionGroup(p, "Load options",
+                    "These options determine how hard the server is driven.")
+    g.add_option("--clients", type="int", default=1,
+                 help="Number of client ids, each with one session [%default]")
+    g.add_option("--depth", type="int", default=4,
+                 help="Iterations in flight per session [%default]")
+    g.add_option("--slots", type="int", default=8,
+                 help="ca_maxrequests requested for each session [%default]")
+    g.add_option("--duration", type="float", default=10.0,
+                 help="Seconds to measure each workload [%default]")
+    g.add_option("--warmup", type="float", default=2.0,
+                 help="Seconds to run each workload before measuring "
+                 "[%default]")
+    p.add_option_group(g)
+
+    g = OptionGroup(p, "Workload options",
+                    "These options set the size of the objects used.")
+    g.add_option("--filesize", type="int", default=1024*1024,
+                 help="Size of file used by I/O workloads [%default]")
+    g.add_option("--iosize", type="int", default=4096,
+                 help="Size of each READ or WRITE [%default]")
+    g.add_option("--dirsize", type="int", default=1000,
+                 help="Entries in directory used by readdir [%default]")
+    p.add_option_group(g)
+
+    g = OptionGroup(p, "Security flavor options",
+                    "These options affect the AUTH_SYS credential used.")
+    g.add_option("--uid", default=0, type='int',
+                 help="uid for auth_sys [%default]")
+    g.add_option("--gid", default=0, type='int',
+                 help="gid for auth_sys [%default]")
+    g.add_option("--machinename", default=socket.gethostname(),
+                 metavar="HOST", help="Machine name to use for auth_sys")
+    p.add_option_group(g)
+    return p.parse_args()
+
+def main():
+    p = OptionParser("%prog SERVER:/PATH [options]\n"
+                     "       %prog --selftest [options]",
+                     version="%prog " + VERSION,
+                     formatter=IndentedHelpFormatter(2, 25))
+    opts, args = scan_options(p)
+
+    if opts.showworkloads:
+        for name in default_mix:
+            print "%-10s %s" % (name, workloads[name].description)
+        sys.exit(0)
+
+    mix = opts.workload or default_mix
+    for name in mix:
+        if name not in workloads:
+            p.error("Unknown workload: %s" % name)
+    if opts.depth < 1 or opts.clients < 1:
+        p.error("--depth and --clients must be positive")
+    if opts.duration <= 0 or opts.warmup < 0:
+        p.error("--duration must be positive, and --warmup not negative")
+
+    if opts.selftest:
+        if args:
+            p.error("Can not give a server with --selftest")
+        transport = opts.transport or "tcp"
+        server, host, port, path = start_selftest_server(transport)
+    else:
+        if not args:
+            p.error("Need a server")
+        if opts.transport is not None:
+            p.error("--transport only applies to --selftest")
+        url = args.pop(0)
+        server_list, path = nfs4lib.parse_nfs_url(url)
+        transport = nfs4lib.nfs_url_transport(url)
+        if not server_list:
+            p.error("Not a valid server name")
+        host, port = server_list[0]
+
+    c = nfs4client.NFS4Client(host, port, transport=transport)
+    cred = rpc.security.instance(rpc.AUTH_SYS).init_cred(
+        uid=opts.uid, gid=opts.gid, name=opts.machinename)
+    c.set_cred(cred)
+    clients = [BenchClient(c, opts, i, cred) for i in xrange(opts.clients)]
+    sess = clients[0].sess
+    dirfh = make_bench_dir(sess, path)
+
+    results = {"config": {"server": "%s:%s" % (host, port),
+                          "transport": transport,
+                          "path": '/' + '/'.join(path),
+                          "selftest": opts.selftest,
+                          "clients": opts.clients,
+                          "depth": opts.depth,
+                          "slots": opts.slots,
+                          "slots_granted":
+                              len(sess.fore_channel.slots),
+                          "duration": opts.duration,
+                          "warmup": opts.warmup,
+                          "filesize": opts.filesize,
+                          "iosize": opts.iosize,
+                          "dirsize": opts.dirsize,
+                          "start_time": time.time(),
+                          },
+               "workloads": {},
+               }
+    for name in mix:
+        print "Running %s..." % name,
+        sys.stdout.flush()
+        summary = run_workload(name, clients, opts, dirfh)
+        results["workloads"][name] = summary
+        lat = summary.get("latency_ms", {})
+        print "%.1f iter/s, p50 %.2fms, p99 %.2fms, %i errors" % \
+              (summary["iterations_per_sec"], lat.get("p50", 0),
+               lat.get("p99", 0), summary["errors"])
+
+    if opts.json is not None:
+        fd = open(opts.json, 'w')
+        try:
+            json.dump(results, fd, indent=2, sort_keys=True)
+        finally:
+            fd.close()
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ import nfs_ops
 op = nfs_ops.NFS4ops()
 import time, struct
 import threading
+import Queue
 import hmac
 import inspect
 from os.path import basename
@@ -27,8 +28,9 @@ op4 = nfs_ops.NFS4ops()
 SHOW_TRAFFIC = 0
 
 class NFS4Client(rpc.Client, rpc.Server):
-    def __init__(self, host='localhost', port=2049, minorversion=1, ctrl_proc=16, summary=None):
+    def __init__(self, host='localhost', port=2049, minorversion=1, ctrl_proc=16, summary=None, transport="tcp"):
         rpc.Client.__init__(self, 100003, 4)
+        self.transport = transport # Used by every connect() we make
         self.prog = 0x40000000
         self.versions = [1] # List of supported versions of prog
 
@@ -453,17 +455,29 @@ class SendChannel(object):
         s.maxoperations = attrs.ca_maxoperations
         s.maxrequests = attrs.ca_maxrequests
         s.slots = [Slot(i) for i in xrange(s.maxrequests)]
+        # Highest slotid the server currently wants us to use, see 2.10.6.1
+        s.target_highest_slotid = s.maxrequests - 1
 
     def choose_slot(self):
         self.lock.acquire()
         try:
-            for slot in self.slots:
+            for slot in self.slots[:self.target_highest_slotid + 1]:
                 if not slot.inuse:
                     slot.inuse = True
                     return slot
             raise RuntimeError("Out of slots")
         finally:
             self.lock.release()
+
+    def set_target(self, target):
+        """Shrink (or regrow) usable slot table as directed by server"""
+        with self.lock:
+            self.target_highest_slotid = max(0, min(target,
+                                                    len(self.slots) - 1))
+
+    def window(self):
+        """Number of slots we are currently allowed to have in use"""
+        return self.target_highest_slotid + 1
                 
 class SessionRecord(object):
     def __init__(self, csr, client):
@@ -551,6 +565,8 @@ class SessionRecord(object):
     def update_seq_state(self, res, slot):
         seq_res = res.resarray[0]
         slot.finish_call(seq_res)
+        if seq_res.sr_status == NFS4_OK:
+            self.fore_channel.set_target(seq_res.sr_target_highest_slotid)
         return res
 
     def remove_seq_op(self, res):
@@ -559,6 +575,460 @@ class SessionRecord(object):
             res.resarray = res.resarray[1:]
         return res
 
+    def pipeline(self, depth=None, **kwargs):
+        """Return a CompoundPipeline issuing compounds over this session"""
+        return CompoundPipeline(self, depth, **kwargs)
+
+class CompoundFuture(rpc.DeferredData):
+    """The eventual result of a compound sent through a CompoundPipeline"""
+    def __init__(self, ops, kwargs):
+        rpc.DeferredData.__init__(self, (ops, kwargs))
+        self.retries = 0 # Number of times NFS4ERR_DELAY caused a resend
+        self._callbacks = []
+        self._cb_lock = threading.Lock()
+
+    def done(self):
+        return self._filled.isSet()
+
+    def result(self, timeout=None):
+        """Wait for and return the COMPOUND4res, raising any error seen"""
+        self.wait(timeout)
+        return self.data
+
+    def add_done_callback(self, funct):
+        """Call funct(future) once result is available"""
+        with self._cb_lock:
+            if not self.done():
+                self._callbacks.append(funct)
+                return
+        funct(self)
+
+    def fill(self, data=None, exception=None):
+        rpc.DeferredData.fill(self, data, exception)
+        with self._cb_lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for funct in callbacks:
+            try:
+                funct(self)
+            except Exception:
+                log_cb.exception("Ignoring error in future callback")
+
+class CompoundPipeline(object):
+    """Keep a window of compounds outstanding across a session's slots.
+
+    Each submit() returns a CompoundFuture immediately.  Up to depth
+    requests (further limited by the server's sr_target_highest_slotid)
+    are on the wire at once.  A compound answered with NFS4ERR_DELAY is
+    resent after an exponential backoff, without holding a slot or a
+    worker while it waits.
+    """
+    def __init__(self, session, depth=None, max_retries=10,
+                 delay_time=0.1, max_delay=5.0):
+        self.session = session
+        self.channel = session.fore_channel
+        if depth is None:
+            depth = len(self.channel.slots)
+        self.depth = depth
+        self.max_retries = max_retries
+        self.delay_time = delay_time # Initial backoff after NFS4ERR_DELAY
+        self.max_delay = max_delay
+        self._queue = Queue.Queue()
+        self._cond = threading.Condition()
+        self._outstanding = 0 # Number of compounds on the wire
+        self._pending = 0 # Number of submitted compounds not yet finished
+        self._closed = False
+        self._workers = []
+        for i in xrange(depth):
+            t = threading.Thread(target=self._worker,
+                                 name="CompoundPipeline-%i" % i)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, ops, **kwargs):
+        """Queue a compound, taking the same kwargs as SessionRecord.compound
+
+        Returns a CompoundFuture.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Pipeline is closed")
+            self._pending += 1
+        future = CompoundFuture(ops, kwargs)
+        self._queue.put(future)
+        return future
+
+    def map(self, ops_list, **kwargs):
+        """Submit each list of ops, returning the list of futures"""
+        return [self.submit(ops, **kwargs) for ops in ops_list]
+
+    def wait(self, futures, timeout=None):
+        """Return list of results for futures, in order"""
+        return [f.result(timeout) for f in futures]
+
+    def close(self):
+        """Stop workers once every submitted compound has completed"""
+        with self._cond:
+            self._closed = True
+            while self._pending:
+                self._cond.wait()
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+
+    def _get_slot(self):
+        """Wait until window allows another outstanding call"""
+        with self._cond:
+            while self._outstanding >= min(self.depth, self.channel.window()):
+                self._cond.wait()
+            self._outstanding += 1
+
+    def _put_slot(self):
+        with self._cond:
+            self._outstanding -= 1
+            # The window may have grown as well as shrunk
+            self._cond.notifyAll()
+
+    def _finish(self, future, res=None, exception=None):
+        future.fill(res, exception)
+        with self._cond:
+            self._pending -= 1
+            self._cond.notifyAll()
+
+    def _worker(self):
+        while True:
+            future = self._queue.get()
+            if future is None:
+                return
+            ops, kwargs = future.msg
+            kwargs = dict(kwargs)
+            handle_state_errors = kwargs.pop("handle_state_errors", True)
+            self._get_slot()
+            try:
+                slot = self.session.compound_async(ops, **kwargs)
+                res = self.session.listen(slot, pipe=kwargs.get("pipe"))
+            except Exception, e:
+                self._put_slot()
+                self._finish(future, exception=e)
+                continue
+            self._put_slot()
+            if res.status == NFS4ERR_DELAY and handle_state_errors and \
+                   future.retries < self.max_retries:
+                self._retry(future)
+            else:
+                self._finish(future, res)
+
+    def _retry(self, future):
+        """Resend future after a backoff, without blocking the worker"""
+        delay = min(self.delay_time * (2 ** future.retries), self.max_delay)
+        future.retries += 1
+        timer = threading.Timer(delay, self._queue.put, (future,))
+        timer.setDaemon(True)
+        timer.start()
+
+class CachedFile(object):
+    """What DelegationCache knows about one open file"""
+    def __init__(self, fh, stateid, deleg):
+        self.fh = fh
+        self.stateid = stateid # Open stateid, used for all I/O
+        self.deleg = deleg # open_delegation4 from OPEN
+        self.attrs = {} # {FATTR4_*: value}, only kept while delegated
+        self.blocks = {} # {index: data}, only kept while delegated
+        self.dirty = set() # Indices of blocks not yet written to server
+        self.names = [] # (dirfh, name) pairs that LOOKUP to this file
+        self.lock = threading.Lock()
+
+    def delegated(self):
+        return self.deleg.delegation_type in (OPEN_DELEGATE_READ,
+                                              OPEN_DELEGATE_WRITE)
+
+    def write_delegated(self):
+        return self.deleg.delegation_type == OPEN_DELEGATE_WRITE
+
+    def deleg_stateid(self):
+        if self.deleg.delegation_type == OPEN_DELEGATE_READ:
+            return self.deleg.read.stateid
+        else:
+            return self.deleg.write.stateid
+
+class DelegationCache(object):
+    """Client side cache of attributes, names and data for delegated files.
+
+    Files are opened through open(), asking for a delegation.  While one
+    is held, getattr(), lookup() and read() are answered locally where
+    possible, and under a write delegation write() just dirties the
+    cached blocks.  On CB_RECALL (or close) dirty data is written back,
+    and the delegation returned.  Files without a delegation are passed
+    straight through to the server.
+
+    The cache takes over the session client's CB_RECALL pre-hook.
+    Counters in self.stats show how often the server was avoided.
+    """
+    blocksize = 65536
+    cached_attrs = [FATTR4_TYPE, FATTR4_CHANGE, FATTR4_SIZE, FATTR4_FILEID,
+                    FATTR4_MODE, FATTR4_NUMLINKS, FATTR4_OWNER,
+                    FATTR4_OWNER_GROUP, FATTR4_TIME_ACCESS,
+                    FATTR4_TIME_MODIFY]
+
+    def __init__(self, session, owner="DelegationCache"):
+        self.session = session
+        self.owner = open_owner4(0, owner)
+        self.files = {} # {fh: CachedFile}
+        self.names = {} # {(dirfh, name): fh}
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, misses=0, recalls=0, flushes=0)
+        channel = session.fore_channel
+        # Leave room for the RPC and COMPOUND around READ and WRITE data
+        self.iosize = min(channel.maxrequestsize,
+                          channel.maxresponsesize) - 1024
+        session.client.cb_pre_hook(OP_CB_RECALL, self._recall)
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def open(self, dirfh, name, access=OPEN4_SHARE_ACCESS_READ, create=False,
+             attrs={FATTR4_MODE: 0644}):
+        """OPEN dirfh/name asking for a delegation, return the filehandle"""
+        if access & OPEN4_SHARE_ACCESS_WRITE:
+            want = OPEN4_SHARE_ACCESS_WANT_WRITE_DELEG
+        else:
+            want = OPEN4_SHARE_ACCESS_WANT_READ_DELEG
+        if create:
+            how = openflag4(OPEN4_CREATE, createhow4(UNCHECKED4, attrs))
+        else:
+            how = openflag4(OPEN4_NOCREATE)
+        claim = open_claim4(CLAIM_NULL, name)
+        res = self.session.compound(
+            [op4.putfh(dirfh),
+             op4.open(0, access | want, OPEN4_SHARE_DENY_NONE,
+                      self.owner, how, claim),
+             op4.getfh(),
+             op4.getattr(nfs4lib.list2bitmap(self.cached_attrs))])
+        nfs4lib.check(res)
+        fh = res.resarray[-2].object
+        file = CachedFile(fh, res.resarray[-3].stateid,
+                          res.resarray[-3].delegation)
+        with self.lock:
+            old = self.files.get(fh)
+        if old is not None:
+            if old.delegated() and file.delegated() and \
+                   old.deleg_stateid().other == file.deleg_stateid().other:
+                # Server handed back the delegation we already hold
+                with old.lock:
+                    file.blocks, file.dirty = old.blocks, old.dirty
+                    file.names = old.names
+            else:
+                self._return(old)
+        with self.lock:
+            self.files[fh] = file
+            if file.delegated():
+                file.attrs = res.resarray[-1].obj_attributes
+                file.names.append((dirfh, name))
+                self.names[(dirfh, name)] = fh
+        return fh
+
+    def close(self, fh):
+        """Flush and return any delegation, then CLOSE"""
+        with self.lock:
+            file = self.files.pop(fh)
+        self._return(file)
+        res = self.session.compound([op4.putfh(fh),
+                                     op4.close(0, file.stateid)])
+        nfs4lib.check(res)
+
+    def lookup(self, dirfh, name):
+        """Return filehandle for dirfh/name"""
+        fh = self.names.get((dirfh, name))
+        if fh is not None:
+            self._count("hits")
+            return fh
+        self._count("misses")
+        res = self.session.compound([op4.putfh(dirfh), op4.lookup(name),
+                                     op4.getfh()])
+        nfs4lib.check(res)
+        return res.resarray[-1].object
+
+    def getattr(self, fh, attrs):
+        """Return {attr: value} for the list of attrs"""
+        file = self.files.get(fh)
+        if file is not None and file.delegated():
+            with file.lock:
+                if file.delegated() and \
+                       not [a for a in attrs if a not in file.attrs]:
+                    self._count("hits")
+                    return dict((a, file.attrs[a]) for a in attrs)
+        self._count("misses")
+        res = self.session.compound([op4.putfh(fh),
+                                     op4.getattr(nfs4lib.list2bitmap(attrs))])
+        nfs4lib.check(res)
+        return res.resarray[-1].obj_attributes
+
+    def read(self, fh, offset, count):
+        """Return up to count bytes at offset, short only at EOF"""
+        file = self.files.get(fh)
+        if file is None or not file.delegated():
+            self._count("misses")
+            return self._read(fh, self._stateid(file), offset, count)
+        with file.lock:
+            if not file.delegated():
+                # Recalled while we waited for the lock
+                self._count("misses")
+                return self._read(fh, file.stateid, offset, count)
+            size = file.attrs.get(FATTR4_SIZE)
+            if size is not None:
+                count = max(min(count, size - offset), 0)
+            out = []
+            end = offset + count
+            while offset < end:
+                data = self._block(file, offset // self.blocksize)
+                start = offset % self.blocksize
+                piece = data[start:start + end - offset]
+                if not piece:
+                    break
+                out.append(piece)
+                offset += len(piece)
+            return "".join(out)
+
+    def write(self, fh, offset, data):
+        """Write data at offset, locally if a write delegation is held"""
+        file = self.files[fh]
+        with file.lock:
+            if not file.write_delegated():
+                self._count("misses")
+                self._write(fh, file.stateid, offset, data)
+                # Keep what we have in step with what we just wrote
+                first = offset // self.blocksize
+                last = (offset + len(data) - 1) // self.blocksize
+                for i in range(first, last + 1):
+                    file.blocks.pop(i, None)
+                file.attrs = {}
+                return len(data)
+            self._count("hits")
+            count = len(data)
+            end = offset + count
+            while offset < end:
+                i = offset // self.blocksize
+                block = self._block(file, i)
+                start = offset % self.blocksize
+                piece = data[:self.blocksize - start]
+                data = data[len(piece):]
+                if len(block) < start:
+                    block += "\0" * (start - len(block))
+                file.blocks[i] = block[:start] + piece + \
+                                 block[start + len(piece):]
+                file.dirty.add(i)
+                offset += len(piece)
+            if end > file.attrs.get(FATTR4_SIZE, 0):
+                file.attrs[FATTR4_SIZE] = end
+            return count
+
+    def flush(self, fh):
+        """Write any dirty data back to the server"""
+        file = self.files.get(fh)
+        if file is not None:
+            with file.lock:
+                self._flush(file)
+
+    def _stateid(self, file):
+        if file is None:
+            return nfs4lib.state00
+        return file.stateid
+
+    def _block(self, file, index):
+        """Return cached block, reading it from server if needed"""
+        data = file.blocks.get(index)
+        if data is not None:
+            self._count("hits")
+            return data
+        self._count("misses")
+        data = self._read(file.fh, file.stateid, index * self.blocksize,
+                          self.blocksize)
+        file.blocks[index] = data
+        return data
+
+    def _read(self, fh, stateid, offset, count):
+        out = []
+        while count > 0:
+            res = self.session.compound([op4.putfh(fh),
+                                         op4.read(stateid, offset,
+                                                  min(count, self.iosize))])
+            nfs4lib.check(res)
+            data = res.resarray[-1].data
+            out.append(data)
+            offset += len(data)
+            count -= len(data)
+            if res.resarray[-1].eof or not data:
+                break
+        return "".join(out)
+
+    def _write(self, fh, stateid, offset, data):
+        while data:
+            res = self.session.compound([op4.putfh(fh),
+                                         op4.write(stateid, offset,
+                                                   FILE_SYNC4,
+                                                   data[:self.iosize])])
+            nfs4lib.check(res)
+            count = res.resarray[-1].count
+            offset += count
+            data = data[count:]
+
+    def _flush(self, file):
+        """Write back dirty blocks.  Called with file.lock held."""
+        if not file.dirty:
+            return
+        self._count("flushes")
+        size = file.attrs.get(FATTR4_SIZE)
+        for i in sorted(file.dirty):
+            data = file.blocks[i]
+            if size is not None:
+                data = data[:max(size - i * self.blocksize, 0)]
+            self._write(file.fh, file.stateid, i * self.blocksize, data)
+        file.dirty.clear()
+
+    def _return(self, file):
+        """Flush, drop cached data and DELEGRETURN"""
+        with file.lock:
+            if not file.delegated():
+                return
+            self._flush(file)
+            stateid = file.deleg_stateid()
+            file.deleg = open_delegation4(OPEN_DELEGATE_NONE)
+            file.attrs = {}
+            file.blocks = {}
+            with self.lock:
+                for key in file.names:
+                    if self.names.get(key) == file.fh:
+                        del self.names[key]
+            file.names = []
+        res = self.session.compound([op4.putfh(file.fh),
+                                     op4.delegreturn(stateid)])
+        if res.status not in (NFS4_OK, NFS4ERR_BAD_STATEID,
+                              NFS4ERR_DELEG_REVOKED):
+            nfs4lib.check(res)
+
+    def _recall(self, arg, env):
+        """CB_RECALL pre-hook, returns the delegation from another thread
+
+        The callback reply must not wait for the flush, since the server
+        may need it before it will answer our WRITEs.
+        """
+        self._count("recalls")
+        file = self.files.get(arg.opcbrecall.fh)
+        if file is None:
+            return
+        t = threading.Thread(target=self._recall_thread, args=(file,),
+                             name="DelegationCache-recall")
+        t.setDaemon(True)
+        t.start()
+
+    def _recall_thread(self, file):
+        try:
+            self._return(file)
+        except Exception:
+            log_cb.exception("Error returning recalled delegation")
+
 ##     def open(self, owner, name=None, type=OPEN4_NOCREATE,
 ##              mode=UNCHECKED4, attrs={FATTR4_MODE:0644}, verf=None,
 ##              access=OPEN4_SHARE_ACCESS_READ,
@@ -2,6 +2,7 @@ from __future__ import with_statement
 import rpc
 import xdrdef.nfs4_const
 from xdrdef.nfs4_pack import NFS4Packer, NFS4Unpacker
+from xdrlib import Error as XDRError
 import xdrdef.nfs4_type
 import nfs_ops
 import time
@@ -10,6 +11,7 @@ import hmac
 import struct
 import random
 import re
+import urllib
 from locking import Lock
 try:
     from Crypto.Cipher import AES
@@ -241,38 +243,150 @@ class FancyNFS4Unpacker(NFS4Unpacker):
             list.append(e)
         data.entries = list
         return data
-            
+
+class LazyArgArray(object):
+    """The argarray of a COMPOUND4args, unpacked one op at a time.
+
+    Ops are only decoded when first asked for, so a compound that
+    stops early (an error, or a SEQUENCE replay) never pays to decode
+    the rest.  An op whose arguments don't decode is returned with
+    badxdr set, and nothing after it can be reached.  An unknown opcode
+    comes back as OP_ILLEGAL.
+    """
+    def __init__(self, unpacker):
+        self._p = unpacker
+        self._count = unpacker.unpack_uint()
+        self._ops = []
+
+    def __len__(self):
+        return self._count
+
+    def _decode_next(self):
+        p = self._p
+        pos = p.get_position()
+        try:
+            op = p.unpack_nfs_argop4()
+            if len(self._ops) + 1 == self._count:
+                p.done()
+        except (XDRError, EOFError, ValueError):
+            p.set_position(pos)
+            try:
+                op = xdrdef.nfs4_type.nfs_argop4(p.unpack_nfs_opnum4())
+                op.badxdr = True
+            except (XDRError, EOFError):
+                op = xdrdef.nfs4_type.nfs_argop4(xdrdef.nfs4_const.OP_ILLEGAL)
+            # There is no way to find where any later ops start
+            self._count = len(self._ops) + 1
+        self._ops.append(op)
+        return op
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("argarray index out of range")
+        while len(self._ops) <= i:
+            self._decode_next()
+        return self._ops[i]
+
+    def __iter__(self):
+        i = 0
+        while i < self._count:
+            yield self[i]
+            i += 1
+
+    def __repr__(self):
+        return repr(list(self))
+
+class LazyNFS4Unpacker(FancyNFS4Unpacker):
+    """Unpacks COMPOUND4args with a LazyArgArray, for use by servers.
+
+    WRITE data is returned as a buffer into the request, not a copy.
+    """
+    def unpack_COMPOUND4args(self):
+        data = xdrdef.nfs4_type.COMPOUND4args()
+        data.tag = self.unpack_utf8str_cs()
+        data.minorversion = self.unpack_uint32_t()
+        data.argarray = LazyArgArray(self)
+        return data
+
+    def unpack_WRITE4args(self):
+        data = xdrdef.nfs4_type.WRITE4args()
+        data.stateid = self.unpack_stateid4()
+        data.offset = self.unpack_offset4()
+        data.stable = self.unpack_stable_how4()
+        n = self.unpack_uint()
+        pos = self.get_position()
+        buf = self.get_buffer()
+        end = pos + (n + 3) // 4 * 4
+        if end > len(buf):
+            raise EOFError
+        data.data = buffer(buf, pos, n)
+        self.set_position(end)
+        return data
+
+class FattrCodec(object):
+    """Encoder and decoder for the attr_vals of one fattr4 attrmask.
+
+    The encode and decode methods are generated as straight-line code
+    calling the pack_fattr4_*/unpack_fattr4_* method of each attribute
+    in turn.  Use fattr_codec() to get a cached instance.
+    """
+    def __init__(self, attrmask):
+        self.attrmask = attrmask
+        self.bits = tuple(_bitmap2list(attrmask))
+        lines = ["def encode(data):",
+                 "    p = FancyNFS4Packer()"]
+        for bitnum in self.bits:
+            lines.append("    p.%s(data[%i])" % (bitnum2packer[bitnum], bitnum))
+        lines.append("    return p.get_buffer()")
+        lines += ["def decode(attr_vals):",
+                  "    u = FancyNFS4Unpacker(attr_vals)",
+                  "    result = {"]
+        for bitnum in self.bits:
+            lines.append("        %i: u.%s()," %
+                         (bitnum, bitnum2unpacker[bitnum]))
+        lines += ["    }",
+                  "    u.done()",
+                  "    return result"]
+        namespace = {"FancyNFS4Packer": FancyNFS4Packer,
+                     "FancyNFS4Unpacker": FancyNFS4Unpacker}
+        exec compile("\n".join(lines), "<fattr4 %#x>" % attrmask,
+                     "exec") in namespace
+        self.encode = namespace["encode"]
+        self.decode = namespace["decode"]
+
+_fattr_codecs = {}
+_fattr_codecs_max = 1024 # Masks come from clients, so bound the cache
+
+def fattr_codec(attrmask):
+    """Return the cached FattrCodec for attrmask"""
+    try:
+        return _fattr_codecs[attrmask]
+    except KeyError:
+        codec = FattrCodec(attrmask)
+        if len(_fattr_codecs) >= _fattr_codecs_max:
+            _fattr_codecs.clear()
+        _fattr_codecs[attrmask] = codec
+        return codec
+
 def dict2fattr(dict):
     """Convert a dictionary of form {numb:value} to a fattr4 object.
 
     Returns a fattr4 object.  
     """
-
-    attrs = dict.keys()
-    attrs.sort()
-
-    packer = FancyNFS4Packer()
-    attr_vals = ""
-    for bitnum in attrs:
-        value = dict[bitnum]
-        packer.reset()
-        getattr(packer, bitnum2packer[bitnum])(value)
-        attr_vals += packer.get_buffer()
-    attrmask = list2bitmap(attrs)
-    return xdrdef.nfs4_type.fattr4(attrmask, attr_vals); 
+    attrmask = list2bitmap(dict)
+    attr_vals = fattr_codec(attrmask).encode(dict)
+    return xdrdef.nfs4_type.fattr4(attrmask, attr_vals)
 
 def fattr2dict(obj):
     """Convert a fattr4 object to a dictionary with attribute name and values.
 
     Returns a dictionary of form {bitnum:value}
     """
-    result = {}
-    list = bitmap2list(obj.attrmask)
-    unpacker = FancyNFS4Unpacker(obj.attr_vals)
-    for bitnum in list:
-        result[bitnum] = getattr(unpacker, bitnum2unpacker[bitnum])()
-    unpacker.done()
-    return result
+    return fattr_codec(obj.attrmask).decode(obj.attr_vals)
 
 def list2bitmap(list):
     """Construct a bitmap from a list of bit numbers"""
@@ -281,17 +395,34 @@ def list2bitmap(list):
         mask |= 1L << bit
     return mask
 
-def bitmap2list(bitmap):
-    """Return (sorted) list of bit numbers set in bitmap"""
+def _bitmap2list(bitmap):
     out = []
-    bitnum = 0
+    base = 0
     while bitmap:
-        if bitmap & 1:
-            out.append(bitnum)
-        bitnum += 1
-        bitmap >>= 1
+        # Take a 32 bit word at a time, and within it pull off the
+        # lowest set bit with w & -w, until the word is empty.
+        word = int(bitmap & 0xffffffff)
+        while word:
+            low = word & -word
+            out.append(base + low.bit_length() - 1)
+            word ^= low
+        bitmap >>= 32
+        base += 32
     return out
 
+_bitmap_lists = {}
+
+def bitmap2list(bitmap):
+    """Return (sorted) list of bit numbers set in bitmap"""
+    try:
+        return list(_bitmap_lists[bitmap])
+    except KeyError:
+        bits = tuple(_bitmap2list(bitmap))
+        if len(_bitmap_lists) >= _fattr_codecs_max:
+            _bitmap_lists.clear()
+        _bitmap_lists[bitmap] = bits
+        return list(bits)
+
 ##########################################################
 
 def printhex(str, pretty=True):
@@ -495,16 +626,31 @@ def get_nfstime(t=None):
     nsec = int((t - sec) * 1000000000)
     return xdrdef.nfs4_type.nfstime4(sec, nsec)
 
+def nfs_url_transport(url):
+    """Return the rpc transport named by the scheme of an nfs url
+
+    nfs:// (or no scheme) and nfs+tcp:// give "tcp", nfs+udp:// gives
+    "udp", nfs+unix:// gives "unix", and nfs+shm:// gives "shm".
+    """
+    m = re.match(r"nfs\+(tcp|udp|unix|shm)://", url)
+    if m:
+        return m.group(1)
+    return "tcp"
+
 def parse_nfs_url(url):
     """Parse [nfs://]host:port/path, format taken from rfc 2224
        multipath addr:port pair are as such:
 
       $ip1:$port1,$ip2:$port2..
 
+    The scheme may also be nfs+tcp, nfs+udp, nfs+unix or nfs+shm (see
+    nfs_url_transport).  For nfs+unix and nfs+shm, host is the
+    %-encoded path of the socket, as in nfs+unix://%2Ftmp%2Fnfs.sock/export.
+
     Returns triple server, port, path.
     """
     p = re.compile(r"""
-    (?:nfs://)?               # Ignore an optionally prepended 'nfs://'
+    (?:nfs(?:\+(?:tcp|udp|unix|shm))?://)? # Ignore an optional scheme
     (?P<servers>[^/]+)
     (?P<path>/.*)?            # set path=everything else, must start with /
     $
@@ -514,8 +660,12 @@ def parse_nfs_url(url):
     if m:
         servers = m.group('servers')
         server_list = []
+        if nfs_url_transport(url) in ("unix", "shm"):
+            for server in servers.split(','):
+                server_list.append((urllib.unquote(server.strip()), None))
+            servers = ''
 
-        for server in servers.split(','):
+        for server in filter(None, servers.split(',')):
             server = server.strip()
 
             idx = server.rfind(':')
@@ -15,6 +15,11 @@ import hmac
 import random
 import struct
 import collections
+import hashlib
+import bisect
+import itertools
+import re
+import socket
 import logging
 from nfs4commoncode import CBCompoundState, CompoundState, encode_status, encode_status_by_name
 import nfs4client
@@ -24,6 +29,150 @@ from errorparser import ErrorDesc, ErrorParser
 log = logging.getLogger("nfs.proxy")
 log.setLevel(logging.INFO)
 
+# What peek_compound() learns about a COMPOUND without decoding it.
+# The session fields are None unless the first op is SEQUENCE.
+CompoundPeek = collections.namedtuple("CompoundPeek",
+                                      "minorversion ops sessionid "
+                                      "sequenceid slotid")
+
+def _skip_opaque(data, pos):
+    size, = struct.unpack_from(">I", data, pos)
+    return pos + 4 + ((size + 3) & ~3)
+
+def _skip_array(width):
+    def skip(data, pos):
+        count, = struct.unpack_from(">I", data, pos)
+        return pos + 4 + width * count
+    return skip
+
+# How to step over each kind of field in _arg_layouts
+_skippers = {
+    "u": lambda data, pos: pos + 4,   # 32 bit int, enum or bool
+    "h": lambda data, pos: pos + 8,   # 64 bit int or verifier4
+    "s": lambda data, pos: pos + 16,  # stateid4, sessionid4 or deviceid4
+    "o": _skip_opaque,                # opaque<> or string
+    "b": _skip_array(4),              # bitmap4
+    "S": _skip_array(16),             # stateid4<>
+    }
+
+# Argument layouts of the ops peek_compound() can step over.  Ops with
+# union arguments (OPEN, LOCK, CREATE, layout ops...) are left out, and
+# compounds containing them are always decoded.
+_arg_layouts = {
+    OP_ACCESS: "u",
+    OP_CLOSE: "us",
+    OP_COMMIT: "hu",
+    OP_DELEGPURGE: "h",
+    OP_DELEGRETURN: "s",
+    OP_GETATTR: "b",
+    OP_GETFH: "",
+    OP_LINK: "o",
+    OP_LOCKT: "uhhho",
+    OP_LOCKU: "uushh",
+    OP_LOOKUP: "o",
+    OP_LOOKUPP: "",
+    OP_NVERIFY: "bo",
+    OP_OPEN_DOWNGRADE: "suuu",
+    OP_PUTFH: "o",
+    OP_PUTPUBFH: "",
+    OP_PUTROOTFH: "",
+    OP_READ: "shu",
+    OP_READDIR: "hhuub",
+    OP_READLINK: "",
+    OP_REMOVE: "o",
+    OP_RENAME: "oo",
+    OP_RENEW: "h",
+    OP_RESTOREFH: "",
+    OP_SAVEFH: "",
+    OP_SECINFO: "o",
+    OP_SETATTR: "sbo",
+    OP_VERIFY: "bo",
+    OP_WRITE: "shuo",
+    OP_DESTROY_SESSION: "s",
+    OP_FREE_STATEID: "s",
+    OP_GETDEVICEINFO: "suub",
+    OP_SECINFO_NO_NAME: "u",
+    OP_SEQUENCE: "suuuu",
+    OP_TEST_STATEID: "S",
+    OP_DESTROY_CLIENTID: "h",
+    OP_RECLAIM_COMPLETE: "u",
+    }
+
+def peek_compound(data):
+    """Return CompoundPeek for the XDR encoded COMPOUND4args in data.
+
+    Only the op codes and SEQUENCE header are read.  Returns None if
+    some op's arguments can not be stepped over, or data is malformed,
+    in which case the caller must decode the compound properly.
+    """
+    sessionid = sequenceid = slotid = None
+    ops = []
+    try:
+        pos = _skip_opaque(data, 0) # tag
+        minorversion, count = struct.unpack_from(">II", data, pos)
+        pos += 8
+        for i in xrange(count):
+            op, = struct.unpack_from(">I", data, pos)
+            pos += 4
+            layout = _arg_layouts.get(op)
+            if layout is None:
+                return None
+            if op == OP_SEQUENCE and i == 0:
+                sessionid = data[pos:pos + NFS4_SESSIONID_SIZE]
+                sequenceid, slotid = struct.unpack_from(">II", data,
+                                                        pos + 16)
+            for kind in layout:
+                pos = _skippers[kind](data, pos)
+            ops.append(op)
+    except struct.error:
+        return None
+    if pos != len(data):
+        return None
+    return CompoundPeek(minorversion, ops, sessionid, sequenceid, slotid)
+
+def parse_servers(servers, default_port):
+    """Turn "host[:port],host[:port],..." into a list of (host, port)"""
+    out = []
+    for server in servers.split(','):
+        server = server.strip()
+        (host, port), = nfs4lib.parse_nfs_url(server)[0]
+        if not re.search(r":\d+$", server):
+            port = default_port
+        out.append((host, port))
+    return out
+
+class ConsistentHash(object):
+    """Place keys on nodes, moving few keys if the set of nodes changes"""
+    def __init__(self, nodes, replicas=64):
+        ring = []
+        for node in nodes:
+            for i in xrange(replicas):
+                ring.append((self._hash("%r-%i" % (node, i)), node))
+        ring.sort()
+        self.hashes = [h for h, node in ring]
+        self.nodes = [node for h, node in ring]
+
+    def _hash(self, key):
+        return struct.unpack(">I", hashlib.md5(key).digest()[:4])[0]
+
+    def get(self, key):
+        i = bisect.bisect(self.hashes, self._hash(key))
+        return self.nodes[i % len(self.nodes)]
+
+class RoundRobin(object):
+    """Place each new key on the next node in turn"""
+    def __init__(self, nodes):
+        self.nodes = itertools.cycle(nodes)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.nodes.next()
+
+placements = {"hash": ConsistentHash,
+              "roundrobin": RoundRobin,
+              }
+
 class NFS4Proxy(rpc.Server):
     """Implement an NFS(v4.x) proxy."""
     class Channel(object):
@@ -35,26 +184,28 @@ class NFS4Proxy(rpc.Server):
             self.maxrequests = maxreqs
 
     class ProxyClient(rpc.Client):
-        def __init__(self, prog, version, cb_version, server, port, pipe):
+        """Connections to one upstream server, one per downstream client"""
+        def __init__(self, prog, version, cb_version, server, port):
             rpc.Client.__init__(self, prog, version)
             self.proxy = None
             self.prog = prog
             self.version = version
             self.dserver = server
             self.dport = port
-            self.cb_prog = None
+            self.cb_progs = set() # callback programs of our clients
             self.cb_versions = [cb_version]
             # currently support only root (? fix ? )
             rpcsec = rpc.security.instance(rpc.AUTH_SYS)
             self.default_cred = rpcsec.init_cred(uid=0,gid=0,name="root")
-            if pipe: #reuse connection
-                self.pipe = pipe
-            else:
-                self.pipe = self.connect_to_server()
+
+        def __repr__(self):
+            return "ProxyClient(%s:%i)" % (self.dserver, self.dport)
 
         def _check_program(self, prog):
-            if self.cb_prog is not None:
-                return (prog == self.cb_prog)
+            return prog in self.cb_progs
+
+        def _check_version(self, low, hi, vers):
+            return (low <= vers <= hi)
 
         def _version_range(self, prog):
             return (min(self.cb_versions), max(self.cb_versions))
@@ -85,16 +236,52 @@ class NFS4Proxy(rpc.Server):
                 else:
                     return pipe
 
-        def make_call(self, proc, data, timeout=15.0):
-                xid = self.pipe.send_call(self.prog, self.version,
-                                          proc, data, self.default_cred)
-                header, data = self.pipe.listen(xid, timeout)
+        def make_call(self, pipe, proc, data, timeout=15.0):
+                xid = pipe.send_call(self.prog, self.version,
+                                     proc, data, self.default_cred)
+                header, data = pipe.listen(xid, timeout)
                 return data
 
+    class Route(object):
+        """Where calls arriving on one downstream connection are sent
+
+        Each downstream connection gets its own connection to the
+        upstream server, and so its sessions and backchannel are kept
+        apart from those of other clients.
+        """
+        def __init__(self, upstream, pipe, downstream):
+            self.upstream = upstream # ProxyClient for the chosen server
+            self.pipe = pipe # Our connection to that server
+            self.downstream = downstream # Client's connection to us
+            self.cb_prog = None # Set from client's CREATE_SESSION
+            self.cb_version = min(upstream.cb_versions)
+
+        def call(self, proc, data, timeout):
+            return self.upstream.make_call(self.pipe, proc, data, timeout)
+
+        def callback(self, proc, data, timeout):
+            xid = self.downstream.send_call(self.cb_prog, self.cb_version,
+                                            proc, data,
+                                            self.upstream.default_cred)
+            header, data = self.downstream.listen(xid, timeout)
+            return data
+
+        def set_cb_prog(self, program):
+            self.cb_prog = program
+            self.upstream.cb_progs.add(program)
+
+        def close(self):
+            """Shut down the upstream connection, its owner reaps it"""
+            try:
+                self.pipe.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
     def __init__(self, **kwargs):
         port = kwargs.pop("port")
         dport = kwargs.pop("dport")
-        dserver = kwargs.pop("dserver")
+        dservers = parse_servers(kwargs.pop("dserver"), dport)
+        placement = kwargs.pop("placement", "hash")
         self.program = kwargs.pop("program", NFS4_PROGRAM)
         self.version = kwargs.pop("version", 4)
         self.cb_version = kwargs.pop("cb_version", 1)
@@ -103,15 +290,32 @@ class NFS4Proxy(rpc.Server):
         self.bchannel = self.Channel(4096, 4096, 0, 2, 1)
         rpc.Server.__init__(self, prog=self.program, versions=[self.version],
                             port=port)
-        # we support only one server connection
-        self.client = self.ProxyClient(self.program, self.version,
-                                       self.cb_version,
-                                       dserver, dport,
-                                       None)
-        self.client.proxy = self
+        self.upstreams = []
+        for dserver, dport in dservers:
+            upstream = self.ProxyClient(self.program, self.version,
+                                        self.cb_version, dserver, dport)
+            upstream.proxy = self
+            self.upstreams.append(upstream)
+        self.placement = placements[placement](self.upstreams)
+        self.lock = threading.Lock()
+        self.routes = {} # {downstream pipe: Route}
+        self.cb_routes = {} # {upstream pipe: Route}
+        self.sessions = {} # {sessionid: ProxyClient}
         # load error description file
         errfile = kwargs.pop("errorfile", None)
         self.errorhandler = ErrorParser(errfile)
+        # forward compounds no rule applies to without decoding them
+        self.passthrough = kwargs.pop("passthrough", True)
+        self.intercepted_ops = self._intercepted_ops()
+
+    def _intercepted_ops(self):
+        """Return set of op codes with an override or error rule"""
+        names = set()
+        if self.errorhandler is not None:
+            names = self.errorhandler.operations()
+        return set(op for op, name in nfs_opnum4.items()
+                   if callable(getattr(self, name.lower(), None)) or
+                   name.lower()[3:] in names)
 
     def start(self):
         """Cause the server to start listening on the previously bound port"""
@@ -121,24 +325,54 @@ class NFS4Proxy(rpc.Server):
             import sys
             sys.exit()
 
-    def start_cb_proxy(self, program, version, client_pipe):
-        # FIXME: we support only one client at a time (at least with backchannel)
-        self.client.cb_prog = program
-        self.cb_client = self.ProxyClient(program, version, None, None,
-                                          None, client_pipe)
-        self.cb_client.proxy = self
+    def get_route(self, cred, callback=False, sessionid=None):
+        """Return the Route for a call arriving on cred.connection
 
-    def forward_call(self, calldata, callback=False, procedure=1,
-                     timeout=15.0, retries=3):
-        def get_client(callback):
+        A downstream connection seen for the first time is sent to the
+        server already holding sessionid, if known, or else to the one
+        chosen by the placement policy for the client's address.
+        Callbacks arrive on an upstream connection, and return None if
+        it does not belong to any client.
+        """
+        pipe = cred.connection
+        with self.lock:
             if callback:
-                return self.cb_client
-            return self.client
+                return self.cb_routes.get(pipe)
+            route = self.routes.get(pipe)
+            if route is not None:
+                return route
+            upstream = self.sessions.get(sessionid)
+        if upstream is None:
+            upstream = self.placement.get(pipe.getpeername()[0])
+        # Connect outside the lock, as this may take a while
+        route = self.Route(upstream, upstream.connect_to_server(), pipe)
+        with self.lock:
+            if pipe in self.routes:
+                # Another call from this client beat us to it
+                route.close()
+                return self.routes[pipe]
+            self.routes[pipe] = route
+            self.cb_routes[route.pipe] = route
+        log.info("Routing %r to %r" % (pipe.getpeername(), upstream))
+        return route
+
+    def _event_close(self, fd):
+        pipe = self.sockets.get(fd)
+        rpc.Server._event_close(self, fd)
+        with self.lock:
+            route = self.routes.pop(pipe, None)
+            if route is not None:
+                del self.cb_routes[route.pipe]
+        if route is not None:
+            route.close()
+
+    def forward_call(self, calldata, route, callback=False, procedure=1,
+                     timeout=15.0, retries=3):
         while True:
             try:
-                client = get_client(callback)
-                data = client.make_call(procedure, calldata)
-                return data
+                if callback:
+                    return route.callback(procedure, calldata, timeout)
+                return route.call(procedure, calldata, timeout)
             except rpc.RPCTimeout:
                 log.critical('-'*60)
                 log.critical("RPC call forwarding failed")
@@ -162,7 +396,11 @@ class NFS4Proxy(rpc.Server):
             log.debug("** CALLBACK **")
         log.debug("Handling NULL")
         try:
-            self.forward_call(calldata="", callback=callback, procedure=0)
+            route = self.get_route(cred, callback)
+            if route is None:
+                log.critical("Error: callback from unknown server connection")
+                return rpc.GARBAGE_ARGS, None
+            self.forward_call("", route, callback=callback, procedure=0)
             return rpc.SUCCESS, ''
         except rpc.RPCTimeout:
             log.critical("Error: cannot connect to destination server")
@@ -174,10 +412,22 @@ class NFS4Proxy(rpc.Server):
         if callback:
             log.debug("** CALLBACK **")
         log.debug("Handling COMPOUND")
+        # stage 0: forward untouched if nothing would act on it
+        if self.passthrough and not callback:
+            peek = peek_compound(data)
+            if peek is not None and \
+                   self.intercepted_ops.isdisjoint(peek.ops):
+                log.debug("Passing through %r" % (peek,))
+                try:
+                    route = self.get_route(cred, sessionid=peek.sessionid)
+                    return rpc.SUCCESS, self.forward_call(data, route)
+                except rpc.RPCTimeout:
+                    log.critical("Error: cannot connect to destination server")
+                    return rpc.GARBAGE_ARGS, None
         # stage 1: data in XDR as received from the client
         unpacker = nfs4lib.FancyNFS4Unpacker(data)
         if callback:
-            args = unpacker.unpack_CB_COMPOUNDargs()
+            args = unpacker.unpack_CB_COMPOUND4args()
         else:
             args = unpacker.unpack_COMPOUND4args()
         log.debug("Client sent:")
@@ -188,11 +438,13 @@ class NFS4Proxy(rpc.Server):
         args.req_size = len(data) # BUG, need to use cred.payload_size
         if callback:
             env = CBCompoundState(args, cred)
+            opnums = nfs_cb_opnum4
         else:
             env = CompoundState(args, cred)
+            opnums = nfs_opnum4
         for arg in args.argarray:
             env.index += 1
-            opname = nfs_opnum4.get(arg.argop, 'op_illegal')
+            opname = opnums.get(arg.argop, 'op_illegal')
             log.info("*** %s (%d) ***" % (opname, arg.argop))
             # look for functions implemented by the proxy
             # that override communication
@@ -235,8 +487,15 @@ class NFS4Proxy(rpc.Server):
         log.debug("Proxy sent:")
         log.debug(repr(args))
         calldata = packer.get_buffer()
-        try:    
-            ret_data = self.forward_call(calldata, callback)
+        sessionid = None
+        if args.argarray and args.argarray[0].argop == OP_SEQUENCE:
+            sessionid = args.argarray[0].opsequence.sa_sessionid
+        route = self.get_route(cred, callback, sessionid)
+        if route is None:
+            log.critical("Error: callback from unknown server connection")
+            return rpc.GARBAGE_ARGS, None
+        try:
+            ret_data = self.forward_call(calldata, route, callback)
         except rpc.RPCTimeout:
             log.critical("Error: cannot connect to destination server")
             return rpc.GARBAGE_ARGS, None
@@ -252,7 +511,7 @@ class NFS4Proxy(rpc.Server):
         # stage 5: post-processing - data in COMPOUND4res
         # XXX: check operation etc.
         for arg in res.resarray:
-            opname = nfs_opnum4.get(arg.resop, 'op_illegal')
+            opname = opnums.get(arg.resop, 'op_illegal')
             log.info("*** %s (%d) ***" % (opname, arg.resop))
             # look for functions implemented by the proxy
             # that override communication
@@ -289,15 +548,26 @@ class NFS4Proxy(rpc.Server):
                 if chan.maxrequests < attrs.ca_maxrequests:
                     attrs.ca_maxrequests = chan.maxrequests
             if direction is 0: # client to proxy
-                # XXX: this might be buggy with more than one clients (?)
-                self.start_cb_proxy(arg.opcreate_session.csa_cb_program,
-                                    version=1, client_pipe=cred.connection)
+                route = self.get_route(cred)
+                route.set_cb_prog(arg.opcreate_session.csa_cb_program)
                 _adjust_channel_values(arg.opcreate_session.csa_fore_chan_attrs,
                                        self.fchannel)
                 _adjust_channel_values(arg.opcreate_session.csa_back_chan_attrs,
                                        self.bchannel)
             elif direction is 1: # proxy to client
-                pass
+                res = arg.opcreate_session
+                if res.csr_status == NFS4_OK:
+                    # Later connections using this session go to same server
+                    route = self.get_route(cred)
+                    with self.lock:
+                        self.sessions[res.csr_resok4.csr_sessionid] = \
+                            route.upstream
+
+    def op_destroy_session(self, arg, cred, direction=0):
+            if direction is 0: # client to proxy
+                with self.lock:
+                    self.sessions.pop(arg.opdestroy_session.dsa_sessionid,
+                                      None)
 #FUNCTION OVERRIDING END
 
 def scan_options():
@@ -305,9 +575,17 @@ def scan_options():
     p = OptionParser("%prog [--dport=<?> --port=<?>] --dserver=<?>",
                     formatter = IndentedHelpFormatter(2, 25)
                     )
-    p.add_option("--dserver", dest="dserver", help="IP address to connect to")
+    p.add_option("--dserver", dest="dserver", help="IP address to connect to, "
+                 "or a comma separated list of host[:port] to spread clients over")
     p.add_option("--dport", dest="dport", default="2049", type=int, help="Set port to connect to")
+    p.add_option("--placement", default="hash", choices=sorted(placements),
+                 help="How clients are spread over several servers: hash "
+                 "keeps each client address on one server, roundrobin "
+                 "places each connection in turn [%default]")
     p.add_option("--port", dest="port", type=int, default="2049", help="Set port to listen on (2049)")
+    p.add_option("--nopassthrough", dest="passthrough", action="store_false",
+                 default=True, help="Decode every compound, even if no "
+                 "error rule applies to it")
 
     opts, args = p.parse_args()
     if args:
@@ -316,7 +594,8 @@ def scan_options():
 
 if __name__ == "__main__":
     opts = scan_options()
-    S = NFS4Proxy(port=opts.port, dserver=opts.dserver, dport=opts.dport, errorfile="error.xml")
+    S = NFS4Proxy(port=opts.port, dserver=opts.dserver, dport=opts.dport, errorfile="error.xml",
+                  passthrough=opts.passthrough, placement=opts.placement)
     if True:
         S.start()
     else:
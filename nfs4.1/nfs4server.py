@@ -10,12 +10,17 @@ from xdrdef.sctrl_pack import SCTRLPacker, SCTRLUnpacker
 import xdrdef.sctrl_type, xdrdef.sctrl_const
 import traceback, threading
 from locking import Lock, Counter
+import capture
+import metrics
+import persist
+import os
 import time
 import hmac
 import random
 import struct
 import collections
 import logging
+import nfs4state
 from nfs4state import find_state
 from nfs4commoncode import CompoundState, encode_status, encode_status_by_name
 from fs import RootFS, ConfigFS
@@ -209,10 +214,11 @@ class ClientList(object):
     the mapping of either to ClientRecords, where all of the 
     server's state data related to the client can be accessed.
     """
-    def __init__(self):
+    def __init__(self, journal=None):
         self._data = {}
         self.lock = Lock("ClientList")
         self._nextid = 0L
+        self.journal = journal # persist.StateJournal, or None
 
     def __getitem__(self, key):
         return self._data.get(key)
@@ -232,6 +238,8 @@ class ClientList(object):
         del self._data[clientid]
         del self._data[c.ownerid]
         c.freeze = True
+        if self.journal is not None:
+            self.journal.remove_client(clientid)
 
     def add(self, arg, principal, security):
         """Add a new client using EXCHANGE_ID4args.
@@ -251,8 +259,30 @@ class ClientList(object):
         # can record both without fear of collision.
         self._data[c.ownerid] = c
         self._data[c.clientid] = c
+        self.save(c)
         return c
 
+    def save(self, c):
+        """Record the client's current properties in the journal"""
+        if self.journal is None:
+            return
+        p = nfs4lib.FancyNFS4Packer()
+        p.pack_EXCHANGE_ID4args(c.exchange_args)
+        self.journal.add_client(c.clientid, p.get_buffer(),
+                                c.principal.name, c.confirmed)
+
+    def restore(self, clients, nextid):
+        """Put back clients rebuilt from the journal.
+
+        nextid is the first clientid never handed out, which keeps
+        clientids unique across restarts.
+        """
+        with self.lock:
+            for c in clients:
+                self._data[c.ownerid] = c
+                self._data[c.clientid] = c
+            self._nextid = max(self._nextid, nextid)
+
     def wipe(self):
         with self.lock:
             self._data = {}
@@ -286,6 +316,9 @@ class ClientRecord(object):
         self.sessions = [] # sessions associated with this clientid
         self.lastused = time.time() # time of last "RENEW" equivalant
         self.state = VerboseDict(self.config) # {other_id : StateTableEntry}
+        self.revoked = set() # 'other' ids of revoked delegations, until FREE_STATEID
+        self.restored = False # Set True if rebuilt from the journal
+        self.reclaim_complete = False # Set True by global RECLAIM_COMPLETE
         self._next = 1 # counter for generating unique stateid 'other'
         self._handle_ctr = Counter(name="ssv_handle_counter")
         self._lock = Lock("Client")
@@ -297,6 +330,7 @@ class ClientRecord(object):
             #      - for example, self.protection should not be modified
             return
         self.principal = principal
+        self.exchange_args = arg # Kept so the journal can rebuild us
         self.ownerid = arg.eia_clientowner.co_ownerid
         self.verifier = arg.eia_clientowner.co_verifier
         if arg.eia_client_impl_id:
@@ -369,7 +403,8 @@ class SessionRecord(object):
                                     client.session_replay.seqid) # XXX does this work?
         self.channel_fore = Channel(csa.csa_fore_chan_attrs, client.config) # Normal communication
         self.channel_back = Channel(csa.csa_back_chan_attrs, client.config) # Callback communication
-        self.persist = False # see 2.10.4.5 STUB - currently no way to set True
+        self.create_args = csa # Kept so the journal can rebuild us
+        self.persist = False # see 2.10.4.5, only set if server has a journal
         self.headerpadsize = 0 # STUB - ignored
         self.binding = (client.protection.type != SP4_NONE)
         self.nonce = {} # Store nonce while waiting for challange response
@@ -563,12 +598,26 @@ class NFS4Server(rpc.Server):
             log_cfg.setLevel(20)
 
         self.summary = SummaryOutput(kwargs.pop('show_summary', False))
+        self.capture = None # Flight recorder, see set_capture()
+        self.metrics = metrics.ServerMetrics()
+        capture_size = kwargs.pop('capture', 0)
+        self.capture_max = kwargs.pop('capture_max', 256 * 1024 * 1024)
+        self.dumpdir = kwargs.pop('dumpdir', None) # See dump_path()
+        statedir = kwargs.pop('statedir', None)
+        reset_state = kwargs.pop('reset_state', False)
+        sync_state = kwargs.pop('sync_state', False)
 
         rpc.Server.__init__(self, prog=NFS4_PROGRAM, versions=[4], port=port,
                             **kwargs)
         self.root = RootFS().root # Root of exported filesystem tree
         self._fsids = {self.root.fs.fsid: self.root.fs} # {fsid: fs}
-        self.clients = ClientList() # List of attached clients
+        # Journal of clients and persistent sessions, see restore_state()
+        if statedir is None:
+            self.journal = None
+        else:
+            self.journal = persist.StateJournal(statedir, reset_state,
+                                                sync_state)
+        self.clients = ClientList(self.journal) # List of attached clients
         self.sessions = {} # List of attached sessions
         self.minor_versions = [1]
         self.config = ServerConfig()
@@ -577,12 +626,16 @@ class NFS4Server(rpc.Server):
         self.mount(ConfigFS(self), path="/config")
         self.verifier = struct.pack('>d', time.time())
         self.recording = Recording()
+        self.recalls = nfs4state.RecallScheduler(self)
         self.devid_counter = Counter(name="devid_counter")
         self.devids = {} # {devid: device}
         # default cred for the backchannel -- currently supports only AUTH_SYS
         rpcsec = rpc.security.instance(rpc.AUTH_SYS)
         self.default_cred = rpcsec.init_cred(uid=4321,gid=42,name="mystery")
         self.err_inc_dict = self.init_err_inc_dict()
+        self.set_capture(capture_size)
+        if self.journal is not None:
+            self.restore_state()
 
     def start(self):
         """Cause the server to start listening on the previously bound port"""
@@ -600,6 +653,42 @@ class NFS4Server(rpc.Server):
             readline.parse_and_bind("tab: complete")
             code.InteractiveConsole(d).interact("Interact now")
 
+    def set_capture(self, size):
+        """Keep the last size bytes of traffic in a flight recorder
+
+        A size of 0 turns recording off.  Sizes over capture_max raise
+        ValueError.
+        """
+        if not 0 <= size <= self.capture_max:
+            raise ValueError("Capture size %i not in 0..%i" %
+                             (size, self.capture_max))
+        if size:
+            self.capture = capture.FlightRecorder(size)
+        else:
+            self.capture = None
+
+    def dump_path(self, name):
+        """Return where to write a debug dump called name
+
+        Since name comes from a client, only a plain file name is
+        allowed, and it is placed in the server's dumpdir.  Raises
+        ValueError if name is unacceptable or no dumpdir was set.
+        """
+        if self.dumpdir is None:
+            raise ValueError("Dumps are disabled, see --dumpdir")
+        if (not name or name in (os.curdir, os.pardir) or os.sep in name or
+            (os.altsep and os.altsep in name)):
+            raise ValueError("Bad dump file name %r" % name)
+        return os.path.join(self.dumpdir, name)
+
+    def dump_capture(self, name):
+        """Save flight recorder contents to dumpdir/name in pcapng format"""
+        filename = self.dump_path(name)
+        if self.capture is None:
+            log_41.warn("No capture to dump to %s" % filename)
+            return
+        self.capture.dump(filename)
+
     def reboot(self):
         # STUB - all sorts of locking issues to think through
         log_41.warn("CALLING REBOOT")
@@ -607,6 +696,96 @@ class NFS4Server(rpc.Server):
         # STUB - need to implement grace period, and send info in SEQ flags
         self.sessions = {}
         self.clients.wipe()
+        if self.journal is not None:
+            # Act like a restart, and bring back what was journaled
+            self.restore_state()
+
+    def restore_state(self):
+        """Rebuild client records and persistent sessions from the journal.
+
+        Only client records, persistent sessions and their reply caches
+        are journaled.  Open, lock and delegation state is not, so
+        restored clients are marked, and SEQUENCE tells them to reclaim
+        it until they send a global RECLAIM_COMPLETE.
+        """
+        start = time.time()
+        with self.journal.lock:
+            state = self.journal.state
+            server = dict(state["server"])
+            nextid = state["nextid"]
+            saved_clients = sorted(state["clients"].items())
+            saved_sessions = sorted((sessionid, dict(s["slots"]), s)
+                                    for sessionid, s
+                                    in state["sessions"].items())
+        # Keep server_owner the same, so clients know it is the same server
+        if "minor_id" in server:
+            self.config.minor_id = server["minor_id"]
+            self.config._owner = server_owner4(self.config.minor_id,
+                                               self.config.major_id)
+        else:
+            self.journal.set_server("minor_id", self.config.minor_id)
+        clients = []
+        for clientid, saved in saved_clients:
+            unpacker = nfs4lib.FancyNFS4Unpacker(saved["args"])
+            arg = unpacker.unpack_EXCHANGE_ID4args()
+            if arg.eia_state_protect.spa_how != SP4_NONE:
+                # STUB - the GSS contexts protecting these can't be restored
+                log_41.warn("Dropping journaled client %i, which used "
+                            "state protection" % clientid)
+                self.journal.remove_client(clientid)
+                continue
+            c = ClientRecord(clientid, arg,
+                             nfs4lib.NFS4Principal(saved["principal"]),
+                             security=self.sec_flavors)
+            c.confirmed = saved["confirmed"]
+            c.restored = True
+            if saved["replay"] is not None:
+                c.session_replay.seqid, data = saved["replay"]
+                c.session_replay.replay_cache = Cache(data)
+            clients.append(c)
+        self.clients.restore(clients, nextid)
+        count = 0
+        for sessionid, slots, saved in saved_sessions:
+            c = self.clients[saved["clientid"]]
+            if c is None:
+                continue
+            unpacker = nfs4lib.FancyNFS4Unpacker(saved["args"])
+            csa = unpacker.unpack_CREATE_SESSION4args()
+            session = SessionRecord(c, csa)
+            session.sessionid = sessionid
+            session.persist = True
+            session.cb_prog = csa.csa_cb_program
+            channel = session.channel_fore
+            for slotid, (seqid, data) in slots.items():
+                if slotid < len(channel.slots):
+                    channel.slots[slotid].seqid = seqid
+                    channel.slots[slotid].replay_cache = Cache(data)
+            c.sessions.append(session)
+            self.sessions[sessionid] = session
+            count += 1
+        elapsed = time.time() - start
+        self.metrics.set_gauge("nfs_state_restore_seconds",
+                               "Time taken by the last restore_state()",
+                               elapsed)
+        log_41.warn("Restored %i clients and %i sessions from %s in %.3fs" %
+                    (len(clients), count, self.journal.path, elapsed))
+
+    def journal_reply(self, env):
+        """Journal a reply just put into a persistent replay cache"""
+        session = env.session
+        if session is not None:
+            if session.persist:
+                slotid = env.argarray[0].opsequence.sa_slotid
+                slot = session.channel_fore.slots[slotid]
+                self.journal.slot_reply(session.sessionid, slotid,
+                                        slot.seqid, env.cache.data)
+            return
+        arg = env.argarray[0]
+        if arg.argop == OP_CREATE_SESSION:
+            c = self.clients[arg.opcreate_session.csa_clientid]
+            if c is not None and c.session_replay.replay_cache is env.cache:
+                self.journal.client_replay(c.clientid, c.session_replay.seqid,
+                                           env.cache.data)
 
     def mount(self, fs, path):
         """Mount the fs at the given path, creating the path if in RootFS.
@@ -689,30 +868,47 @@ class NFS4Server(rpc.Server):
         """COMPOUND procedure"""
         log_41.info("*" * 40)
         log_41.info("Handling COMPOUND")
-        # data is an XDR packed string.  Unpack it.
-        unpacker = nfs4lib.FancyNFS4Unpacker(data)
+        sample = self.config.metrics_sample
+        timed = sample and self.metrics.sampled(sample)
+        if timed:
+            start = time.time()
+        # data is an XDR packed string.  Unpack it.  Only the header is
+        # decoded here, the ops are decoded as op_compound reaches them.
+        unpacker = nfs4lib.LazyNFS4Unpacker(data)
         try:
             args = unpacker.unpack_COMPOUND4args()
-            unpacker.done()
         except:
             log_41.info(repr(data))
             log_41.warn("returning GARBAGE_ARGS")
             log_41.debug("unpacking raised the following error", exc_info=True)
             return rpc.GARBAGE_ARGS, None
-        log_41.info(repr(args))
+        if log_41.isEnabledFor(logging.INFO):
+            log_41.info(repr(args))
+        env = None
         try:
             # SEQUENCE needs to know size of request
             args.req_size = len(data) # BUG, need to use cred.payload_size
+            args.timed = timed
+            args.counted = bool(sample) # Status counts cover every op
+            if timed:
+                unpacked = time.time()
+                self.metrics.time_phase("unpack", unpacked - start)
             # Handle the request
             env = self.op_compound(args, cred)
+            if timed:
+                done = time.time()
+                self.metrics.time_phase("compound", done - unpacked)
             # Pack the results back into an XDR string
             res = COMPOUND4res(env.results.reply.status,
                                env.results.reply.tag,
                                env.results.reply.results)
-            log_41.info(repr(res))
+            if log_41.isEnabledFor(logging.INFO):
+                log_41.info(repr(res))
             p = nfs4lib.FancyNFS4Packer()
             p.pack_COMPOUND4res(res)
             reply = p.get_buffer()
+            if timed:
+                self.metrics.time_phase("pack", time.time() - done)
             # Stuff the replay cache
             if env.cache is not None:
                 p.reset()
@@ -721,16 +917,22 @@ class NFS4Server(rpc.Server):
                                                  env.results.cache.results))
                 env.cache.data = p.get_buffer()
                 env.cache.valid.set()
+                if self.journal is not None:
+                    self.journal_reply(env)
         except NFS4Replay, e:
             log_41.info("Replay...waiting for valid data")
             e.cache.valid.wait()
             log_41.info("Replay...sending data")
             reply = e.cache.data
-            unpacker.reset(reply)
-            show = unpacker.unpack_COMPOUND4res()
-            unpacker.done()
-            log_41.info(repr(show))
-        self.recording.add(data, reply)
+            if log_41.isEnabledFor(logging.INFO):
+                show = nfs4lib.FancyNFS4Unpacker(reply).unpack_COMPOUND4res()
+                log_41.info(repr(show))
+        if self.recording.on:
+            self.recording.add(data, reply)
+        if self.capture is not None:
+            session = getattr(env, "session", None)
+            clientid = session and session.client.clientid
+            self.capture.add(cred, args, clientid, data, reply)
         return rpc.SUCCESS, reply
 
     def init_err_inc_dict(self):
@@ -820,11 +1022,17 @@ class NFS4Server(rpc.Server):
             env.index += 1
             # Look for function self.op_<name>
             funct = getattr(self, opname.lower(), None)
-            if funct is None:
+            if getattr(arg, "badxdr", False):
+                # The op's arguments could not be decoded
+                result = encode_status_by_name(opname.lower()[3:],
+                                               NFS4ERR_BADXDR)
+            elif funct is None:
                 # If it doesn't exist, return _NOTSUPP
                 result = encode_status_by_name(opname.lower()[3:],
                                                NFS4ERR_NOTSUPP)
             else:
+                if args.timed:
+                    op_start = time.time()
                 try:
                     # Otherwise, call the function
                     result = funct(arg, env)
@@ -842,13 +1050,19 @@ class NFS4Server(rpc.Server):
                     traceback.print_exc()
                     result = encode_status_by_name(opname.lower()[3:],
                                                    NFS4ERR_SERVERFAULT)
+                if args.timed:
+                    self.metrics.time_op(opname[3:], time.time() - op_start)
+            if args.counted:
+                self.metrics.count_status(opname[3:], nfsstat4[result.status])
             env.results.append(result)
             opnames.append(opname.lower()[3:])
             status = result.status
             if status != NFS4_OK:
                 break
         log_41.info("Replying.  Status %s (%d)" % (nfsstat4[status], status))
-        client_addr = '%s:%s' % cred.connection._s.getpeername()[:2]
+        client_addr = cred.connection.getpeername()
+        if isinstance(client_addr, tuple):
+            client_addr = '%s:%s' % client_addr[:2]
         self.summary.show_op('handle v4.1 %s' % client_addr,
                              opnames, nfsstat4[status])
         return env
@@ -857,6 +1071,8 @@ class NFS4Server(rpc.Server):
         log_41.info("delete_session REMOVE SESSION")
         del self.sessions[sessionid]
         session.client.sessions.remove(session)
+        if session.persist:
+            self.journal.remove_session(sessionid)
 
     def error_set_session(self, session, sessionid, err):
         if (err == NFS4ERR_BADSESSION or err == NFS4ERR_DEADSESSION):
@@ -909,8 +1125,14 @@ class NFS4Server(rpc.Server):
         # STUB - figure out return flags
         pass
         # return
+        flags = 0
+        if session.client.revoked:
+            flags |= SEQ4_STATUS_RECALLABLE_STATE_REVOKED
+        if session.client.restored and not session.client.reclaim_complete:
+            # Its state was lost when we restarted
+            flags |= SEQ4_STATUS_RESTART_RECLAIM_NEEDED
         res = SEQUENCE4resok(session.sessionid, slot.seqid, arg.sa_slotid,
-                             arg.sa_highest_slotid, channel.maxrequests, 0)
+                             arg.sa_highest_slotid, channel.maxrequests, flags)
         return encode_status(NFS4_OK, res)
         
                
@@ -941,6 +1163,7 @@ class NFS4Server(rpc.Server):
                 return encode_status(NFS4ERR_CLID_INUSE)
             else:
                 c.confirmed = True
+                self.clients.save(c)
                 # STUB - need to purge state of any previous, and
                 # adjust ClientList appropriately
         # Go through args and use/adjust them
@@ -955,8 +1178,13 @@ class NFS4Server(rpc.Server):
         channel.connections.append(connection)
         session.cb_prog = arg.csa_cb_program
         # STUB - setting flags
-        # Establish backchannel if the client asked for one
         flags = 0
+        # Sessions can only outlive a restart if we keep a journal
+        if arg.csa_flags & CREATE_SESSION4_FLAG_PERSIST and \
+                self.journal is not None:
+            session.persist = True
+            flags |= CREATE_SESSION4_FLAG_PERSIST
+        # Establish backchannel if the client asked for one
         if arg.csa_flags & CREATE_SESSION4_FLAG_CONN_BACK_CHAN:
             try:
                 self.cb_null(session.cb_prog, connection, credinfo=None)
@@ -969,6 +1197,11 @@ class NFS4Server(rpc.Server):
         # Attach to global lists
         c.sessions.append(session) # XXX Is this needed?
         self.sessions[session.sessionid] = session
+        if session.persist:
+            p = nfs4lib.FancyNFS4Packer()
+            p.pack_CREATE_SESSION4args(arg)
+            self.journal.add_session(session.sessionid, c.clientid,
+                                     p.get_buffer())
         # Return
         res = CREATE_SESSION4resok(session.sessionid, arg.csa_sequence,
                                    flags, fore_attrs, back_attrs)
@@ -1618,8 +1851,7 @@ class NFS4Server(rpc.Server):
             if env.index != len(env.argarray) - 1:
                 return encode_status(NFS4ERR_INVAL) # QUESTION - what error?
         # STUB - need to think through any locking issues
-        del self.sessions[arg.dsa_sessionid]
-        session.client.sessions.remove(session)
+        self.delete_session(session, arg.dsa_sessionid)
         return encode_status(NFS4_OK)
 
     def op_remove(self, arg, env):
@@ -1841,7 +2073,58 @@ class NFS4Server(rpc.Server):
         with find_state(env, arg.deleg_stateid, allow_0=False) as state:
             state.delegreturn()
         return encode_status(NFS4_OK)
-    
+
+    def op_test_stateid(self, arg, env):
+        """Report on the validity of each stateid, without using them"""
+        check_session(env)
+        client = env.session.client
+        codes = []
+        for stateid in arg.ts_stateids:
+            state = client.state.get(stateid.other, None)
+            if stateid.other in client.revoked:
+                codes.append(NFS4ERR_DELEG_REVOKED)
+            elif state is None or state.invalid:
+                # This includes the special stateids
+                codes.append(NFS4ERR_BAD_STATEID)
+            elif stateid.seqid == 0 or stateid.seqid == state.seqid:
+                codes.append(NFS4_OK)
+            elif stateid.seqid < state.seqid:
+                codes.append(NFS4ERR_OLD_STATEID)
+            else:
+                codes.append(NFS4ERR_BAD_STATEID)
+        return encode_status(NFS4_OK, TEST_STATEID4resok(codes))
+
+    def op_free_stateid(self, arg, env):
+        """Forget a stateid with no state left, such as a revoked delegation"""
+        check_session(env)
+        client = env.session.client
+        stateid = arg.fsa_stateid
+        if stateid.other == "\0" * 12 and stateid.seqid == 1:
+            stateid = env.cid # The current stateid
+            if stateid in [None, nfs4lib.state00, nfs4lib.state11]:
+                return encode_status(NFS4ERR_BAD_STATEID)
+        other = stateid.other
+        if other in client.revoked:
+            # The client has acknowledged the revocation
+            client.revoked.discard(other)
+            return encode_status(NFS4_OK)
+        if other in client.state:
+            # STUB - an unlocked lock stateid could be freed here
+            return encode_status(NFS4ERR_LOCKS_HELD)
+        return encode_status(NFS4ERR_BAD_STATEID)
+
+    def op_reclaim_complete(self, arg, env):
+        check_session(env)
+        if arg.rca_one_fs:
+            # STUB - we don't track reclaims per filesystem
+            check_cfh(env)
+            return encode_status(NFS4_OK)
+        client = env.session.client
+        if client.reclaim_complete:
+            return encode_status(NFS4ERR_COMPLETE_ALREADY)
+        client.reclaim_complete = True
+        return encode_status(NFS4_OK)
+
     def op_getdevicelist(self, arg, env): # STUB
         check_session(env)
         check_cfh(env)
@@ -2077,7 +2360,8 @@ def scan_options():
                     formatter = IndentedHelpFormatter(2, 25)
                     )
     p.add_option("-r", "--reset", action="store_true", default=False,
-                 help="Reset and clear any disk-based filesystems")
+                 help="Reset and clear any disk-based filesystems "
+                 "and --statedir")
     p.add_option("-v", "--verbose", action="store_true", default=False,
                  help="Print debug info to screen and enter interpreter on ^C")
     p.add_option("-s", "--show_summary", action="store_true", default=False,
@@ -2095,16 +2379,46 @@ def scan_options():
                  help="File used to determine dataserver addresses")
     p.add_option("--port", type="int", default=2049,
                  help="Set port to listen on (2049)")
+    p.add_option("--udp", action="store_true", default=False,
+                 help="Also take calls over UDP on --port")
+    p.add_option("--unix", default=None, metavar="PATH",
+                 help="Also listen on an AF_UNIX socket at PATH")
+    p.add_option("--shm", default=None, metavar="PATH",
+                 help="Also listen at PATH for clients using shared "
+                 "memory (nfs+shm://) for bulk data")
+    p.add_option("--statedir", default=None, metavar="PATH",
+                 help="Journal clients, persistent sessions and their "
+                 "reply caches in PATH, and restore them on restart")
+    p.add_option("--sync_state", action="store_true", default=False,
+                 help="With --statedir, fsync every journal record")
 
     g = OptionGroup(p, "Debug options",
                     "These affect information collected and printed.")
     g.add_option("--debug_locks", action="store_true", default=False,
                  help="Threads track locks and their state")
+    g.add_option("--profile_locks", action="store_true", default=False,
+                 help="Record lock wait and hold times, see "
+                 "/config/actions/lock_profile* and --dumpdir")
+    g.add_option("--metrics_port", type="int", default=None, metavar="PORT",
+                 help="Serve Prometheus metrics on localhost:PORT/metrics")
+    g.add_option("--metrics_sample", type="int", default=10, metavar="N",
+                 help="With --metrics_port, time one in N compounds "
+                 "[%default]")
+    g.add_option("--capture", type="int", default=0, metavar="MB",
+                 help="Keep last MB of traffic, dump by writing a filename "
+                 "to /config/actions/capture_dump")
+    g.add_option("--capture_max", type="int", default=256, metavar="MB",
+                 help="Largest capture size clients may ask for [%default]")
+    g.add_option("--dumpdir", default=None, metavar="PATH",
+                 help="Directory debug dumps requested through "
+                 "/config/actions are written to (default is no dumps)")
     p.add_option_group(g)
 
     opts, args = p.parse_args()
     if args:
         p.error("Unhandled argument %r" % args[0])
+    if not 0 <= opts.capture <= opts.capture_max:
+        p.error("--capture must be between 0 and --capture_max")
     return opts
 
 if __name__ == "__main__":
@@ -2112,12 +2426,28 @@ if __name__ == "__main__":
     if opts.debug_locks:
         import locking
         locking.DEBUG = True
+    if opts.profile_locks:
+        import locking
+        locking.PROFILE = True
+        locking.profiler.enabled = True
     S = NFS4Server(port=opts.port,
+                   udp=opts.udp,
+                   unix=opts.unix,
+                   shm=opts.shm,
                    is_mds=opts.use_block or opts.use_files,
                    is_ds = opts.is_ds,
                    verbose = opts.verbose,
-                   show_summary = opts.show_summary)
+                   show_summary = opts.show_summary,
+                   capture = opts.capture * 1024 * 1024,
+                   capture_max = opts.capture_max * 1024 * 1024,
+                   dumpdir = opts.dumpdir,
+                   statedir = opts.statedir,
+                   reset_state = opts.reset,
+                   sync_state = opts.sync_state)
     read_exports(S, opts)
+    if opts.metrics_port is not None:
+        S.config.metrics_sample = opts.metrics_sample
+        metrics.serve_metrics(S.metrics, opts.metrics_port)
     if True:
         S.start()
     else:
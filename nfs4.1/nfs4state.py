@@ -1,6 +1,7 @@
 from __future__ import with_statement
 from contextlib import contextmanager
 import threading
+import time
 from locking import Lock
 import struct
 import nfs4lib
@@ -57,6 +58,8 @@ def find_state(env, stateid, allow_0=True, allow_bypass=False):
         # Now map stateid to find state
         state = env.session.client.state.get(stateid.other, None)
         if state is None:
+            if stateid.other in env.session.client.revoked:
+                raise NFS4Error(NFS4ERR_DELEG_REVOKED)
             raise NFS4Error(NFS4ERR_BAD_STATEID, tag="stateid not known")
         if state.file != env.cfh:
             raise NFS4Error(NFS4ERR_BAD_STATEID,
@@ -279,6 +282,8 @@ class DelegState(FileStateTyped):
         FileStateTyped.__init__(self, *args, **kwargs)
         # NOTE all delegations must be the same, either READ or WRITE.
         # Also note, there can only be one WRITE delegation out.
+        # Notified whenever a delegation is returned or revoked
+        self.returned = threading.Condition(self.lock)
 
     def conflicts(self, client, access, deny):
         """Returns True if the given share values conflict with a delegation"""
@@ -299,22 +304,29 @@ class DelegState(FileStateTyped):
             return True
 
     def recall_conflicting_delegations(self, dispatcher, client, access, deny):
+        """Recall conflicting delegations, and wait a bit for their return.
+
+        Called with the lock held.  Raises NFS4ERR_DELAY if the
+        delegations are still out after config.recall_wait seconds.
+        """
         # NOTE OK to have extra access/deny flags
         if not self.conflicts(client, access, deny):
             return
         # Recall everything
-        for e in self._tree.itervalues():
-            if e.status == NORMAL:
-                e.status = CB_INIT
-                t = threading.Thread(target=e.initiate_recall,
-                                     args=(dispatcher,))
-                t.setDaemon(True)
-                t.start()
+        recall = [e for e in self._tree.itervalues() if e.status == NORMAL]
+        for e in recall:
+            e.status = CB_INIT
+        dispatcher.recalls.add(recall)
         # We need to release the lock so that delegations can be recalled,
         # which can involve operations like WRITE, LOCK, OPEN, etc,
-        # that would otherwise block.  The easiest way to do this is to
-        # initiate shut down of this thread.
-        raise NFS4Error(NFS4ERR_DELAY)
+        # that would otherwise block.  Waiting on self.returned does this,
+        # and we are woken as soon as a delegation is returned or revoked.
+        end = time.time() + dispatcher.config.recall_wait
+        while self.conflicts(client, access, deny):
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise NFS4Error(NFS4ERR_DELAY)
+            self.returned.wait(remaining)
 
     def grant_delegation(self, open_state, access):
         # FIXME
@@ -718,6 +730,18 @@ class DelegEntry(StateTableEntry):
     def delegreturn(self):
         self.status = INVALID
         self.delete()
+        self._state.returned.notifyAll()
+
+    def revoke(self):
+        """Forcibly remove a delegation the client failed to return.
+
+        NOTE assumes lock is held.
+        """
+        log.info("Revoking delegation %r" % self.other)
+        self.status = INVALID
+        self.key[0].revoked.add(self.other)
+        self.delete()
+        self._state.returned.notifyAll()
 
     def has_permission(self, access):
         # From draft23 9.1.2:
@@ -727,55 +751,9 @@ class DelegEntry(StateTableEntry):
                 self.deleg_type == OPEN_DELEGATE_READ:
             raise NFS4Error(NFS4ERR_OPENMODE) # Is this the correct error???
 
-    def initiate_recall(self, dispatcher):
-        """Handle CB_RECALL for this delegation.
-
-        It is called in its own thread.
-        """
-        # STUB
-        # find active callback channel
-        # send CB_RECALL
-        # listen for reply
-        # monitor progress?
-        # DELEGRETURN or lease expiry should del self.state[client]
-        #   if that was last, should notify waiting threads that all
-        #   delegs have been returned
-        log.debug("Recalling delegation %r" % self.other)
-        client = self.key[0]
-        session = client.find_active_cb_session()
-        if session is None:
-            # BUG deal with this
-            raise RuntimeError
-        # NOTE that we come in w/o state lock...when should we grab it?
-        # ANSWER - we care about self.status, which can be set to 
-        # INVALID anytime by deleg_return
-        slot = session.channel_back.choose_slot()
-        seq_op = op4.cb_sequence(session.sessionid, slot.get_seqid(),
-                                slot.id, slot.id, True, []) # STUB
-        recall_op = op4.cb_recall(self.get_id(cb=True), False, self.file.fh)
-        if self.invalid:
-            # Race here doesn't matter, but would like to avoid the
-            # RPC if possible.
-            self.status = INVALID
-            return
-        # All sorts of STUBBINESS here
-        pipe = session.channel_back.connections[0]
-        xid = dispatcher.cb_compound_async([seq_op, recall_op], 
-                                           session.cb_prog, pipe=pipe)
-        # Note it is possible that self.invalid is True, but don't 
-        # want to take the lock
-        self.status = CB_SENT
-        res = dispatcher.cb_listen(xid, pipe)
-        session.channel_back.free_slot(slot.id)
-        with self.lock:
-            if res.status != NFS4_OK:
-                # NOTE - this could 'legit' occur if client sends DELEG_RETURN
-                # and get OK before responding to CB_RECALL, could happen
-                # if client spontaneously sends DELEG_RETURN about the same
-                # time server sends CB_RECALL
-                # STUB - now what???
-                raise RuntimeError
-            self.status = (CB_RECEIVED if not self.invalid else INVALID)
+    def recall_op(self):
+        """Return the CB_RECALL op for this delegation"""
+        return op4.cb_recall(self.get_id(cb=True), False, self.file.fh)
 
 class ByteEntry(StateTableEntry):
     type = BYTE
@@ -864,3 +842,138 @@ class LayoutEntry(StateTableEntry):
     def populate(self, layout):
         # Need to record here what we have handed out so far
         pass
+
+class RecallScheduler(object):
+    """Sends CB_RECALLs and revokes delegations that are not returned.
+
+    A single thread handles every recall.  Delegations queued by add()
+    are gathered up per client session, so each session gets one
+    CB_COMPOUND with as many CB_RECALLs as the channel allows.  Replies
+    are picked up without blocking the thread.  Any delegation still
+    out lease_time seconds after it was queued is revoked.
+    """
+    poll = 0.05 # How often to look for CB_COMPOUND replies
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.lock = threading.Condition()
+        self.queue = [] # DelegEntries waiting for CB_RECALL
+        self.deadlines = {} # {DelegEntry: time to revoke}
+        self.inflight = [] # [(xid, pipe, session, slot)]
+        self.thread = None
+
+    def add(self, entries):
+        """Queue the DelegEntries for recall"""
+        if not entries:
+            return
+        deadline = time.time() + self.dispatcher.config.lease_time
+        with self.lock:
+            for e in entries:
+                self.queue.append(e)
+                self.deadlines[e] = deadline
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="RecallScheduler")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    timeout = self._next_wakeup()
+                    if timeout is None or timeout > 0:
+                        self.lock.wait(timeout)
+                batch = self.queue
+                self.queue = []
+                now = time.time()
+                expired = [e for e, t in self.deadlines.items()
+                           if t <= now or e.invalid]
+                for e in expired:
+                    del self.deadlines[e]
+            try:
+                self._send(batch)
+                self._receive()
+                for e in expired:
+                    with e.lock:
+                        if not e.invalid:
+                            e.revoke()
+            except Exception:
+                log.error("Recall scheduler error", exc_info=True)
+
+    def _next_wakeup(self):
+        """Seconds until there is something to do, None if nothing pending"""
+        if self.inflight:
+            return self.poll
+        if not self.deadlines:
+            return None
+        return min(self.deadlines.itervalues()) - time.time()
+
+    def _send(self, entries):
+        """Send one CB_COMPOUND per session covering all given entries"""
+        batches = {} # {sessionid: (session, [DelegEntry])}
+        for e in entries:
+            if e.invalid:
+                continue
+            session = e.key[0].find_active_cb_session()
+            if session is None:
+                # Nothing to do but wait for the deadline to revoke it
+                log.warn("No callback channel to recall %r" % e.other)
+                continue
+            batches.setdefault(session.sessionid, (session, []))[1].append(e)
+        for session, batch in batches.itervalues():
+            channel = session.channel_back
+            if not channel.connections:
+                continue
+            size = max(channel.maxoperations - 1, 1)
+            for i in range(0, len(batch), size):
+                self._send_compound(session, batch[i:i + size])
+
+    def _send_compound(self, session, entries):
+        channel = session.channel_back
+        ops = []
+        for e in entries:
+            with e.lock:
+                if not e.invalid:
+                    ops.append(e.recall_op())
+                    e.status = CB_SENT
+        if not ops:
+            return
+        log.debug("Recalling %i delegations over session %s" %
+                  (len(ops), session.sessionid))
+        slot = channel.choose_slot()
+        seq_op = op4.cb_sequence(session.sessionid, slot.get_seqid(),
+                                 slot.id, slot.id, True, []) # STUB
+        pipe = channel.connections[0]
+        try:
+            xid = self.dispatcher.cb_compound_async([seq_op] + ops,
+                                                    session.cb_prog, pipe=pipe)
+        except Exception:
+            channel.free_slot(slot.id)
+            raise
+        self.inflight.append((xid, pipe, session, slot, time.time()))
+
+    def _receive(self):
+        """Collect any CB_COMPOUND replies that have arrived"""
+        waiting = []
+        for xid, pipe, session, slot, sent in self.inflight:
+            try:
+                res = self.dispatcher.cb_listen(xid, pipe, 0)
+            except rpc.RPCTimeout:
+                if time.time() - sent < self.dispatcher.config.lease_time:
+                    waiting.append((xid, pipe, session, slot, sent))
+                    continue
+                log.warn("No reply to CB_RECALL xid=%i" % xid)
+                res = None
+            if res is not None and res.resarray and \
+                   res.resarray[0].opcbsequence.csr_status == NFS4_OK:
+                seq_res = res.resarray[0].opcbsequence.csr_resok4
+                slot.seqid = seq_res.csr_sequenceid
+            elif res is not None:
+                # NOTE - this could 'legit' occur if client sends
+                # DELEGRETURN and gets OK before responding to CB_RECALL.
+                # Either way, the deadline takes care of the delegation.
+                log.info("CB_RECALL got %s" % nfsstat4.get(res.status))
+            session.channel_back.free_slot(slot.id)
+        self.inflight = waiting
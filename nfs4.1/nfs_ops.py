@@ -1,13 +1,22 @@
 """For each OP_<NAME> in nfs_argop4 and nfs_cb_argop4, create a function
 <name>() that returns the appropriate *_argop4 structure, hiding
 this routine packing from the user.
+
+The functions are built once, when the module is imported.  Arguments
+can be given by position or by keyword, using the field names of the
+<NAME>4args structure.  CompoundTemplate builds many similar compounds
+cheaply, see Slot.
 """
 
+import types
+
 from xdrdef import nfs4_type
 from xdrdef import nfs4_const
 
-from xdrdef import nfs3_type
-from xdrdef import nfs3_const
+# Only NFS3ops needs these, so don't load them for every v4 program
+from xdrdef import lazy_import
+nfs3_type = lazy_import("xdrdef.nfs3_type")
+nfs3_const = lazy_import("xdrdef.nfs3_const")
 
 def nfs4_op_names():
     skip = len('OP_')
@@ -21,63 +30,169 @@ def nfs3_proc_names():
     procs = [ x.lower()[skip:] for x in dir(nfs3_const) if x.startswith(pre) ]
     return procs
 
+def _arg_names(klass):
+    """Names of the fields taken by a generated args class, in order"""
+    init = getattr(klass, '__init__', None)
+    if init is None:
+        return ()
+    code = init.im_func.func_code
+    return code.co_varnames[1:code.co_argcount]
+
+def _check_args(opname, fields, args, kwargs):
+    if len(args) > len(fields):
+        raise TypeError("%s() takes at most %i arguments (%i given)" %
+                        (opname, len(fields), len(args)))
+    for key in kwargs:
+        if key not in fields:
+            raise TypeError("%s() got an unexpected keyword argument '%s'" %
+                            (opname, key))
+        if key in fields[:len(args)]:
+            raise TypeError("%s() got multiple values for argument '%s'" %
+                            (opname, key))
+
+def _v4_constructor(opname):
+    enum_name = opname.upper()
+    # RPC "args" class to create
+    klass = getattr(nfs4_type, "%s4args" % enum_name, None)
+    opnum = getattr(nfs4_const, "OP_" + enum_name)
+    if enum_name.startswith("CB_"):
+        argop = nfs4_type.nfs_cb_argop4
+        field = 'opcb%s' % opname[3:]
+    else:
+        argop = nfs4_type.nfs_argop4
+        field = 'op%s' % opname
+
+    if klass is None:
+        # The op takes no arguments
+        fields = ()
+        def constructor(*args):
+            if args:
+                raise TypeError("%s() takes no arguments (%i given)" %
+                                (opname, len(args)))
+            return argop(opnum)
+    elif type(klass) is dict:
+        # The args are a typedef'd enum, passed through as is
+        fields = ('arg',)
+        def constructor(arg):
+            return argop(opnum, **{field: arg})
+    else:
+        fields = _arg_names(klass)
+        def constructor(*args, **kwargs):
+            if kwargs or len(args) > len(fields):
+                _check_args(opname, fields, args, kwargs)
+            return argop(opnum, **{field: klass(*args, **kwargs)})
+    constructor.__name__ = opname
+    constructor.__doc__ = "%s(%s)" % (opname, ", ".join(fields))
+    return constructor
+
+def _v3_constructor(procname):
+    klass = getattr(nfs3_type, "%s3args" % procname.upper(), None)
+    if klass is None:
+        return None
+    fields = _arg_names(klass)
+    def constructor(*args, **kwargs):
+        if kwargs or len(args) > len(fields):
+            _check_args(procname, fields, args, kwargs)
+        # for v3 just return an instance
+        return klass(*args, **kwargs)
+    constructor.__name__ = procname
+    constructor.__doc__ = "%s(%s)" % (procname, ", ".join(fields))
+    return constructor
+
+def _build_constructors(names, build):
+    table = {}
+    for name in names:
+        constructor = build(name)
+        if constructor is not None:
+            table[name] = constructor
+    return table
+
+# All v4 constructors are built once, at import time.  The v3 ones are
+# built the first time an NFS3ops is created.
+nfs4_constructors = _build_constructors(nfs4_op_names(), _v4_constructor)
+nfs3_constructors = None
+
+def _nfs3_constructors():
+    global nfs3_constructors
+    if nfs3_constructors is None:
+        nfs3_constructors = _build_constructors(nfs3_proc_names(),
+                                                _v3_constructor)
+    return nfs3_constructors
+
 class NFSops:
     def __init__(self, is_v4):
         self._is_v4 = is_v4
         if is_v4:
-            self._op_names = nfs4_op_names()
-            self._type = nfs4_type
-            self._const = nfs4_const
-            self._args_suffix = '4args'
-            self._op_prefix = 'OP_'
+            self._constructors = nfs4_constructors
         else:
-            self._op_names = nfs3_proc_names()
-            self._type = nfs3_type
-            self._const = nfs3_const
-            self._args_suffix = '3args'
-            self._op_prefix = 'NFSPROC3_'
+            self._constructors = _nfs3_constructors()
+        self._op_names = self._constructors.keys()
+        # Normal attribute lookup finds these without calling __getattr__
+        self.__dict__.update(self._constructors)
 
     def __getattr__(self, attrname):
-        if attrname in self._op_names:
-            return lambda *args: self._handle_op(attrname, args)
-
-    def _handle_op(self, opname, args):
-        enum_name = opname.upper()
-
-        # RPC "args" class to create
-        class_name = "%s%s" % (enum_name, self._args_suffix)
-        klass = getattr(self._type, class_name, None)
-
-        if self._is_v4:
-            # stuff class into argop
-
-            # args to pass to argop __init__
-            opnum = getattr(self._const, self._op_prefix + enum_name)
-            kwargs = {}
-
-            if klass:
-                # otherwise it takes no arguments
-                if type(klass) is dict:
-                    assert len(args) == 1
-                    arg = args[0]
-                else:
-                    arg = klass(*args)
-
-                if enum_name.startswith("CB_"):
-                    kwargs['opcb%s' % enum_name.lower()] = arg
-                else:
-                    kwargs['op%s' % enum_name.lower()] = arg
-
-            if enum_name.startswith("CB_"):
-                argop = self._type.nfs_cb_argop4
-            else:
-                argop = self._type.nfs_argop4
-
-            return argop(opnum, **kwargs)
-
-        else:
-            # for v3 just return an instance
-            return klass(*args)
+        raise AttributeError("no such op: %s" % attrname)
+
+    def template(self, ops):
+        """Return a CompoundTemplate for ops, see CompoundTemplate"""
+        return CompoundTemplate(ops)
+
+class Slot(object):
+    """Placeholder for an op argument that is filled in later.
+
+    Use it in place of any argument to an op constructor, then pass the
+    ops to CompoundTemplate.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Slot(%r)" % self.name
+
+def _clone(obj):
+    # copy.copy() would trip over the __getattr__ of the generated types
+    return types.InstanceType(obj.__class__, obj.__dict__.copy())
+
+class CompoundTemplate(object):
+    """A fixed list of ops, some of whose arguments are Slots.
+
+    For example:
+        read = CompoundTemplate([op.putfh(fh),
+                                 op.read(stateid, Slot("offset"), 4096)])
+        ops = read.fill(offset=8192)
+
+    fill() only copies the ops that hold a Slot.  The other ops are
+    shared by every list it returns, so don't modify them.
+    """
+    def __init__(self, ops):
+        self.ops = list(ops)
+        self.slots = [] # list of (index, argname, [(field, slotname)])
+        names = set()
+        for i, argop in enumerate(self.ops):
+            for argname, arg in argop.__dict__.items():
+                if not hasattr(arg, '__dict__'):
+                    continue
+                found = [(field, value.name)
+                         for field, value in arg.__dict__.items()
+                         if isinstance(value, Slot)]
+                if found:
+                    self.slots.append((i, argname, found))
+                    names.update([name for field, name in found])
+        self.names = frozenset(names)
+
+    def fill(self, **values):
+        if len(values) != len(self.names) or self.names.difference(values):
+            raise TypeError("template needs values for %s, got %s" %
+                            (sorted(self.names), sorted(values)))
+        ops = self.ops[:]
+        for i, argname, found in self.slots:
+            argop = _clone(ops[i])
+            arg = _clone(getattr(argop, argname))
+            for field, name in found:
+                setattr(arg, field, values[name])
+            setattr(argop, argname, arg)
+            ops[i] = argop
+        return ops
 
 class NFS3ops(NFSops):
     def __init__(self):
@@ -0,0 +1,187 @@
+"""Journal of client, session and reply cache state, kept across restarts
+
+The server appends a record to the journal whenever a client record, a
+persistent session, or the reply cached in one of their slots changes.
+Records are pickled tuples of strings and integers.  XDR encoded args
+stand in for the server's objects, so the server can rebuild them with
+its usual constructors.
+
+Replaying the journal gives a snapshot, kept in StateJournal.state:
+    {"server": {key: value},
+     "nextid": first clientid not yet handed out,
+     "clients": {clientid: {"args": packed EXCHANGE_ID4args,
+                            "principal": name,
+                            "confirmed": bool,
+                            "replay": (seqid, cached CREATE_SESSION reply)}},
+     "sessions": {sessionid: {"clientid": clientid,
+                              "args": packed CREATE_SESSION4args,
+                              "slots": {slotid: (seqid, cached reply)}}}}
+
+The journal is rewritten from the snapshot when opened, and again when
+it has grown well beyond the snapshot's size, so it stays bounded.
+"""
+
+from __future__ import with_statement
+import os
+import cPickle as pickle
+import threading
+import logging
+
+log = logging.getLogger("nfs.server.persist")
+
+def empty_state():
+    return {"server": {}, "nextid": 0L, "clients": {}, "sessions": {}}
+
+def apply_record(state, record):
+    """Update snapshot state with one journal record"""
+    kind = record[0]
+    if kind == "client":
+        clientid, args, principal, confirmed = record[1:]
+        old = state["clients"].get(clientid, {})
+        state["clients"][clientid] = {"args": args,
+                                      "principal": principal,
+                                      "confirmed": confirmed,
+                                      "replay": old.get("replay")}
+        state["nextid"] = max(state["nextid"], clientid + 1)
+    elif kind == "client_replay":
+        clientid, seqid, data = record[1:]
+        if clientid in state["clients"]:
+            state["clients"][clientid]["replay"] = (seqid, data)
+    elif kind == "client_del":
+        clientid = record[1]
+        state["clients"].pop(clientid, None)
+        for sessionid, s in state["sessions"].items():
+            if s["clientid"] == clientid:
+                del state["sessions"][sessionid]
+    elif kind == "session":
+        sessionid, clientid, args = record[1:]
+        state["sessions"][sessionid] = {"clientid": clientid,
+                                        "args": args,
+                                        "slots": {}}
+    elif kind == "slot":
+        sessionid, slotid, seqid, data = record[1:]
+        if sessionid in state["sessions"]:
+            state["sessions"][sessionid]["slots"][slotid] = (seqid, data)
+    elif kind == "session_del":
+        state["sessions"].pop(record[1], None)
+    elif kind == "server":
+        key, value = record[1:]
+        state["server"][key] = value
+    elif kind == "nextid":
+        state["nextid"] = max(state["nextid"], record[1])
+    else:
+        raise ValueError("Unknown journal record %r" % kind)
+
+def state_records(state):
+    """Yield a minimal list of records which rebuild state"""
+    for key, value in sorted(state["server"].items()):
+        yield ("server", key, value)
+    yield ("nextid", state["nextid"])
+    for clientid, c in sorted(state["clients"].items()):
+        yield ("client", clientid, c["args"], c["principal"], c["confirmed"])
+        if c["replay"] is not None:
+            yield ("client_replay", clientid) + c["replay"]
+    for sessionid, s in sorted(state["sessions"].items()):
+        yield ("session", sessionid, s["clientid"], s["args"])
+        for slotid, (seqid, data) in sorted(s["slots"].items()):
+            yield ("slot", sessionid, slotid, seqid, data)
+
+class StateJournal(object):
+    """Append-only journal of server state in directory path
+
+    With sync set, every record is fsync'ed before the call returns,
+    as persistent sessions strictly require.  Otherwise records survive
+    a crash of the server process, but not of the machine.
+    """
+    filename = "state_journal"
+    compact_min = 16 * 1024 * 1024 # Don't compact journals smaller than this
+
+    def __init__(self, path, reset=False, sync=False):
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.file = os.path.join(path, self.filename)
+        if reset and os.path.exists(self.file):
+            os.remove(self.file)
+        self.state = self._load()
+        self._compact()
+
+    def _load(self):
+        state = empty_state()
+        if not os.path.exists(self.file):
+            return state
+        count = 0
+        fd = open(self.file, "rb")
+        try:
+            while True:
+                try:
+                    record = pickle.load(fd)
+                except EOFError:
+                    break
+                except Exception:
+                    # Most likely a record torn by a crash mid-write
+                    log.warn("Ignoring damaged journal after %i records in %s"
+                             % (count, self.file))
+                    break
+                apply_record(state, record)
+                count += 1
+        finally:
+            fd.close()
+        return state
+
+    def _compact(self):
+        """Rewrite the journal to hold just the current snapshot"""
+        tmp = self.file + ".new"
+        fd = open(tmp, "wb")
+        try:
+            for record in state_records(self.state):
+                pickle.dump(record, fd, pickle.HIGHEST_PROTOCOL)
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        os.rename(tmp, self.file)
+        self.fd = open(self.file, "ab")
+        self.compacted_size = self.written = self.fd.tell()
+
+    def append(self, *record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            apply_record(self.state, record)
+            self.fd.write(data)
+            self.fd.flush()
+            if self.sync:
+                os.fsync(self.fd.fileno())
+            self.written += len(data)
+            if self.written > max(self.compact_min, 4 * self.compacted_size):
+                self.fd.close()
+                self._compact()
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+    # Convenience functions, one per record type
+
+    def add_client(self, clientid, args, principal, confirmed):
+        self.append("client", clientid, args, principal, confirmed)
+
+    def client_replay(self, clientid, seqid, data):
+        self.append("client_replay", clientid, seqid, data)
+
+    def remove_client(self, clientid):
+        self.append("client_del", clientid)
+
+    def add_session(self, sessionid, clientid, args):
+        self.append("session", sessionid, clientid, args)
+
+    def slot_reply(self, sessionid, slotid, seqid, data):
+        self.append("slot", sessionid, slotid, seqid, data)
+
+    def remove_session(self, sessionid):
+        self.append("session_del", sessionid)
+
+    def set_server(self, key, value):
+        self.append("server", key, value)
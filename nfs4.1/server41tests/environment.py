@@ -16,6 +16,7 @@ import rpc
 import nfs4client
 import sys
 import os
+import copy
 import nfs4lib
 from nfs4lib import use_obj, UnexpectedCompoundRes
 import logging
@@ -114,7 +115,8 @@ class Environment(testmod.Environment):
     def __init__(self, opts):
         self._lock = Lock()
         self.opts = opts
-        self.c1 = nfs4client.NFS4Client(opts.server, opts.port, opts.minorversion)
+        self.c1 = nfs4client.NFS4Client(opts.server, opts.port, opts.minorversion,
+                                        transport=opts.transport)
         s1 = rpc.security.instance(opts.flavor)
         if opts.flavor == rpc.AUTH_NONE:
             self.cred1 = s1.init_cred()
@@ -141,7 +143,7 @@ class Environment(testmod.Environment):
         self.stateid0 = stateid4(0, '')
         self.stateid1 = stateid4(0xffffffffL, '\xff'*12)
 
-        log.info("Created client to %s, %i" % (opts.server, opts.port))
+        log.info("Created client to %s, %s" % (opts.server, opts.port))
 
     def init(self):
         """Run once before any test is run"""
@@ -201,6 +203,24 @@ class Environment(testmod.Environment):
         res = close_file(sess, fh, stateid)
         check(res)
             
+    def worker(self, index):
+        """Returns a new Environment for a parallel test worker
+
+        It has its own client connection, and uses its own subdirectory
+        of opts.home, so that tests run by different workers do not
+        interfere.
+        """
+        opts = copy.copy(self.opts)
+        env = self.__class__(opts)
+        opts.home = opts.home + ["worker%i" % index]
+        env.c1.homedir = opts.home
+        sess = env.c1.new_client_session("Environment.worker%i_%i" %
+                                         (index, env.timestamp))
+        res = create_obj(sess, opts.home, NF4DIR)
+        check(res, msg="Trying to create /%s," % '/'.join(opts.home))
+        sess.c.null()
+        return env
+
     def finish(self):
         """Run once after all tests are run"""
         if self.opts.nocleanup:
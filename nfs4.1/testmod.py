@@ -8,9 +8,14 @@
 #
 from __future__ import with_statement
 import nfs4lib
+import os
 import re
 import sys
+import cPickle as pickle
+import json
 import time
+import threading
+import Queue
 from traceback import format_exception, print_exc
 import xml.dom.minidom
 import datetime
@@ -272,19 +277,21 @@ def _run_filter(test, options):
     """Returns True if test should be run, False if it should be skipped"""
     return True
 
-def runtests(tests, options, environment, runfilter=_run_filter):
+def runtests(tests, options, environment, runfilter=_run_filter,
+             stream=None):
     """tests is an array of test objects, to be run in order
     
-    (as much as possible)
+    (as much as possible).  If stream is given, each test result is
+    written to it as soon as the test has run.
     """
     for t in tests:
         if t.result == TEST_NOTRUN:
-            _runtree(t, options, environment, runfilter)
+            _runtree(t, options, environment, runfilter, stream)
         else:
             # Test has already been run in a dependency tree
             pass
 
-def _runtree(t, options, environment, runfilter=_run_filter):
+def _runtree(t, options, environment, runfilter=_run_filter, stream=None):
     if t.result == TEST_WAIT:
         # We are waiting for a dependency to run
         return
@@ -305,9 +312,9 @@ def _runtree(t, options, environment, runfilter=_run_filter):
                 return
             continue
         if dep.result == t._omit_result and options.rundeps:
-            _runtree(dep, options, environment, runfilter)
+            _runtree(dep, options, environment, runfilter, stream)
         elif dep.result == TEST_NOTRUN:
-            _runtree(dep, options, environment, runfilter)
+            _runtree(dep, options, environment, runfilter, stream)
         # Note dep.result has now changed
         if dep.result == TEST_WAIT:
             # Oops, hit a circular dependency
@@ -319,6 +326,145 @@ def _runtree(t, options, environment, runfilter=_run_filter):
                               (dep, dep.result))
             return
     t.run(environment, getattr(options, 'verbose', False))
+    if stream is not None:
+        stream.record(t)
+
+def _exclusive(test):
+    """Returns True if test must not run concurrently with any other"""
+    return False
+
+def _wanted(tests, options, runfilter):
+    """Returns the set of tests that runtests would try to run"""
+    wanted = set()
+    todo = [t for t in tests if runfilter(t, options)]
+    while todo:
+        t = todo.pop()
+        if t in wanted:
+            continue
+        wanted.add(t)
+        if options.rundeps:
+            todo.extend([d for d in t.dependencies if d.result != DEP_FUNCT])
+    return wanted
+
+def runtests_parallel(tests, options, environments, runfilter=_run_filter,
+                      exclusive=_exclusive, stream=None):
+    """Run tests concurrently, one worker thread per environment
+
+    Each environment must be independent, with its own client and home
+    directory.  A test is only started once all of its dependencies have
+    finished, and results are judged as in _runtree.  Tests for which
+    exclusive(test) is True are run only when no other test is running.
+    Tests that already have a result (see restore_results) are not rerun.
+    """
+    verbose = getattr(options, 'verbose', False)
+    wanted = _wanted(tests, options, runfilter)
+    for t in tests:
+        if t not in wanted and t.result == TEST_NOTRUN:
+            t.result = t._omit_result
+    pending = set([t for t in wanted if t.result == TEST_NOTRUN])
+    # Map each test to the tests waiting on it
+    waiting = dict((t, []) for t in pending)
+    blocked = {}
+    for t in pending:
+        deps = [d for d in t.dependencies
+                if d.result != DEP_FUNCT and d in pending]
+        blocked[t] = len(deps)
+        for d in deps:
+            waiting[d].append(t)
+    # Keep original ordering among ready tests
+    order = dict((t, i) for i, t in enumerate(tests))
+    ready = sorted([t for t in pending if not blocked[t]], key=order.get)
+    todo = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker(environment):
+        while True:
+            t = todo.get()
+            if t is None:
+                return
+            try:
+                _run_ready(t, options, environment, verbose)
+                if stream is not None:
+                    stream.record(t)
+            finally:
+                done.put(t)
+
+    threads = []
+    for env in environments:
+        thread = threading.Thread(target=worker, args=(env,),
+                                  name="Test-%i" % len(threads))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    running = 0
+    running_exclusive = False
+    try:
+        while ready or running:
+            # Start as many ready tests as possible
+            while ready and running < len(threads) and not running_exclusive:
+                if running and exclusive(ready[0]):
+                    break
+                t = ready.pop(0)
+                if not _deps_ok(t, options):
+                    # Judge now so dependents are released in same pass
+                    _finish(t, waiting, blocked, ready, order)
+                    continue
+                running_exclusive = exclusive(t)
+                t.result = t._run_result
+                todo.put(t)
+                running += 1
+            if not running:
+                continue
+            # Python2 Queue.get ignores KeyboardInterrupt without a timeout
+            while True:
+                try:
+                    t = done.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            running_exclusive = False
+            _finish(t, waiting, blocked, ready, order)
+    finally:
+        for thread in threads:
+            todo.put(None)
+    # Anything left is part of a dependency cycle
+    for t in pending:
+        if t.result == TEST_NOTRUN:
+            t.result = t._wait_result
+
+def _deps_ok(t, options):
+    """Check test dependencies, setting t.result to OMIT if they failed"""
+    if options.force:
+        return True
+    for dep in t.dependencies:
+        if dep.result == DEP_FUNCT:
+            continue
+        if dep.result in [TEST_OMIT, TEST_FAIL, TEST_NOTSUP]:
+            t.result = Result(TEST_OMIT,
+                              "Dependency %s had status %s." % \
+                              (dep, dep.result))
+            return False
+    return True
+
+def _run_ready(t, options, environment, verbose):
+    """Run a test whose test dependencies are done, in a worker thread"""
+    for dep in t.dependencies:
+        if dep.result == DEP_FUNCT and not options.force and \
+                not dep(t, environment):
+            t.result = Result(TEST_OMIT,
+                              "Dependency function %s failed" %
+                              dep.__name__)
+            return
+    t.run(environment, verbose)
+
+def _finish(t, waiting, blocked, ready, order):
+    """Release tests that were waiting on t"""
+    for w in waiting[t]:
+        blocked[w] -= 1
+        if not blocked[w]:
+            ready.append(w)
+    ready.sort(key=order.get)
 
 def _import_by_name(name):
     mod = __import__(name)
@@ -347,6 +493,93 @@ def parseversions(t):
         right = int(limits[1])
     return (left, right)
 
+class _LazyFunction(object):
+    """Stand-in for a function whose module has not been imported yet
+
+    The module is only imported the first time the function is called.
+    """
+    def __init__(self, module, attr, name, funct_module, doc):
+        self._module = module
+        self._attr = attr
+        self._funct = None
+        self.__name__ = name
+        self.__module__ = funct_module
+        self.__doc__ = doc
+
+    def __call__(self, *args, **kwargs):
+        if self._funct is None:
+            self._funct = getattr(_import_by_name(self._module), self._attr)
+        return self._funct(*args, **kwargs)
+
+# Bump this whenever the format of the cached index changes
+_INDEX_VERSION = 2
+_INDEX_FILE = ".testindex"
+
+def _scan_module(testdir, testfile, mtime):
+    """Import a test module, and return its index entry
+
+    The entry records, for each test, enough to recreate the Test without
+    importing the module, and also which DEPEND names are functions.
+    """
+    testmod = ".".join([testdir, testfile])
+    mod = _import_by_name(testmod)
+    tests = []
+    functs = {}
+    for attr in dir(mod):
+        if attr.startswith("test"):
+            f = getattr(mod, attr)
+            t = Test(testfile, f, testmod)
+            tests.append((attr, f.__name__, f.__module__, f.__doc__))
+            fmod = _import_by_name(f.__module__)
+            for d in t.depend_list:
+                if hasattr(fmod, d):
+                    funct = getattr(fmod, d)
+                    if callable(funct):
+                        functs[(f.__module__, d)] = funct.__doc__ or ""
+                    else:
+                        functs[(f.__module__, d)] = None
+    return {"mtime": mtime, "tests": tests, "functs": functs}
+
+def _load_index(testdir, package):
+    """Return index of all tests in package, rescanning changed modules"""
+    dirname = os.path.dirname(package.__file__)
+    filename = os.path.join(dirname, _INDEX_FILE)
+    try:
+        fd = open(filename, "rb")
+        try:
+            index = pickle.load(fd)
+        finally:
+            fd.close()
+        if index.get("version") != _INDEX_VERSION:
+            index = {}
+    except Exception:
+        index = {}
+    modules = index.get("modules", {})
+    new_modules = {}
+    for testfile in package.__all__:
+        if testfile.endswith('.py'):
+            testfile = testfile[:-3]
+        try:
+            mtime = os.stat(os.path.join(dirname, testfile + ".py")).st_mtime
+        except OSError:
+            mtime = None
+        entry = modules.get(testfile)
+        if mtime is None or entry is None or entry["mtime"] != mtime:
+            entry = _scan_module(testdir, testfile, mtime)
+        new_modules[testfile] = entry
+    if new_modules != modules:
+        try:
+            fd = open(filename, "wb")
+            try:
+                pickle.dump({"version": _INDEX_VERSION,
+                             "modules": new_modules}, fd, 2)
+            finally:
+                fd.close()
+        except (IOError, OSError):
+            # Read-only install, just don't cache
+            pass
+    return new_modules
+
 def createtests(testdir):
     """ Tests are functions that start with "test".  Their docstring must
     contain a line starting with "CODE:".  It may optionally contain a line
@@ -355,21 +588,27 @@ def createtests(testdir):
     any code names.  The depend list is a list of code names for tests that
     must be run before the given test.
 
+    Test modules are only imported when they have changed since the last
+    call, otherwise the test information is read from an index cached
+    in testdir, and a module is imported when one of its tests is run.
+
     Returns a list of tests, a dictionary of {flags:bitmask}, and a
     dictionary of {code:test}
     """
     # Find all tests in testdir
     tests = []
     package = _import_by_name(testdir)
+    index = _load_index(testdir, package)
+    functs = {}
     for testfile in package.__all__:
         if testfile.endswith('.py'):
             testfile = testfile[:-3]
         testmod = ".".join([testdir, testfile])
-        mod = _import_by_name(testmod)
-        for attr in dir(mod):
-            if attr.startswith("test"):
-                f = getattr(mod, attr)
-                tests.append(Test(testfile, f, testmod))
+        entry = index[testfile]
+        for attr, name, funct_module, doc in entry["tests"]:
+            f = _LazyFunction(testmod, attr, name, funct_module, doc)
+            tests.append(Test(testfile, f, testmod))
+        functs.update(entry["functs"])
     # Reduce doc string info into format easier to work with
     used_codes = {}
     flag_dict = {}
@@ -394,6 +633,7 @@ def createtests(testdir):
         if f in used_codes:
             raise RuntimeError("flag %s is also used as a test code" % f)
     # Now turn dependency names into pointers, and flags into a bitmask
+    dep_functs = {}
     for t in tests:
         t.versions = parseversions(t)
         t.flags = sum([flag_dict[x] for x in t.flags_list])
@@ -402,13 +642,18 @@ def createtests(testdir):
             if d in used_codes:
                 t.dependencies.append(used_codes[d])
             else:
-                mod = _import_by_name(t.runtest.__module__)
-                if not hasattr(mod, d):
+                key = (t.runtest.__module__, d)
+                if key not in functs:
                     raise RuntimeError("Could not find reference to dependency %s" % str(d))
-                funct = getattr(mod, d)
-                if not callable(funct):
+                if functs[key] is None:
                     raise RuntimeError("Dependency %s of %s does not exist" %
                           (d, t.fullname))
+                if key not in dep_functs:
+                    # Share one object, so result is visible to all users
+                    dep_functs[key] = _LazyFunction(t.runtest.__module__, d,
+                                                    d, t.runtest.__module__,
+                                                    functs[key])
+                funct = dep_functs[key]
                 funct.result = t._funct_result
                 t.dependencies.append(funct)
     return tests, flag_dict, used_codes
@@ -460,19 +705,149 @@ def printresults(tests, opts, file=None):
           (count[SKIP], count[FAIL], count[WARN], count[PASS])
     return count[FAIL]
 
+def _text(value):
+    """Make str (or lists of them) safe for json, which wants utf-8
+
+    Messages may quote bytes from the server, so bad utf-8 is replaced.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, list):
+        return [_text(v) for v in value]
+    return value
+
+class ResultStream(object):
+    """Write test results to fd as they happen, one json object per line
+
+    A run writes a "start" line, a "test" line for each test as it
+    finishes, and a "finish" line once all tests have been judged.  A
+    resumed run appends to the same file, so later lines win.  A result
+    that can't be written is reported on stderr, and the run goes on.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+        self.recorded = set()
+
+    def _write(self, d):
+        with self.lock:
+            self.fd.write(json.dumps(d) + '\n')
+            self.fd.flush()
+
+    def start(self, tests):
+        self._write({"type": "start", "total": len(tests),
+                     "time": time.time()})
+
+    def record(self, t):
+        try:
+            self._write({"type": "test",
+                         "code": t.code,
+                         "name": t.name,
+                         "suite": t.suite,
+                         "fullname": t.fullname,
+                         "doc": _text(t.doc),
+                         "flags_list": t.flags_list,
+                         "outcome": t.result.outcome,
+                         "msg": _text(t.result.msg),
+                         "tb": _text(t.result.tb),
+                         "default": t.result.default,
+                         "time_taken": t.time_taken,
+                         })
+        except Exception:
+            print >> sys.stderr, "Could not record result of %s:" % t.code
+            print_exc()
+            return
+        self.recorded.add(t.code)
+
+    def finish(self, tests, complete=True):
+        """Record results not written by the runner, such as omits"""
+        for t in tests:
+            if t.code in self.recorded or t.result == TEST_NOTRUN:
+                continue
+            if t.result == TEST_OMIT and t.result.default:
+                continue
+            self.record(t)
+        if complete:
+            self._write({"type": "finish", "time": time.time()})
+
+def read_results(fd):
+    """Read a ResultStream, returning list of tests in order first seen
+
+    The file is read a line at a time, and may still be being written.
+    Tests not (yet) recorded are represented by placeholders, so that
+    printresults shows an unfinished run as interrupted.
+    """
+    tests = []
+    by_code = {}
+    total = 0
+    complete = False
+    for line in fd:
+        if not line.endswith('\n'):
+            # Partially written line
+            break
+        d = json.loads(line)
+        if d["type"] == "start":
+            total = d["total"]
+            complete = False
+        elif d["type"] == "finish":
+            complete = True
+        elif d["type"] == "test":
+            t = by_code.get(d["code"])
+            if t is None:
+                t = Test.__new__(Test)
+                by_code[d["code"]] = t
+                tests.append(t)
+            result = Result(d["outcome"], d["msg"].encode('utf-8'),
+                            default=d["default"])
+            result.tb = d["tb"]
+            for key in ("code", "name", "suite", "fullname", "doc",
+                        "flags_list", "time_taken"):
+                setattr(t, key, d[key])
+            t.result = result
+    if complete:
+        # The rest were never selected to run
+        filler = Test._omit_result
+    else:
+        filler = Result()
+    for i in range(total - len(tests)):
+        t = Test.__new__(Test)
+        t.result = filler
+        t.time_taken = 0
+        tests.append(t)
+    return tests
+
+def restore_results(tests, fd):
+    """Mark tests that passed in the ResultStream fd as already run
+
+    Returns the number of tests restored.
+    """
+    passed = dict([(t.code, t) for t in read_results(fd)
+                   if t.result == TEST_PASS])
+    count = 0
+    for t in tests:
+        if t.code in passed:
+            t.result = t._pass_result
+            t.time_taken = passed[t.code].time_taken
+            count += 1
+    return count
+
 def xml_printresults(tests, file_name, suite='all'):
     with open(file_name, 'w') as fd:
         failures = 0
         skipped = 0
         total_time = 0
+        count = 0
         doc = xml.dom.minidom.Document()
         testsuite = doc.createElement("testsuite")
-        testsuite.setAttribute("tests", str(len(tests)))
         testsuite.setAttribute("errors", "0")
         testsuite.setAttribute("timestamp", str(datetime.datetime.now()))
         testsuite.setAttribute("name", suite)
         doc.appendChild(testsuite)
         for t in tests:
+            if not hasattr(t, "code"):
+                # read_results placeholder
+                continue
+            count += 1
             testcase = doc.createElement("testcase")
             testsuite.appendChild(testcase)
             testcase.setAttribute("name", t.name)
@@ -492,6 +867,7 @@ def xml_printresults(tests, file_name, suite='all'):
                 skip = doc.createElement("skipped")
                 testcase.appendChild(skip)
 
+        testsuite.setAttribute("tests", str(count))
         testsuite.setAttribute("failures", str(failures))
         testsuite.setAttribute("skipped", str(skipped))
         testsuite.setAttribute("time", str(total_time))
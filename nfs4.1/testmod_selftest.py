@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Checks of testmod's own machinery, run with: python testmod_selftest.py"""
+
+import use_local
+import unittest
+from StringIO import StringIO
+import testmod
+from testmod import FailureException
+
+class FakeEnvironment(object):
+    def startUp(self):
+        pass
+
+    def shutDown(self):
+        pass
+
+    def clean_sessions(self):
+        pass
+
+    def clean_clients(self):
+        pass
+
+def testBadBytes(t, env):
+    """Fail with a message quoting bytes that are not utf-8
+
+    CODE: SELF1
+    """
+    raise FailureException("Server returned tag '\xff'")
+
+class ResultStreamTest(unittest.TestCase):
+    def make_test(self, function):
+        t = testmod.Test(None, function, "testmod_selftest")
+        t.code = t.code_list[0]
+        t.run(FakeEnvironment())
+        return t
+
+    def test_failure_msg_with_bad_utf8(self):
+        t = self.make_test(testBadBytes)
+        self.assertEqual(t.result, testmod.TEST_FAIL)
+        self.assertTrue("\xff" in t.result.msg)
+        fd = StringIO()
+        stream = testmod.ResultStream(fd)
+        stream.start([t])
+        stream.record(t)
+        stream.finish([t])
+        self.assertTrue(t.code in stream.recorded)
+        fd.seek(0)
+        tests = testmod.read_results(fd)
+        self.assertEqual(len(tests), 1)
+        self.assertEqual(tests[0].result, testmod.TEST_FAIL)
+        self.assertTrue("Server returned tag" in tests[0].result.msg)
+
+    def test_unrecordable_result_does_not_raise(self):
+        t = self.make_test(testBadBytes)
+        t.time_taken = object() # Not json serializable
+        stream = testmod.ResultStream(StringIO())
+        stream.record(t)
+        self.assertFalse(t.code in stream.recorded)
+
+if __name__ == "__main__":
+    unittest.main()
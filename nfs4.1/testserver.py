@@ -38,7 +38,6 @@ from optparse import OptionParser, OptionGroup, IndentedHelpFormatter
 import server41tests.environment as environment
 import socket
 import rpc
-import cPickle as pickle
 
 VERSION="0.2" # How/when update this?
 
@@ -53,6 +52,10 @@ if not hasattr(os, "getgid"):
 else:
     GID = os.getgid()
 
+# Tests with these flags affect the whole server, so never run alongside
+# other tests when using --jobs
+EXCLUSIVE_FLAGS = ["reboot"]
+
 def scan_options(p):
     """Parse command line options
     """
@@ -67,11 +70,16 @@ def scan_options(p):
     p.add_option("--nocleanup", action="store_true", default=False,
                  help="Skip final cleanup of test directory")
     p.add_option("--outfile", "--out", default=None, metavar="FILE",
-                 help="Store test results in FILE [%default]")
+                 help="Store test results in FILE as they happen [%default]")
+    p.add_option("--resume", action="store_true", default=False,
+                 help="Skip tests that passed in existing --outfile, "
+                 "and append new results to it")
     p.add_option("--xmlout", "--xml", default=None, metavar="FILE",
                  help="Store test results in xml format [%default]")
     p.add_option("--debug_fail", action="store_true", default=False,
                  help="Force some checks to fail")
+    p.add_option("--jobs", "-j", type="int", default=1, metavar="N",
+                 help="Run up to N independent tests at once [%default]")
     p.add_option("--minorversion", type="int", default=1,
                  metavar="MINORVERSION", help="Choose NFSv4 minor version")
 
@@ -244,6 +252,7 @@ def main():
         p.error("Need a server")
     url = args.pop(0)
     server_list, opt.path = nfs4lib.parse_nfs_url(url)
+    opt.transport = nfs4lib.nfs_url_transport(url)
 
     if not server_list:
         p.error("%s not a valid server name" % url)
@@ -253,6 +262,9 @@ def main():
     if not args:
         p.error("No tests given")
 
+    if opt.resume and opt.outfile is None:
+        p.error("--resume needs --outfile")
+
     # Check --use* options are valid
     for attr in dir(opt):
         if attr.startswith('use') and attr != "usefh":
@@ -332,15 +344,34 @@ def main():
         raise
         print sys.exc_info()[1]
         sys.exit(1)
+    stream = None
     if opt.outfile is not None:
-        fd = file(opt.outfile, 'w')
+        if opt.resume and os.path.exists(opt.outfile):
+            fd = open(opt.outfile, 'r')
+            try:
+                count = testmod.restore_results(tests, fd)
+            finally:
+                fd.close()
+            print "Skipping %i tests that passed in %s" % (count, opt.outfile)
+            fd = open(opt.outfile, 'a')
+        else:
+            fd = open(opt.outfile, 'w')
+        stream = testmod.ResultStream(fd)
+        stream.start(tests)
     try:
         clean_finish = False
-        testmod.runtests(tests, opt, env, run_filter)
+        if opt.jobs > 1:
+            workers = [env.worker(i) for i in range(opt.jobs)]
+            mask = sum([fdict.get(f, 0) for f in EXCLUSIVE_FLAGS])
+            testmod.runtests_parallel(tests, opt, workers, run_filter,
+                                      lambda t: t.flags & mask, stream)
+        else:
+            testmod.runtests(tests, opt, env, run_filter, stream)
         clean_finish = True
     finally:
-        if opt.outfile is not None:
-            pickle.dump(tests, fd, 0)
+        if stream is not None:
+            stream.finish(tests, clean_finish)
+            fd.close()
         if not clean_finish:
             testmod.printresults(tests, opt)
     try:
@@ -0,0 +1,155 @@
+"""Modules generated by xdrgen from the .x files in this directory.
+
+Two helpers keep the cost of importing them down:
+
+lazy_import(name) returns a stand-in for a module that is only imported
+the first time one of its attributes is used.  Use it for definitions a
+program only sometimes needs.
+
+enable_code_cache(directory) keeps the compiled code of the generated
+modules in directory, so they are not recompiled on every run when .pyc
+files can't be written (a read-only tree, or PYTHONDONTWRITEBYTECODE).
+It is turned on for every program by setting XDRDEF_CACHE=directory.
+"""
+
+import imp
+import marshal
+import os
+import struct
+import sys
+import zlib
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+class LazyModule(object):
+    """Stands in for a module until one of its attributes is used"""
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            __import__(self._name)
+            module = sys.modules[self._name]
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__["_module"] is None:
+            return "<lazy module %r>" % self._name
+        return repr(self._module)
+
+def lazy_import(name):
+    """Return name's module if already loaded, else a LazyModule for it"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+class CodeCache(object):
+    """Import hook which loads the generated modules from cached code.
+
+    Each entry is stamped with the interpreter's magic number and the
+    source's mtime and size, and is rebuilt when any of them change.
+    """
+    suffixes = ("_const", "_type", "_pack")
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _source(self, fullname):
+        package, _, name = fullname.rpartition(".")
+        if package != __name__ or not name.endswith(self.suffixes):
+            return None
+        source = os.path.join(_here, name + ".py")
+        if not os.path.exists(source):
+            return None
+        return source
+
+    def find_module(self, fullname, path=None):
+        if self._source(fullname) is None:
+            return None
+        return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        source = self._source(fullname)
+        code = self.get_code(source)
+        module = imp.new_module(fullname)
+        module.__file__ = source
+        module.__package__ = __name__
+        module.__loader__ = self
+        sys.modules[fullname] = module
+        try:
+            exec code in module.__dict__
+        except:
+            del sys.modules[fullname]
+            raise
+        return module
+
+    def get_code(self, source):
+        st = os.stat(source)
+        stamp = imp.get_magic() + struct.pack("<II", int(st.st_mtime) & 0xffffffff,
+                                              st.st_size & 0xffffffff)
+        # Include a hash of the path, in case several trees share the cache
+        cached = os.path.join(self.directory, "%s-%08x.pyc" %
+                              (os.path.basename(source)[:-3],
+                               zlib.crc32(source) & 0xffffffff))
+        try:
+            fd = open(cached, "rb")
+            try:
+                if fd.read(len(stamp)) == stamp:
+                    return marshal.loads(fd.read())
+            finally:
+                fd.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        fd = open(source, "rU")
+        try:
+            code = compile(fd.read(), source, "exec")
+        finally:
+            fd.close()
+        self._save(cached, stamp, code)
+        return code
+
+    def _save(self, cached, stamp, code):
+        # Write to a temporary name and rename, so concurrent runs never
+        # see a partial file.  A cache we can't write is just skipped.
+        tmp = "%s.%i" % (cached, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd = open(tmp, "wb")
+            try:
+                fd.write(stamp)
+                marshal.dump(code, fd)
+            finally:
+                fd.close()
+            os.rename(tmp, cached)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+def enable_code_cache(directory):
+    """Load the generated modules through a CodeCache in directory"""
+    for hook in sys.meta_path:
+        if isinstance(hook, CodeCache):
+            hook.directory = directory
+            return
+    sys.meta_path.insert(0, CodeCache(directory))
+
+if os.environ.get("XDRDEF_CACHE"):
+    enable_code_cache(os.path.expanduser(os.environ["XDRDEF_CACHE"]))
@@ -1,11 +1,15 @@
 from __future__ import with_statement
 
 import socket, select
+import os
+import stat
+import mmap
+import tempfile
 import struct
 import threading
 import logging
-from collections import deque as Deque
-from errno import EINPROGRESS, EWOULDBLOCK
+from collections import deque as Deque, OrderedDict
+from errno import EINPROGRESS, EWOULDBLOCK, EAGAIN
 
 import rpc_pack
 from rpc_const import *
@@ -23,6 +27,9 @@ log_t = logging.getLogger("rpc.thread") # handler threads
 
 LOOPBACK = "127.0.0.1"
 
+# Transports that ConnectionHandler.connect() accepts
+TRANSPORTS = ("tcp", "unix", "udp", "shm")
+
 def inc_u32(i):
     """Increment a 32 bit integer, with wrap-around."""
     return int( (i+1) & 0xffffffff )
@@ -251,7 +258,11 @@ class Pipe(object):
         return "pipe-%i" % self._s.fileno()
 
     def recv_records(self, count):
-        """Pull up to count bytes from pipe, converting into records."""
+        """Pull up to count bytes from pipe, converting into records.
+
+        Returns a list of (record, pipe) pairs, where pipe is what any
+        reply to record should be sent through.
+        """
         # This is only called from main handler thread, so doesn't need locking
         data = self._s.recv(count)
         if not data:
@@ -278,7 +289,7 @@ class Pipe(object):
                 # self._read_buf is empty.
                 record = ''.join(self._packet_buf)
                 self._packet_buf = []
-                out.append(record)
+                out.append((record, self))
         return out
 
     def push_record(self, record):
@@ -316,7 +327,11 @@ class Pipe(object):
             return out
 
         record = self._write_queue.pop()
-        self._write_buf += add_record_marks(record, count)
+        self._write_buf += add_record_marks(self._encode_record(record), count)
+
+    def _encode_record(self, record):
+        """Hook for subclasses to transform a record about to be sent"""
+        return record
 
     def flush_pipe(self):
         """Try to flush the write buffer.
@@ -433,6 +448,314 @@ class RpcPipe(Pipe):
         reply = (msg, msg_data) # The return value of self.listen()
         deferred.fill(reply, exc)
 
+class DatagramPipe(RpcPipe):
+    """RpcPipe over a UDP socket.
+
+    Each datagram carries exactly one record, so no record marking is
+    done, and records too big for a datagram can not be sent.
+
+    A connected socket (client side) talks only to its peer, and is
+    itself the pipe replies come back through.  An unconnected socket
+    (server side) hears from anyone, so each sender gets a DatagramPeer,
+    which routes replies back to that sender's address.  Only the
+    max_peers most recent senders are remembered, since source
+    addresses are trivially spoofed.
+    """
+    maxdatagram = 65507 # Largest UDP payload over IPv4
+    max_peers = 1024 # Senders remembered at once
+
+    def __init__(self, socket, write_alarm):
+        RpcPipe.__init__(self, socket, write_alarm)
+        try:
+            socket.getpeername()
+            self._connected = True
+        except Exception:
+            self._connected = False
+        self._peers = OrderedDict() # {address: DatagramPeer}, oldest first
+        self._write_buf = Deque() # [(address, datagram)] waiting to be sent
+
+    def __str__(self):
+        return "udp-%i" % self._s.fileno()
+
+    def recv_records(self, count):
+        """Read one datagram, returning it as a record."""
+        try:
+            data, address = self._s.recvfrom(self.maxdatagram)
+        except socket.error, e:
+            if self._connected:
+                raise
+            # Don't let one bad sender close the socket everyone uses
+            log_p.warn("recvfrom got exception %s" % str(e))
+            return []
+        if self._connected:
+            return [(data, self)]
+        peer = self._peers.pop(address, None)
+        if peer is None:
+            peer = DatagramPeer(self, address)
+            if len(self._peers) >= self.max_peers:
+                self._peers.popitem(last=False)
+        self._peers[address] = peer
+        return [(data, peer)]
+
+    def push_record(self, record, address=None):
+        self._write_queue.appendleft((address, record))
+        self._alarm.buzz('\x00', self)
+
+    def pop_record(self, count):
+        address, record = self._write_queue.pop()
+        if len(record) > self.maxdatagram:
+            log_p.error("Dropping %i byte record, too big for a datagram" %
+                        len(record))
+            return
+        self._write_buf.appendleft((address, record))
+
+    def flush_pipe(self):
+        while self._write_buf:
+            address, record = self._write_buf[-1]
+            try:
+                if address is None:
+                    self._s.send(record)
+                else:
+                    self._s.sendto(record, address)
+            except socket.error, e:
+                if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                    return False
+                log_p.error("flush_pipe got exception %s" % str(e))
+            self._write_buf.pop()
+        return True
+
+class ShmRegion(object):
+    """One direction of a shared memory area, used as a ring buffer.
+
+    The sender appends data at its head, and the receiver, having
+    copied data out, stores how far it has read in the first 8 bytes of
+    the region, which frees the space for reuse.  Both counters only
+    grow; positions in the ring are taken modulo size.  Since a pipe
+    places and consumes chunks in stream order, no other locking is
+    needed.
+    """
+    def __init__(self, mm, base, size):
+        self._mm = mm
+        self._base = base # Offset of region in mm
+        self.size = size # Bytes available for data
+        self._head = 0 # Sender's count of bytes placed
+
+    def place(self, data):
+        """Copy data into the ring, returning (offset, length, end)
+
+        Returns None if there is not enough free space.
+        """
+        n = len(data)
+        tail = struct.unpack_from('>Q', self._mm, self._base)[0]
+        start = self._head
+        if start % self.size + n > self.size:
+            # Don't wrap data around the end, skip to the beginning
+            start += self.size - start % self.size
+        if start + n - tail > self.size:
+            return None
+        offset = start % self.size
+        pos = self._base + 8 + offset
+        self._mm[pos:pos + n] = data
+        self._head = start + n
+        return offset, n, self._head
+
+    def take(self, offset, length, end):
+        """Copy out a chunk placed by the other end, and free its space"""
+        if offset + length > self.size:
+            raise ValueError("Chunk (%i, %i) outside of region" %
+                             (offset, length))
+        pos = self._base + 8 + offset
+        data = self._mm[pos:pos + length]
+        struct.pack_into('>Q', self._mm, self._base, end)
+        return data
+
+class ShmPipe(RpcPipe):
+    """RpcPipe which moves bulk data through shared memory.
+
+    This emulates RPC-over-RDMA between two processes on one host.  The
+    stream socket (normally AF_UNIX) carries every RPC header, but the
+    procedure data of any message over inline_size bytes is placed into
+    a mmap-ed region shared by both ends, and the record just holds a
+    chunk (offset, length) pointing at it.  If the region is full, data
+    is sent inline instead.
+
+    Each record on the stream starts with a transport header:
+      SHM_INLINE, then the RPC message
+      SHM_CHUNK, offset, length, end, then the RPC header
+      SHM_SETUP, then the path of the file to map
+    The client creates the file and offers it before its first call.
+    The server only maps a "pynfs-shm-" file in /dev/shm or the temp
+    directory which is owned by the peer's uid, and unlinks it once
+    mapped.  The first half of the file carries data sent by the
+    client, the second half data sent by the server.  A bad SETUP or
+    CHUNK record closes the connection.
+    """
+    SHM_INLINE = 0
+    SHM_CHUNK = 1
+    SHM_SETUP = 2
+
+    inline_size = 1024 # Largest procedure data sent on the stream
+    region_size = 8 * 1024 * 1024 # Bytes of data in each direction
+    max_region_size = 256 * 1024 * 1024 # Largest region a server accepts
+    prefix = "pynfs-shm-"
+
+    def __init__(self, *args, **kwargs):
+        RpcPipe.__init__(self, *args, **kwargs)
+        self._mm = None
+        self._send_region = None
+        self._recv_region = None
+        self.placed = 0 # Bytes of procedure data sent through shm
+        self.inlined = 0 # Bytes of procedure data sent on the stream
+
+    def __str__(self):
+        return "shm-%i" % self._s.fileno()
+
+    def _map(self, fd, client):
+        size = self.region_size + 8
+        self._mm = mmap.mmap(fd, 2 * size)
+        to_server = ShmRegion(self._mm, 0, self.region_size)
+        to_client = ShmRegion(self._mm, size, self.region_size)
+        if client:
+            self._send_region, self._recv_region = to_server, to_client
+        else:
+            self._send_region, self._recv_region = to_client, to_server
+
+    def offer_region(self):
+        """Client side: create the shared memory, and tell server about it"""
+        dir = None
+        if os.path.isdir("/dev/shm"):
+            dir = "/dev/shm"
+        fd, path = tempfile.mkstemp(prefix=self.prefix, dir=dir)
+        try:
+            os.ftruncate(fd, 2 * (self.region_size + 8))
+            self._map(fd, True)
+        finally:
+            os.close(fd)
+        self.push_record((None, struct.pack('>L', self.region_size) + path))
+
+    def _peer_uid(self):
+        """Return the uid of the process at the other end of the socket"""
+        creds = self._s.getsockopt(socket.SOL_SOCKET,
+                                   getattr(socket, "SO_PEERCRED", 17),
+                                   struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid
+
+    def _accept_region(self, data):
+        """Server side: map the shared memory offered by the client
+
+        Raises ValueError if the offer is not acceptable.
+        """
+        if self._mm is not None:
+            raise ValueError("Shared memory already set up")
+        size = struct.unpack('>L', data[:4])[0]
+        path = data[4:]
+        if not 0 < size <= self.max_region_size:
+            raise ValueError("Bad shared memory size %i" % size)
+        dirs = set([os.path.realpath("/dev/shm"),
+                    os.path.realpath(tempfile.gettempdir())])
+        if (os.path.realpath(os.path.dirname(path)) not in dirs or
+            not os.path.basename(path).startswith(self.prefix)):
+            raise ValueError("Refusing to map %r" % path)
+        fd = os.open(path, os.O_RDWR | getattr(os, "O_NOFOLLOW", 0))
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise ValueError("%r is not a regular file" % path)
+            if st.st_uid != self._peer_uid():
+                raise ValueError("%r is not owned by the client" % path)
+            if st.st_size != 2 * (size + 8):
+                raise ValueError("%r has the wrong size" % path)
+            self.region_size = size
+            self._map(fd, False)
+            # Only remove the file we actually mapped
+            lst = os.lstat(path)
+            if (lst.st_dev, lst.st_ino) == (st.st_dev, st.st_ino):
+                os.unlink(path)
+        finally:
+            os.close(fd)
+
+    def rpc_send(self, rpc_msg, data=''):
+        # Keep header and data apart, so data can be placed on its own
+        p = FancyRPCPacker()
+        p.pack_rpc_msg(rpc_msg)
+        self.push_record((p.get_buffer(), data))
+
+    def _encode_record(self, record):
+        if type(record) is not tuple:
+            return struct.pack('>L', self.SHM_INLINE) + record
+        header, data = record
+        if header is None:
+            # From offer_region
+            return struct.pack('>L', self.SHM_SETUP) + data
+        if len(data) > self.inline_size and self._send_region is not None:
+            chunk = self._send_region.place(data)
+            if chunk is not None:
+                self.placed += len(data)
+                return struct.pack('>LLLQ', self.SHM_CHUNK, *chunk) + header
+        self.inlined += len(data)
+        return struct.pack('>L', self.SHM_INLINE) + header + data
+
+    def recv_records(self, count):
+        records = RpcPipe.recv_records(self, count)
+        if records is None:
+            return None
+        out = []
+        try:
+            for record, pipe in records:
+                kind = struct.unpack('>L', record[:4])[0]
+                if kind == self.SHM_INLINE:
+                    out.append((record[4:], pipe))
+                elif kind == self.SHM_CHUNK:
+                    if self._recv_region is None:
+                        raise ValueError("Chunk sent before shared memory")
+                    offset, length, end = struct.unpack('>LLQ', record[4:20])
+                    data = self._recv_region.take(offset, length, end)
+                    out.append((record[20:] + data, pipe))
+                elif kind == self.SHM_SETUP:
+                    self._accept_region(record[4:])
+                else:
+                    log_p.error("Unknown shm record type %i" % kind)
+        except (ValueError, struct.error, EnvironmentError), e:
+            # Don't trust anything more from this peer
+            log_p.warn("Closing %s after bad shm record: %s" % (self, e))
+            return None
+        return out
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._s.close()
+
+class DatagramPeer(RpcPipe):
+    """The address a datagram came from, seen as a pipe to reply through."""
+    def __init__(self, parent, address):
+        RpcPipe.__init__(self, parent._s, parent._alarm)
+        self._parent = parent
+        self.peer = address
+
+    def __str__(self):
+        return "udp-%i-%s" % (self._s.fileno(), self.peer[0])
+
+    def getpeername(self):
+        return self.peer
+
+    # A sender forgotten by its DatagramPipe comes back as a new
+    # DatagramPeer, which should still match any connection bindings.
+    def __eq__(self, other):
+        return (isinstance(other, DatagramPeer) and
+                self._parent is other._parent and self.peer == other.peer)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._parent), self.peer))
+
+    def push_record(self, record):
+        self._parent.push_record(record, self.peer)
+
 #################################################
 
 class ConnectionHandler(object):
@@ -454,6 +777,8 @@ class ConnectionHandler(object):
         self.sockets = {} # {fd: pipe}
         # A list of the sockets set to listen for connections
         self.listeners = set()
+        # Pipe used for connections to listeners that don't use RpcPipe
+        self.pipe_classes = {} # {listener fd: class}
 
         # Create internal server for alarm system to connect to
         self.s = self.expose((LOOPBACK, 0), socket.AF_INET, False)
@@ -470,6 +795,7 @@ class ConnectionHandler(object):
         self.rsize = 4096 # Read data in chunks of this size
         self.wsize = 4098 # Read data in chunks of this size
         self.rpcversions = (2,) # Supported RPC versions
+        self.transport = "tcp" # Default transport used by connect()
 
         # Dictionary {flavor: handler} used for server-side authentication
         self.sec_flavors = security.instances()
@@ -561,8 +887,9 @@ class ConnectionHandler(object):
             log_p.error("accept() got error %s" % str(e))
             return
         csock.setblocking(0)
+        pipe_class = self.pipe_classes.get(s.fileno(), RpcPipe)
         fd = csock.fileno()
-        pipe = self.sockets[fd] = RpcPipe(csock, self._alarm)
+        pipe = self.sockets[fd] = pipe_class(csock, self._alarm)
         log_p.info("got connection from %s, assigned to fd=%i" %
              (csock.getpeername(), fd))
         # Start listening for data to come in on new connection
@@ -592,11 +919,11 @@ class ConnectionHandler(object):
 
         For each full RPC record, then dispatch it to a thread.
         """
-        s = self.sockets[fd]
-        for r in records:
+        for r, pipe in records:
             log_p.log(5, "Received record from %i" % fd)
             log_p.log(2, repr(r))
-            t = threading.Thread(target=self._event_rpc_record, args=(r, s))
+            t = threading.Thread(target=self._event_rpc_record,
+                                 args=(r, pipe))
             t.setDaemon(True)
             t.start()
 
@@ -657,6 +984,7 @@ class ConnectionHandler(object):
         call_info.payload_size = len(msg_data)
         call_info.connection = pipe
         call_info.raw_cred = msg.body.cred
+        call_info.xid = msg.xid
         notify = None
         try:
             # Check for reasons to DENY the call
@@ -801,27 +1129,49 @@ class ConnectionHandler(object):
         #       else return AUTH_BADCRED
         return True
     
-    def connect(self, address, secure=False):
+    def connect(self, address, secure=False, transport=None):
         """Connect to given address, returning new pipe
 
         If secure==True, will bind local asocket to a port < 1024.
+        transport is one of TRANSPORTS, defaulting to self.transport.
+        For "unix", address is the socket path, or a tuple starting
+        with it.
         """
         log_t.info("Called connect(%r)" % (address,))
-        af = socket.AF_INET
-        if address[0].find(':') != -1:
-            af = socket.AF_INET6
-        s = socket.socket(af, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        if secure:
-            self.bindsocket(s)
+        if transport is None:
+            transport = self.transport
+        if transport in ("unix", "shm"):
+            if not isinstance(address, basestring):
+                address = address[0]
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        elif transport in ("tcp", "udp"):
+            af = socket.AF_INET
+            if address[0].find(':') != -1:
+                af = socket.AF_INET6
+            if transport == "tcp":
+                s = socket.socket(af, socket.SOCK_STREAM)
+            else:
+                s = socket.socket(af, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if secure:
+                self.bindsocket(s)
+        else:
+            raise ValueError("Unknown transport %r" % transport)
         s.connect(address)
         s.setblocking(0)
-        pipe = RpcPipe(s, self._alarm)
+        if transport == "udp":
+            pipe = DatagramPipe(s, self._alarm)
+        elif transport == "shm":
+            pipe = ShmPipe(s, self._alarm)
+        else:
+            pipe = RpcPipe(s, self._alarm)
         # Tell polling loop about the new socket
         defer = DeferredData()
         self._alarm.buzz('\x01', (pipe, defer))
         # Wait until polling loop knows about new socket
         defer.wait()
+        if transport == "shm":
+            pipe.offer_region()
         return pipe
 
     def bindsocket(self, s, port=1):
@@ -843,14 +1193,25 @@ class ConnectionHandler(object):
                     raise
 
 
-    def expose(self, address, af, safe=True):
-        """Start listening for incoming connections on the given address"""
+    def expose(self, address, af, safe=True, pipe_class=None):
+        """Start listening for incoming connections on the given address
+
+        For af == AF_UNIX, address is the socket path.  Connections
+        accepted are wrapped in pipe_class, by default RpcPipe.
+        """
         s = socket.socket(af, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if af == socket.AF_UNIX:
+            # Remove a socket left behind by an earlier server
+            if os.path.exists(address):
+                os.unlink(address)
+        else:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(address)
         s.setblocking(0)
         s.listen(5)
         self.listeners.add(s.fileno()) # XXX BUG - never removed
+        if pipe_class is not None:
+            self.pipe_classes[s.fileno()] = pipe_class
         if safe:
             # Tell polling loop about the new socket
             defer = DeferredData()
@@ -864,6 +1225,27 @@ class ConnectionHandler(object):
             # A list of all sockets we have open, indexed by fileno
             self.sockets[s.fileno()] = s
         return s
+
+    def expose_udp(self, address, af, safe=True):
+        """Start accepting datagrams on the given address
+
+        Calls arriving this way go through the same dispatch as those
+        arriving over a connection.
+        """
+        s = socket.socket(af, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(address)
+        s.setblocking(0)
+        pipe = DatagramPipe(s, self._alarm)
+        if safe:
+            defer = DeferredData()
+            self._alarm.buzz('\x01', (pipe, defer))
+            defer.wait()
+        else:
+            self.readlist.add(s.fileno())
+            self.errlist.add(s.fileno())
+            self.sockets[s.fileno()] = pipe
+        return pipe
             
     def make_call_function(self, pipe, procedure, prog, vers):
         def call(data, credinfo, proc=None, timeout=15.0):
@@ -884,7 +1266,14 @@ class ConnectionHandler(object):
 #################################################
 
 class Server(ConnectionHandler):
-    def __init__(self, prog, versions, port, interface=''):
+    def __init__(self, prog, versions, port, interface='', udp=False,
+                 unix=None, shm=None):
+        """Listen for TCP connections on port
+
+        If udp is True, also take datagrams on the same port, and if unix
+        is set, also listen on an AF_UNIX socket at that path.  Setting
+        shm does the same, for clients using the shm transport.
+        """
         ConnectionHandler.__init__(self)
         self.prog = prog
         self.versions = versions # List of supported versions of prog
@@ -892,9 +1281,17 @@ class Server(ConnectionHandler):
         try:
             # This listens on both AF_INET and AF_INET6
             self.expose((interface, port), socket.AF_INET6, False)
+            af = socket.AF_INET6
         except:
             # ipv6 not supported, fall back to ipv4
             self.expose((interface, port), socket.AF_INET, False)
+            af = socket.AF_INET
+        if udp:
+            self.expose_udp((interface, port), af, False)
+        if unix is not None:
+            self.expose(unix, socket.AF_UNIX, False)
+        if shm is not None:
+            self.expose(shm, socket.AF_UNIX, False, ShmPipe)
 
     def _check_program(self, prog):
         return (self.prog == prog)
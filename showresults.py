@@ -38,9 +38,18 @@ class MyUnpickler(pickle.Unpickler):
 
 def show(filename, opt):
     fd = file(filename, 'r')
-    p = MyUnpickler(fd)
-    tests = p.load()
+    if fd.read(1) == '{':
+        # Json stream from testserver.py --outfile
+        fd.seek(0)
+        tests = testmod.read_results(fd)
+    else:
+        # Pickled results from older runs
+        fd.seek(0)
+        p = MyUnpickler(fd)
+        tests = p.load()
     testmod.printresults(tests, opt)
+    if opt.xmlout is not None:
+        testmod.xml_printresults(tests, opt.xmlout)
 
 def scan_options(p):
     """Parse command line options"""
@@ -60,6 +69,8 @@ def scan_options(p):
                  help="Show failed tests [default]")
     p.add_option("--hidefail", action="store_false", dest="showfail",
                  help="Hide failed tests")
+    p.add_option("--xmlout", "--xml", default=None, metavar="FILE",
+                 help="Also store results in xml format")
     return p.parse_args()
 
 def main():